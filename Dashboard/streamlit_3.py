@@ -3,6 +3,10 @@ import pandas as pd
 import plotly.express as px
 from sklearn.linear_model import LinearRegression
 import numpy as np
+import sys
+
+sys.path.append("..")
+from modeling.cube import DazubiCube, TOTAL_REGION
 
 # Seite konfigurieren
 st.set_page_config(
@@ -34,6 +38,15 @@ st.markdown("""
 df = pd.read_csv("../data/dazubi_grouped_berufe.csv")
 df = df[["Jahr", "Region", "Beruf_clean", "Vorzeitige Vertragslösungen Insgesamt"]].dropna()
 
+
+# Summen über Regionen einmal vorberechnen statt bei jeder Auswahl
+@st.cache_resource
+def load_cube():
+    return DazubiCube(df)
+
+
+cube = load_cube()
+
 # Sidebar – Filter
 st.sidebar.image("https://cdn-icons-png.flaticon.com/512/3064/3064197.png", width=80)
 st.sidebar.header("🎛️ Filteroptionen")
@@ -85,7 +98,8 @@ if not filtered_df.empty:
 
     # Forecast mit Linear Regression
     if zeige_forecast:
-        forecast_df = filtered_df.groupby("Jahr")["Vorzeitige Vertragslösungen Insgesamt"].sum().reset_index()
+        forecast_df = cube.series(region if region != "Alle" else TOTAL_REGION, beruf, "Vorzeitige Vertragslösungen Insgesamt", jahr_range)
+        forecast_df = forecast_df[forecast_df.index.isin(filtered_df["Jahr"])].reset_index()
         X = forecast_df[["Jahr"]]
         y = forecast_df["Vorzeitige Vertragslösungen Insgesamt"]
         model = LinearRegression()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+'''
+Reader for the wide Destatis tables with one row per year and one column per state, e.g. data/destatis/nominalwage_idx.csv.
+
+The headers of these tables contain soft hyphens, line breaks after hyphens ('Baden-\\nWürttemberg')
+and footnote numbers ('Hamburg1'). They are normalized with one compiled pattern. The year column
+is parsed numerically (a trailing '-' or footnote is ignored), the values are converted from the
+German number format in one pass and the table is melted into a typed long table:
+
+	year (int16), state (category), <value_name> (float32)
+
+The long table is cached as Parquet next to the source in data/cache/destatis and only rebuilt if
+the source file is newer. Compare with the former string replacements of the notebook:
+
+	python data_collect/destatis.py --benchmark data/destatis/*.csv
+'''
+import os, re, time, argparse, glob
+import numpy as np
+import pandas as pd
+
+source_dir = 'data/destatis'
+cache_dir = 'data/cache/destatis'
+
+# soft hyphen, line break after a hyphen, footnote number at the end of a name, remaining whitespace
+header_pattern = re.compile(r'(?P<soft>\u00ad)|(?<=-)\s*\n\s*(?P<hyphen>)|(?<=[^\d\s])(?P<footnote>\d+)$|(?P<space>\s+)')
+year_pattern = re.compile(r'(\d{4})')
+# parentheses, whitespace and dashes after a number, a leading minus is kept
+value_pattern = re.compile(r'[()\s]|(?<=\d)-')
+
+def _replace_header(match: re.Match) -> str:
+	return ' ' if match.lastgroup == 'space' else ''
+
+def normalize_header(header: str) -> str:
+	'''Normalizes a column header, e.g. 'Baden-\\nWürttemberg' -> 'Baden-Württemberg', 'Hamburg1' -> 'Hamburg'.'''
+	return header_pattern.sub(_replace_header, str(header)).strip()
+
+def parse_years(years: pd.Series) -> pd.Series:
+	'''Year column as Int16, entries like '2024-' or '2024 1)' are reduced to the year.'''
+	if pd.api.types.is_numeric_dtype(years):
+		return years.astype('Int16')
+	return pd.to_numeric(years.astype(str).str.extract(year_pattern, expand=False), errors='coerce').astype('Int16')
+
+def parse_values(values: pd.Series) -> pd.Series:
+	'''Numbers in the German format as float32, parentheses (provisional values) are removed, a lone dash is missing.'''
+	if pd.api.types.is_numeric_dtype(values):
+		return values.astype('float32')
+	text = values.astype(str).str.replace(value_pattern, '', regex=True).str.replace(',', '.', regex=False)
+	return pd.to_numeric(text, errors='coerce').astype('float32')
+
+def to_long(df_raw: pd.DataFrame, value_name: str, year_column: str = 'Jahr') -> pd.DataFrame:
+	'''
+	Reshapes a wide Destatis table into a typed long table.
+
+	Args:
+		df_raw (pd.DataFrame): Table with a year column and one column per state.
+		value_name (str): Name of the value column of the result.
+		year_column (str): Name of the year column of df_raw (after normalizing), 'year' is accepted too.
+
+	Returns:
+		pd.DataFrame: Columns 'year' (int16), 'state' (category) and value_name (float32),
+			rows without year or value are dropped.
+	'''
+	df = df_raw.rename(columns=normalize_header)
+	if year_column not in df.columns:
+		year_column = 'year'
+	years = parse_years(df[year_column])
+	state_cols = [col for col in df.columns if col != year_column]
+	# state-major order: all years of the first state, then all years of the second state, ...
+	df_long = pd.DataFrame({
+		'year': np.tile(years.to_numpy(dtype='float64', na_value=np.nan), len(state_cols)),
+		'state': pd.Categorical.from_codes(np.repeat(np.arange(len(state_cols)), len(df)), categories=pd.Index(state_cols)),
+		value_name: parse_values(pd.Series(df[state_cols].to_numpy(dtype=object).T.ravel())),
+	})
+	df_long = df_long.dropna(subset=['year', value_name])
+	df_long['year'] = df_long['year'].astype('int16')
+	return df_long.reset_index(drop=True)
+
+def cache_path(path: str, cache_dir: str = cache_dir) -> str:
+	return os.path.join(cache_dir, os.path.splitext(os.path.basename(path))[0] + '.parquet')
+
+def read_table(path: str, value_name: str = None, cache_dir: str = cache_dir, refresh: bool = False) -> pd.DataFrame:
+	'''
+	Reads a Destatis CSV file as typed long table, using the Parquet cache if it's newer than the file.
+
+	Args:
+		path (str): CSV file.
+		value_name (str, optional): Name of the value column, defaults to the file name without extension.
+		refresh (bool): Rebuild the cached table.
+	'''
+	value_name = value_name or os.path.splitext(os.path.basename(path))[0]
+	cached = cache_path(path, cache_dir)
+	if not refresh and os.path.exists(cached) and os.path.getmtime(cached) >= os.path.getmtime(path):
+		df = pd.read_parquet(cached)
+		if value_name in df.columns:
+			return df
+	df = to_long(pd.read_csv(path), value_name)
+	os.makedirs(cache_dir, exist_ok=True)
+	tmp_filename = cached + '.tmp'
+	try:
+		df.to_parquet(tmp_filename, index=False)
+		os.replace(tmp_filename, cached)
+	except (KeyboardInterrupt, OSError, RuntimeError):
+		if os.path.exists(tmp_filename):
+			os.remove(tmp_filename)
+		raise
+	return df
+
+def legacy_prepare_wage_dataframe(df_raw: pd.DataFrame, value_col_name: str) -> pd.DataFrame:
+	'''The former implementation of the notebook feature_integration.ipynb, only kept for the benchmark.'''
+	df_processed = df_raw.copy()
+	if 'Jahr' in df_processed.columns:
+		df_processed.rename(columns={'Jahr': 'year'}, inplace=True)
+	df_processed['year'] = df_processed['year'].astype(str).str.replace('-', '', regex=False)
+	df_processed['year'] = pd.to_numeric(df_processed['year'], errors='coerce').astype('Int64')
+	for old, new in [
+		(r'Hamburg1', 'Hamburg'), (r'Schleswig-Holstein1', 'Schleswig-Holstein'), (r'Sachsen-Anhalt1', 'Sachsen-Anhalt'),
+		(r'Baden-\nWürttemberg', 'Baden-Württemberg'), (r'Nordrhein-\nWestfalen', 'Nordrhein-Westfalen'), (r'Rheinland-\nPfalz', 'Rheinland-Pfalz'),
+	]:
+		df_processed.columns = df_processed.columns.str.replace(old, new, regex=True)
+	df_processed.columns = df_processed.columns.str.replace('Nieder\u00adsachsen', 'Niedersachsen', regex=False)
+	df_processed.columns = df_processed.columns.str.strip()
+	state_cols = [col for col in df_processed.columns if col != 'year']
+	for col in state_cols:
+		df_processed[col] = df_processed[col].astype(str).str.replace(r'[()\-\s]', '', regex=True)
+		df_processed[col] = df_processed[col].str.replace(',', '.', regex=False)
+		df_processed[col] = pd.to_numeric(df_processed[col], errors='coerce')
+	df_long = df_processed.melt(id_vars=['year'], var_name='state', value_name=value_col_name)
+	df_long.dropna(subset=['year', value_col_name], inplace=True)
+	df_long['year'] = df_long['year'].astype(int)
+	df_long['state'] = df_long['state'].astype(str).str.strip()
+	return df_long
+
+def benchmark(paths: list, repeat: int = 5, scale: int = 1000) -> pd.DataFrame:
+	'''
+	Time of the legacy notebook function and of `to_long` per file.
+
+	The rows of each table are repeated `scale` times, the real tables have only a few dozen rows.
+
+	Returns:
+		pd.DataFrame: One row per file with the rows, the best time of both variants and the memory of the results.
+	'''
+	results = []
+	for path in paths:
+		df_raw = pd.read_csv(path)
+		df_raw = pd.concat([df_raw] * scale, ignore_index=True)
+		value_name = os.path.splitext(os.path.basename(path))[0]
+		row = {'file': path, 'rows': len(df_raw)}
+		for name, func in [('legacy', legacy_prepare_wage_dataframe), ('reader', to_long)]:
+			best = float('inf')
+			for _ in range(repeat):
+				start = time.perf_counter()
+				df_long = func(df_raw, value_name)
+				best = min(best, time.perf_counter() - start)
+			row[f'{name}_seconds'] = best
+			row[f'{name}_bytes'] = int(df_long.memory_usage(deep=True).sum())
+		results.append(row)
+	return pd.DataFrame(results)
+
+def parse_arguments():
+	parser = argparse.ArgumentParser(
+		formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+		description='Convert the Destatis tables into typed long tables in the Parquet cache',
+	)
+	parser.add_argument('files', nargs='*', help=f'CSV files, default all files in {source_dir}')
+	parser.add_argument('-c', '--cache-dir', default=cache_dir)
+	parser.add_argument('-r', '--refresh', action='store_true', help='Rebuild cached tables.')
+	parser.add_argument('-b', '--benchmark', action='store_true', help='Compare with the former notebook implementation instead.')
+	return parser.parse_args()
+
+if __name__ == '__main__':
+	args = parse_arguments()
+	files = args.files or sorted(glob.glob(os.path.join(source_dir, '*.csv')))
+	if args.benchmark:
+		print(benchmark(files).to_string(index=False))
+	else:
+		for path in files:
+			df = read_table(path, cache_dir=args.cache_dir, refresh=args.refresh)
+			print(f'===> {path}: {len(df)} rows, {df["state"].nunique()} states, {df["year"].min()}-{df["year"].max()} -> {cache_path(path, args.cache_dir)}')
@@ -6,6 +6,7 @@ import requests
 from bs4 import BeautifulSoup
 import pandas as pd
 import term
+from schema import apply_schema, compact, concat, frames_equal, infer_schema, read_dazubi, schema_path, write_schema
 
 # Base URL and directory for saving files
 url = "https://www.bibb.de/dienst/dazubi/de/2252.php"
@@ -210,7 +211,7 @@ def restore_download() -> Tuple[int, DataFrame]:
 					max_filename = filename
 	if max_filename is not None:
 		try:
-			df = pd.read_csv(os.path.join(output_dir_occ, max_filename), index_col=0)
+			df = read_dazubi(os.path.join(output_dir_occ, max_filename))
 			print(f'===> restore file {max_filename} with {len(df)} rows')
 			return max_number+1, df
 		except Exception as e:
@@ -297,14 +298,20 @@ def main(args: argparse.Namespace):
 						time.sleep(args.sleep)
 					cnt += 1
 				if (len(df_occ) > 0):
-					df = pd.concat([df, df_occ])
-					df.reset_index(inplace=True, drop=True)
+					# the attribute columns are compacted per occupation, so the complete table never holds float64 counts
+					df = concat([df, compact(df_occ)])
 					if cnt_write >= args.write_skip:
 						save_dataframe(df, f'{output_dir_occ}/dazubi_{cnt:06d}.csv', sanity_check=not args.no_sanity_check, compress=args.compress)
 						cnt_write = 0
 					else:
 						cnt_write += 1
+		# the types of the concatenated occupations can be wider than needed
+		schema = infer_schema(df)
+		df = apply_schema(df, schema)
+		write_schema(schema, schema_path(output_file))
 		save_dataframe(df, compress=args.compress)
+		if not frames_equal(df, read_dazubi(output_file + ('.bz2' if args.compress else ''), schema)):
+			raise RuntimeError(f'{output_file} doesn\'t read back to the downloaded table')
 	print(f'===> {cnt} files donwloaded')
 	df.info()
 
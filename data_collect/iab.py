@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+'''
+Employment and unemployment features per state and year from the IAB tables "Beruf - Struktur - Entwicklung".
+
+The HTML pages of the 16 states are downloaded concurrently and saved in a cache directory, later
+runs read the cached pages. With --offline nothing is downloaded, so the features can be rebuilt
+(or the cleaning can be tested) from the cache alone. The cleaning removes the section header rows
+of a table with one combined regular expression and converts all values in one pass. The result is
+saved as typed Parquet table with one row per state and year:
+
+	python data_collect/iab.py                # download missing pages and build data/iab_features.parquet
+	python data_collect/iab.py --offline      # build from the cached pages only
+	python data_collect/iab.py --refresh      # download all pages again
+'''
+import os, re, time, argparse
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from urllib.parse import urlencode
+import requests
+import pandas as pd
+
+base_url = 'https://iab.de/grafiken-und-daten/beruf-struktur-entwicklung/'
+params_template = {
+	'beruf': 1,
+	'qualifikation': 0,
+	'jahre': '2013,2014,2015,2016,2017,2018,2019,2020,2021,2022'
+}
+cache_dir = 'data/cache/iab'
+output_file = 'data/iab_features.parquet'
+
+state_id_map = {
+	'BW': 4,
+	'BY': 5,
+	'HB': 6,
+	'HH': 7,
+	'HE': 8,
+	'NI': 9,
+	'NW': 10,
+	'RP': 11,
+	'SL': 12,
+	'SH': 13,
+	'BE': 15,
+	'BB': 16,
+	'MV': 17,
+	'SN': 18,
+	'ST': 19,
+	'TH': 20
+}
+
+abbr_to_full_state_name = {
+	'BW': 'Baden-Württemberg',
+	'BY': 'Bayern',
+	'BE': 'Berlin',
+	'BB': 'Brandenburg',
+	'HB': 'Bremen',
+	'HH': 'Hamburg',
+	'HE': 'Hessen',
+	'MV': 'Mecklenburg-Vorpommern',
+	'NI': 'Niedersachsen',
+	'NW': 'Nordrhein-Westfalen',
+	'RP': 'Rheinland-Pfalz',
+	'SL': 'Saarland',
+	'SN': 'Sachsen',
+	'ST': 'Sachsen-Anhalt',
+	'SH': 'Schleswig-Holstein',
+	'TH': 'Thüringen',
+}
+
+# rows of the first column that are section headers and not metrics
+employment_section_headers = ['Beschäftigtengruppen', 'Branchenstruktur', 'Mittleres monatliches', 'Geschlecht', 'Alter', 'Qualifikation', 'Betriebsgröße']
+unemployment_section_headers = ['Arbeitlosenquote', 'Arbeitslosengruppen', 'Geschlecht', 'Alter', 'Qualifikation', 'Dauer', 'Rechtskreis']
+
+# metric names of the IAB tables (with their typos) to column names, metrics not listed here are dropped
+metric_mapping_emp = {
+	'Sozialversicherungspflichtig Beschäftigte (Anzahl)': 'Emp_Total_Count',
+	'Bestandsentwicklung Index (2013=100)': 'Emp_Index',
+	'Frauen': 'Emp_Women_Share',
+	'Ausländer': 'Emp_Foreign_Share',
+	'Unter 25 Jahre': 'Emp_Age_Under_25_Share',
+	'25 bis unter 35 Jahre': 'Emp_Age_25_34_Share',
+	'35 bis unter 50 Jahre': 'Emp_Age_35_49_Share',
+	'50 und älter': 'Emp_Age_50_Plus_Share',
+	'Teilzeit': 'Emp_PartTime_Share',
+	'Ohne abgeschlossene Berufsausbildung': 'Emp_No_Vocational_Edu_Share',
+	'Abschluss einer anerkannten Berufsausbildung': 'Emp_Recognized_Vocational_Edu_Share',
+	'Meister-/Techniker- oder gleichwertiger Fachschulabschluss': 'Emp_Master_Tech_Share',
+	'Bachelor': 'Emp_Bachelor_Share',
+	'Diplom/Magister/Staatsexamen': 'Emp_Diplom_Magister_StateExam_Share',
+	'Promotion': 'Emp_Promotion_Share',
+	'Berufliche Ausbildung unbekannt': 'Emp_Vocational_Edu_Unknown_Share',
+	'Insgesamt': 'Emp_Avg_Gross_Salary_Total',
+	'Männer': 'Emp_Avg_Gross_Salary_Men',
+	'Land-, Fortswirtschaft, Gartenbau': 'Emp_Sector_Agriculture_Share',
+	'Produzierendes Gewerbe': 'Emp_Sector_Manufacturing_Share',
+	'darunter: Maschinen-, Farhrzeugbau': 'Emp_Sector_Manufacturing_Machinery_Share',
+	'Baugewerbe': 'Emp_Sector_Construction_Share',
+	'Übriges produzierendes Gewerbe': 'Emp_Sector_Manufacturing_Other_Share',
+	'Dienstleistungssektor': 'Emp_Sector_Services_Share',
+	'darunter: Handel': 'Emp_Sector_Services_Trade_Share',
+	'Verkehr und Nachrichtenübermittlung': 'Emp_Sector_Services_Transport_Com_Share',
+	'Kredit- und Versicherunsgewerbe': 'Emp_Sector_Services_Finance_Insurance_Share',
+	'Ingenieurbüros, Rechtsberatung, Werbung, Arbeitnehmerüberlassung': 'Emp_Sector_Services_Professional_Share',
+	'Erziehung, Unterricht, Kultur, Sport, Unterhaltung': 'Emp_Sector_Services_Edu_Culture_Share',
+	'Gesundheits-, Sozialwesen': 'Emp_Sector_Services_Health_Social_Share',
+	'Öffenliche Verwaltung, Sozialversicherung': 'Emp_Sector_Services_Public_Admin_Share',
+	'Übrige Dienstleistungen': 'Emp_Sector_Services_Other_Share',
+}
+
+metric_mapping_unemp = {
+	'Arbeitslose mit desem Zielberuf (Anzahl)': 'Unemp_Total_Count',
+	'Bestandsentwicklung Index (2013=100)': 'Unemp_Index_2013_100',
+	'Alo-Quote insgesamt': 'Unemp_Rate_Total',
+	'Alo-Quote Männer': 'Unemp_Rate_Men',
+	'Alo-Quote Frauen': 'Unemp_Rate_Women',
+	'Frauen': 'Unemp_Women_Share',
+	'Ausländer': 'Unemp_Foreign_Share',
+	'Unter 25 Jahre': 'Unemp_Age_Under_25_Share',
+	'25 bis unter 35 Jahre': 'Unemp_Age_25_34_Share',
+	'35 bis unter 50 Jahre': 'Unemp_Age_35_49_Share',
+	'50 Jahre und älter': 'Unemp_Age_50_Plus_Share',
+	'ohne abgeschlossene Berufsbildung': 'Unemp_No_Vocational_Edu_Share',
+	'mit betrieblicher Ausbildung': 'Unemp_Vocational_Training_Share',
+	'Bachelor': 'Unemp_Bachelor_Share',
+	'Diplom/Magister/Master/Staatsexamen': 'Unemp_Diplom_Magister_Master_StateExam_Share',
+	'Promotion': 'Unemp_Promotion_Share',
+	'Abschluss unbekannt': 'Unemp_Edu_Unknown_Share',
+	'1 Jahr und länger arbeitslos': 'Unemp_LongTerm_Share',
+	'SGB III (Arbeitslosenversicherung)': 'Unemp_SGB_III_Share',
+	'SGB II (Grundsicherung für Arbeitsuchende)': 'Unemp_SGB_II_Share',
+}
+
+def _section_pattern(keywords: list) -> re.Pattern:
+	return re.compile('|'.join(re.escape(keyword) for keyword in keywords), re.IGNORECASE)
+
+employment_section_pattern = _section_pattern(employment_section_headers)
+unemployment_section_pattern = _section_pattern(unemployment_section_headers)
+year_pattern = re.compile(r'^\d{4}$')
+
+class NotCachedError(RuntimeError):
+	pass
+
+def parse_arguments():
+	parser = argparse.ArgumentParser(
+		formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+		description='Download the IAB employment tables of all states and save them as feature table',
+	)
+	parser.add_argument('-o', '--output', default=output_file, help='Parquet file for the feature table.')
+	parser.add_argument('-c', '--cache-dir', default=cache_dir, help='Directory for the downloaded HTML pages.')
+	parser.add_argument('-w', '--workers', type=int, default=4, help='Number of concurrent downloads.')
+	parser.add_argument('--offline', action='store_true', help='Only use the cached pages, a missing page is an error.')
+	parser.add_argument('--refresh', action='store_true', help='Download all pages again, even if they are cached.')
+	return parser.parse_args()
+
+def state_url(state: str) -> str:
+	params = params_template.copy()
+	params['region'] = state_id_map[state]
+	return f'{base_url}?{urlencode(params)}#iab-results'
+
+def fetch_state(state: str, cache_dir: str = cache_dir, offline: bool = False, refresh: bool = False, retries: int = 3) -> str:
+	'''
+	Returns the HTML page of a state from the cache, downloads it if it's not cached.
+
+	Raises:
+		NotCachedError: If the page is not cached in offline mode.
+		requests.RequestException: If the download failed after the retries.
+	'''
+	path = os.path.join(cache_dir, f'{state}.html')
+	if os.path.exists(path) and not refresh:
+		with open(path, encoding='utf-8') as file:
+			return file.read()
+	if offline:
+		raise NotCachedError(f'The page of {state} is not cached in {cache_dir}, run without --offline first.')
+	for attempt in range(retries + 1):
+		try:
+			response = requests.get(state_url(state), timeout=60)
+			response.raise_for_status()
+			break
+		except requests.RequestException as e:
+			print(f'{state}: {attempt} attempt, Exception: {type(e).__name__} - {e}')
+			if attempt >= retries: raise
+			time.sleep(2 ** attempt)
+	os.makedirs(cache_dir, exist_ok=True)
+	tmp_path = path + '.tmp'
+	with open(tmp_path, 'w', encoding='utf-8') as file:
+		file.write(response.text)
+	os.replace(tmp_path, path)
+	return response.text
+
+def fetch_all(states=None, cache_dir: str = cache_dir, offline: bool = False, refresh: bool = False, workers: int = 4) -> dict[str, str]:
+	'''Fetches the pages of the states (default all) concurrently, returns the HTML per state.'''
+	states = list(states or state_id_map)
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		pages = executor.map(lambda state: fetch_state(state, cache_dir, offline, refresh), states)
+		return dict(zip(states, pages))
+
+def identify_tables(html: str) -> tuple[pd.DataFrame | None, pd.DataFrame | None]:
+	'''Finds the employment and the unemployment table of a page by the first cell of the metric column.'''
+	df_employment_raw = None
+	df_unemployment_raw = None
+	for df_candidate in pd.read_html(StringIO(html), thousands='.', decimal=','):
+		if df_candidate.empty or 'Unnamed: 0' not in df_candidate.columns:
+			continue
+		first = df_candidate['Unnamed: 0'].iloc[0]
+		if not isinstance(first, str):
+			continue
+		first = first.strip().lower()
+		if first.startswith('sozialversicherungspflichtig beschäftigte'):
+			df_employment_raw = df_candidate
+		elif first.startswith('arbeitslose mit desem zielberuf'):
+			df_unemployment_raw = df_candidate
+	return df_employment_raw, df_unemployment_raw
+
+def clean_table(df_raw: pd.DataFrame, metric_mapping: dict, section_pattern: re.Pattern) -> pd.DataFrame:
+	'''
+	Converts a raw IAB table into one row per year and one column per mapped metric.
+
+	The section header rows are removed with one combined pattern, the metrics are mapped to
+	column names (the first occurrence wins, like the sections "Frauen" of the share and the salary)
+	and all values are converted at once. `identify_tables` already parses the German number format,
+	only cells of columns with non numeric entries are still text.
+
+	Returns:
+		pd.DataFrame: Index 'year', one column per metric.
+	'''
+	metric = df_raw['Unnamed: 0'].astype(str)
+	keep = ~metric.str.contains(section_pattern, na=False) & metric.isin(metric_mapping.keys())
+	year_cols = [col for col in df_raw.columns if year_pattern.match(str(col))]
+	if not year_cols:
+		raise ValueError('No year columns found in the table')
+	df = df_raw.loc[keep, year_cols]
+	df.index = metric[keep].map(metric_mapping)
+	df = df[~df.index.duplicated()]
+	values = df.astype(object).stack()
+	is_text = values.map(lambda value: isinstance(value, str))
+	values[is_text] = values[is_text].str.replace('.', '', regex=False).str.replace(',', '.', regex=False)
+	df = pd.to_numeric(values, errors='coerce').unstack().T
+	df.index = df.index.astype(int)
+	df.index.name = 'year'
+	df.columns.name = None
+	return df
+
+def build_features(pages: dict[str, str]) -> pd.DataFrame:
+	'''
+	Builds the typed feature table from the HTML pages of the states.
+
+	Returns:
+		pd.DataFrame: Columns 'state' (category with the full state names), 'year' (int16), the counts as
+			nullable Int32 and all other metrics as float32, sorted by state and year.
+	'''
+	frames = []
+	for state, html in pages.items():
+		df_employment_raw, df_unemployment_raw = identify_tables(html)
+		parts = []
+		if df_employment_raw is not None:
+			parts.append(clean_table(df_employment_raw, metric_mapping_emp, employment_section_pattern))
+		else:
+			print(f'Warning: No employment table found for {state}')
+		if df_unemployment_raw is not None:
+			parts.append(clean_table(df_unemployment_raw, metric_mapping_unemp, unemployment_section_pattern))
+		else:
+			print(f'Warning: No unemployment table found for {state}')
+		if parts:
+			df = pd.concat(parts, axis=1).reset_index()
+			df.insert(0, 'state', abbr_to_full_state_name[state])
+			frames.append(df)
+	df = pd.concat(frames, ignore_index=True)
+	df['state'] = pd.Categorical(df['state'], categories=sorted(abbr_to_full_state_name.values()))
+	df['year'] = df['year'].astype('int16')
+	for col in df.columns[2:]:
+		df[col] = df[col].round().astype('Int32') if col.endswith('_Count') else df[col].astype('float32')
+	return df.sort_values(['state', 'year'], ignore_index=True)
+
+def save_features(df: pd.DataFrame, filename: str = output_file):
+	dirname = os.path.dirname(filename)
+	if dirname:
+		os.makedirs(dirname, exist_ok=True)
+	tmp_filename = filename + '.tmp'
+	try:
+		df.to_parquet(tmp_filename, index=False)
+		os.replace(tmp_filename, filename)
+	except (KeyboardInterrupt, OSError, RuntimeError):
+		if os.path.exists(tmp_filename):
+			os.remove(tmp_filename)
+		raise
+
+def load_features(filename: str = output_file) -> pd.DataFrame:
+	return pd.read_parquet(filename)
+
+def main(args: argparse.Namespace):
+	start = time.time()
+	pages = fetch_all(cache_dir=args.cache_dir, offline=args.offline, refresh=args.refresh, workers=args.workers)
+	print(f'===> {len(pages)} pages in {time.time() - start:.1f}s')
+	df = build_features(pages)
+	save_features(df, args.output)
+	print(f'===> {len(df)} rows, {df.shape[1] - 2} features saved to {args.output}')
+	df.info()
+
+if __name__ == '__main__':
+	args = parse_arguments()
+	main(args)
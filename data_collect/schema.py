@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+'''
+Compact dtypes for the wide DAZUBI table (data/dazubi_complete.csv).
+
+`rename_columns` and the outer merges in `download_dazubi.py` produce hundreds of attribute
+columns. pandas reads all of them as float64 (the merges leave gaps), and Region and Beruf as
+Python strings. The schema declares the smallest type of every column that holds its values:
+
+	Jahr                          int16 (Int16 if a year is missing)
+	Region, Beruf                 category
+	counts                        smallest nullable integer (UInt8, UInt16, ..., Int64)
+	other numbers                 float32 if every value survives the cast, else float64
+	other text                    category if it repeats, else object
+
+`apply_schema` checks every cast and raises a ValueError if a value would change, so the compact
+table always holds exactly the values of the original one. The schema is saved as JSON next to the
+CSV file (dazubi_complete.schema.json), and `read_dazubi` passes it to `read_csv`, so the float64
+table is never built. The crawl applies it before saving, and the conversion to Parquet of the
+workflow applies it too, so the Parquet file keeps the types.
+
+Report the memory and check the round trip through CSV and Parquet (run from the repository root):
+
+	python data_collect/schema.py data/dazubi_complete.csv --parquet data/dazubi_complete.parquet
+'''
+import os, re, json, time, argparse, tempfile
+import numpy as np
+import pandas as pd
+
+# declared types of the key columns, all other columns are inferred from their values
+key_dtypes = {'Jahr': 'int16', 'Region': 'category', 'Beruf': 'category'}
+integer_dtypes = ['UInt8', 'Int8', 'UInt16', 'Int16', 'UInt32', 'Int32', 'UInt64', 'Int64']
+# text columns with fewer unique values than this fraction of the rows become categories
+category_fraction = 0.5
+
+def schema_path(path: str) -> str:
+	'''Path of the schema of a CSV or Parquet file, e.g. data/dazubi_complete.schema.json.'''
+	return re.sub(r'\.(csv|parquet)(\.\w+)?$', '', path) + '.schema.json'
+
+def minimal_dtype(values: pd.Series) -> str:
+	'''Smallest dtype that holds all values of a column, see the module docstring.'''
+	if isinstance(values.dtype, pd.CategoricalDtype):
+		return 'category'
+	if values.dtype == object:
+		# the cells of the Excel sheets are Python numbers in object columns
+		numbers = pd.to_numeric(values, errors='coerce')
+		if numbers.notna().sum() == values.notna().sum():
+			values = numbers
+	if pd.api.types.is_bool_dtype(values) or not pd.api.types.is_numeric_dtype(values):
+		unique = values.nunique(dropna=True)
+		return 'category' if unique <= category_fraction * max(len(values), 1) else 'object'
+	numbers = values.dropna().to_numpy(dtype='float64')
+	if len(numbers) == 0:
+		return 'UInt8'
+	if np.isfinite(numbers).all() and (numbers == np.round(numbers)).all():
+		low, high = numbers.min(), numbers.max()
+		for dtype in integer_dtypes:
+			info = np.iinfo(dtype.lower())
+			if info.min <= low and high <= info.max:
+				return dtype
+	if (numbers.astype('float32').astype('float64') == numbers).all():
+		return 'float32'
+	return 'float64'
+
+def infer_schema(df: pd.DataFrame) -> dict:
+	'''Minimal dtype of every column, the key columns get their declared type.'''
+	schema = {col: key_dtypes.get(col) or minimal_dtype(df[col]) for col in df.columns}
+	if 'Jahr' in df.columns and df['Jahr'].isna().any():
+		schema['Jahr'] = 'Int16'
+	return schema
+
+def same_values(original: pd.Series, compact: pd.Series) -> bool:
+	'''True if both columns hold the same values, missing values in the same rows.'''
+	def comparable(values):
+		if isinstance(values.dtype, pd.CategoricalDtype):
+			values = values.astype(object)
+		elif pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+			values = values.astype('float64')
+		return values.to_numpy()
+	left, right = comparable(original), comparable(compact)
+	missing = pd.isna(left) & pd.isna(right)
+	with np.errstate(invalid='ignore'):
+		return bool((missing | (left == right)).all())
+
+def apply_schema(df: pd.DataFrame, schema: dict = None) -> pd.DataFrame:
+	'''
+	Casts the columns of df to the dtypes of the schema.
+
+	Args:
+		df (pd.DataFrame): Table, e.g. dazubi_complete as read by pandas.
+		schema (dict, optional): dtype per column, default `infer_schema(df)`. Columns that are
+			not in the schema are inferred.
+
+	Raises:
+		ValueError: If a cast would change a value of a column.
+
+	Returns:
+		pd.DataFrame: Copy of df with the compact dtypes.
+	'''
+	schema = schema or {}
+	missing = [col for col in df.columns if col not in schema]
+	if missing:
+		schema = {**infer_schema(df[missing]), **schema}
+	columns = {}
+	for col in df.columns:
+		dtype = schema[col]
+		if str(df[col].dtype) == dtype:
+			columns[col] = df[col]
+			continue
+		try:
+			columns[col] = df[col].astype(dtype)
+		except (TypeError, ValueError, OverflowError) as e:
+			raise ValueError(f'Column {col} can not be stored as {dtype}: {e}') from e
+		if not same_values(df[col], columns[col]):
+			raise ValueError(f'Column {col} changes its values as {dtype}')
+	return pd.DataFrame(columns, index=df.index)
+
+def compact(df: pd.DataFrame) -> pd.DataFrame:
+	'''The table with the inferred minimal dtypes.'''
+	return apply_schema(df, infer_schema(df))
+
+def concat(frames: list) -> pd.DataFrame:
+	'''Concatenates compact tables, categorical columns stay categorical with the union of the categories.'''
+	frames = [frame for frame in frames if len(frame.columns)]
+	categorical = {col for frame in frames for col in frame.columns if isinstance(frame[col].dtype, pd.CategoricalDtype)}
+	for col in categorical:
+		categories = pd.Index([])
+		for frame in frames:
+			if col in frame.columns:
+				values = frame[col]
+				categories = categories.union(values.cat.categories if isinstance(values.dtype, pd.CategoricalDtype) else pd.Index(values.dropna().unique()))
+		dtype = pd.CategoricalDtype(categories)
+		frames = [frame.assign(**{col: frame[col].astype(dtype)}) if col in frame.columns else frame for frame in frames]
+	return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+def write_schema(schema: dict, path: str):
+	with open(path, 'w') as file:
+		json.dump(schema, file, indent=1, ensure_ascii=False)
+
+def read_schema(path: str) -> dict:
+	with open(path) as file:
+		return json.load(file)
+
+def read_dazubi(path: str, schema: dict = None) -> pd.DataFrame:
+	'''
+	Reads a CSV (first column is the index) or Parquet file of the crawl with the compact dtypes.
+
+	The schema defaults to the schema file next to the data, without one it's inferred after reading.
+	'''
+	if schema is None and os.path.exists(schema_path(path)):
+		schema = read_schema(schema_path(path))
+	if path.endswith('.parquet'):
+		return apply_schema(pd.read_parquet(path), schema)
+	if schema is None:
+		return compact(pd.read_csv(path, index_col=0, low_memory=False, float_precision='round_trip'))
+	header = pd.read_csv(path, index_col=0, nrows=0).columns
+	dtype = {col: schema[col] for col in header if col in schema}
+	# the default parser of pandas can be off in the last digit of a float64
+	return apply_schema(pd.read_csv(path, index_col=0, dtype=dtype, float_precision='round_trip'), schema)
+
+def frames_equal(original: pd.DataFrame, compact: pd.DataFrame) -> bool:
+	'''True if both tables have the same columns and the same values in every column.'''
+	return list(original.columns) == list(compact.columns) and len(original) == len(compact) and all(
+		same_values(original[col], compact[col]) for col in original.columns
+	)
+
+def memory_report(before: pd.DataFrame, after: pd.DataFrame) -> str:
+	size_before, size_after = before.memory_usage(deep=True).sum(), after.memory_usage(deep=True).sum()
+	return f'memory {size_before / 2**20:,.1f} MiB -> {size_after / 2**20:,.1f} MiB ({size_before / max(size_after, 1):.1f}x smaller)'
+
+def check_round_trip(df: pd.DataFrame, schema: dict) -> dict:
+	'''Writes the compact table as CSV and Parquet, reads it back and compares it, returns the seconds per format.'''
+	seconds = {}
+	with tempfile.TemporaryDirectory() as directory:
+		for file_format in ('csv', 'parquet'):
+			path = os.path.join(directory, f'round_trip.{file_format}')
+			start = time.perf_counter()
+			df.to_csv(path) if file_format == 'csv' else df.to_parquet(path)
+			restored = read_dazubi(path, schema)
+			seconds[file_format] = time.perf_counter() - start
+			if not frames_equal(df, restored) or dict(restored.dtypes.astype(str)) != dict(df.dtypes.astype(str)):
+				raise ValueError(f'The round trip through {file_format} changed the table')
+	return seconds
+
+def parse_arguments():
+	parser = argparse.ArgumentParser(
+		formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+		description='Infer the compact schema of the DAZUBI table, report the memory and check the round trips',
+	)
+	parser.add_argument('data', nargs='?', default='data/dazubi_complete.csv')
+	parser.add_argument('-p', '--parquet', help='Write the compact table to this Parquet file.')
+	parser.add_argument('--no-check', action='store_true', help='Skip the round trip through CSV and Parquet.')
+	return parser.parse_args()
+
+if __name__ == '__main__':
+	args = parse_arguments()
+	df_raw = pd.read_csv(args.data, index_col=0, low_memory=False, float_precision='round_trip')
+	schema = infer_schema(df_raw)
+	df = apply_schema(df_raw, schema)
+	write_schema(schema, schema_path(args.data))
+	print(f'{len(df)} rows, {len(df.columns)} columns, {memory_report(df_raw, df)}')
+	print(pd.Series(schema).value_counts().to_string())
+	if not args.no_check:
+		seconds = check_round_trip(df, schema)
+		print('lossless round trips: ' + ', '.join(f'{name} {value:.1f}s' for name, value in seconds.items()))
+	if args.parquet:
+		tmp_filename = args.parquet + '.tmp'
+		df.to_parquet(tmp_filename)
+		os.replace(tmp_filename, args.parquet)
+		print(f'Saved {args.parquet}')
@@ -0,0 +1,157 @@
+"""
+Training on aggregated rows instead of one row per person.
+
+The synthetic population is an explosion of aggregated counts, most rows are exact duplicates.
+Fitting on the unique rows with the number of duplicates as `sample_weight` gives the same
+model for estimators where a weight of n is equivalent to n copies of a row (e.g. logistic
+regression, random forest without bootstrap, XGBoost), while training time and memory depend
+on the number of distinct rows only. Parameters that count rows instead of weights (e.g.
+`min_samples_leaf` of HistGradientBoostingClassifier, `bootstrap` or `max_samples` of
+RandomForestClassifier, early stopping on a validation split) can give different models.
+KNeighborsClassifier doesn't support weights at all.
+
+Usage (run from the repository root):
+
+    python -m modeling.aggregation data/synth_combined.csv
+"""
+from logging import getLogger
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.base import clone
+from sklearn.metrics import accuracy_score, f1_score, precision_score, recall_score
+from sklearn.pipeline import Pipeline
+from sklearn.utils.validation import has_fit_parameter
+
+logger = getLogger(__name__)
+
+
+def aggregate_rows(X: pd.DataFrame, y) -> tuple[pd.DataFrame, np.ndarray, np.ndarray]:
+    """
+    Collapses identical rows of features and target into one row with the number of occurrences.
+
+    Args:
+        X (pd.DataFrame): Features.
+        y: Target with the same length as X.
+
+    Returns:
+        tuple: (features of the unique rows, target of the unique rows, number of occurrences)
+    """
+    target = "__target__"
+    cells = (
+        X.assign(**{target: np.asarray(y)})
+        .groupby(list(X.columns) + [target], sort=False, observed=True, dropna=False)
+        .size()
+        .reset_index(name="__count__")
+    )
+    X_cells = cells[list(X.columns)].astype(X.dtypes.to_dict())
+    return X_cells, cells[target].to_numpy(), cells["__count__"].to_numpy()
+
+
+def fit_weighted(estimator, X, y, sample_weight):
+    """
+    Fits an estimator or a Pipeline with sample weights.
+
+    For a Pipeline the weights are passed to the last step.
+
+    Raises:
+        TypeError: If the (final) estimator doesn't support sample weights.
+    """
+    final = estimator.steps[-1][1] if isinstance(estimator, Pipeline) else estimator
+    if not has_fit_parameter(final, "sample_weight"):
+        raise TypeError(f"{type(final).__name__} doesn't support sample_weight")
+    if isinstance(estimator, Pipeline):
+        return estimator.fit(X, y, **{f"{estimator.steps[-1][0]}__sample_weight": sample_weight})
+    return estimator.fit(X, y, sample_weight=sample_weight)
+
+
+def classification_metrics(y_true, y_pred, sample_weight=None) -> dict:
+    """Binary classification metrics, rows can be weighted by their number of occurrences."""
+    return {
+        "accuracy": accuracy_score(y_true, y_pred, sample_weight=sample_weight),
+        "precision": precision_score(y_true, y_pred, sample_weight=sample_weight, zero_division=0),
+        "recall": recall_score(y_true, y_pred, sample_weight=sample_weight, zero_division=0),
+        "f1": f1_score(y_true, y_pred, sample_weight=sample_weight, zero_division=0),
+    }
+
+
+def compare_exploded_and_weighted(estimator, X_train, y_train, X_test, y_test, atol: float = 1e-3) -> pd.DataFrame:
+    """
+    Fits the estimator on the exploded rows and on the aggregated rows and compares the test metrics.
+
+    The test data is aggregated as well, the metrics are weighted with the number of occurrences,
+    which gives exactly the metrics of the exploded test data.
+
+    Args:
+        estimator: Unfitted estimator or Pipeline, it is cloned for both fits.
+        atol (float): Maximum absolute difference of a metric to count as a match.
+
+    Returns:
+        pd.DataFrame: One row per metric with the columns 'exploded', 'weighted', 'difference' and 'match'.
+            The number of training rows and the fit times are stored in `attrs`.
+    """
+    start = time.perf_counter()
+    exploded = clone(estimator).fit(X_train, y_train)
+    time_exploded = time.perf_counter() - start
+
+    start = time.perf_counter()
+    X_cells, y_cells, weights = aggregate_rows(X_train, y_train)
+    weighted = fit_weighted(clone(estimator), X_cells, y_cells, weights)
+    time_weighted = time.perf_counter() - start
+
+    X_test_cells, y_test_cells, test_weights = aggregate_rows(X_test, y_test)
+    result = pd.DataFrame(
+        {
+            "exploded": classification_metrics(
+                y_test_cells, exploded.predict(X_test_cells), test_weights
+            ),
+            "weighted": classification_metrics(
+                y_test_cells, weighted.predict(X_test_cells), test_weights
+            ),
+        }
+    )
+    result["difference"] = (result["weighted"] - result["exploded"]).abs()
+    result["match"] = result["difference"] <= atol
+    result.attrs.update(
+        rows_exploded=len(X_train),
+        rows_weighted=len(X_cells),
+        time_exploded=time_exploded,
+        time_weighted=time_weighted,
+    )
+    logger.info(
+        "exploded: {rows_exploded} rows in {time_exploded:.2f}s, weighted: {rows_weighted} rows in {time_weighted:.2f}s".format(
+            **result.attrs
+        )
+    )
+    return result
+
+
+if __name__ == "__main__":
+    import logging
+    import sys
+
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.model_selection import train_test_split
+    from sklearn.preprocessing import OneHotEncoder
+
+    logging.basicConfig(format="%(asctime)s: %(message)s", level=logging.INFO)
+
+    SEED = 42
+    path = sys.argv[1] if len(sys.argv) > 1 else "data/synth_combined.csv"
+    df = pd.read_csv(path, index_col=0)
+    col_target = "dropped_out"
+    X = df.drop(col_target, axis=1)
+    y = df[col_target].to_numpy()
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, stratify=y, random_state=SEED)
+
+    pipe = Pipeline(
+        [
+            ("enc_onehot", OneHotEncoder(drop="first", handle_unknown="ignore")),
+            ("model_logreg", LogisticRegression(max_iter=500, random_state=SEED)),
+        ]
+    )
+    comparison = compare_exploded_and_weighted(pipe, X_train, y_train, X_test, y_test)
+    print(comparison)
+    if not comparison["match"].all():
+        sys.exit("The metrics of the weighted fit don't match the exploded fit")
@@ -0,0 +1,303 @@
+"""
+Rolling-origin backtest of the forecasters of the dashboards on all occupation/region series.
+
+For every origin year the forecasters only see the years up to the origin and forecast the next
+`horizon` years, which are compared with the reported counts. The series are the (Beruf_clean,
+state) series of `dazubi_grouped_berufe` and the Deutschland series per occupation, taken from
+`modeling.cube.DazubiCube`. Forecasters:
+
+- naive: last value
+- linear_trend: least squares line over the years, like the `LinearRegression` of the dashboards
+  (vectorized over all series)
+- ets: damped additive ETS of `modeling.forecasting`
+- prophet: Prophet per series like `dashboard_FinApprenticeship.py`, only if prophet is installed
+- xgboost: one global model per origin on scaled lags of all series (direct multi-horizon),
+  like the XGBoost of the dashboard but sharing the information of all series. The model of an
+  origin is cached in `cache_dir` and reused by later runs with the same data.
+
+The work is split into tasks (forecaster, origin, chunk of series) that run in a process pool. The
+result is a long table of errors and a leaderboard with MAE, RMSE, sMAPE and the MAE relative to
+the naive forecast.
+
+Usage (run from the repository root):
+
+    python -m modeling.backtest data/dazubi_grouped_berufe.csv --first-origin 2016 --horizon 3 --jobs 8
+"""
+import argparse
+import hashlib
+import os
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from logging import getLogger
+
+import numpy as np
+import pandas as pd
+
+from modeling.cube import TOTAL_REGION, DazubiCube
+from modeling.forecasting import MEASURE, fit_forecast
+
+logger = getLogger(__name__)
+
+CACHE_DIR = "data/cache/backtest"
+N_LAGS = 3
+
+
+def naive_forecast(Y: np.ndarray, years: np.ndarray, horizon: int, **context) -> np.ndarray:
+    return np.repeat(Y[:, -1:], horizon, axis=1)
+
+
+def linear_trend_forecast(Y: np.ndarray, years: np.ndarray, horizon: int, **context) -> np.ndarray:
+    """
+    Least squares line of every series over its observed years, solved for all series at once.
+
+    Like the dashboards, which only have the rows of an occupation since it exists, the years
+    before the first count are left out. A series with one observed year gets its value.
+    """
+    observed = Y > 0
+    first = np.where(observed.any(axis=1), observed.argmax(axis=1), Y.shape[1] - 1)
+    weights = (np.arange(Y.shape[1]) >= first[:, None]).astype(float)
+    x = np.asarray(years, dtype=float)
+    n = weights.sum(axis=1)
+    x_mean = (weights * x).sum(axis=1) / n
+    y_mean = (weights * Y).sum(axis=1) / n
+    dx = x - x_mean[:, None]
+    ss_x = (weights * dx**2).sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = np.where(ss_x > 0, (weights * dx * (Y - y_mean[:, None])).sum(axis=1) / ss_x, 0.0)
+    future = np.arange(1, horizon + 1) + years[-1]
+    return y_mean[:, None] + slope[:, None] * (future - x_mean[:, None])
+
+
+def ets_forecast(Y: np.ndarray, years: np.ndarray, horizon: int, **context) -> np.ndarray:
+    return np.vstack([fit_forecast(y, horizon) for y in Y])
+
+
+def prophet_forecast(Y: np.ndarray, years: np.ndarray, horizon: int, **context) -> np.ndarray:
+    """Prophet with the settings of the dashboard, the last value for series without variation."""
+    import logging
+
+    from prophet import Prophet
+
+    logging.getLogger("cmdstanpy").setLevel(logging.WARNING)
+    dates = pd.to_datetime(years.astype(str))
+    future = pd.DataFrame({"ds": pd.to_datetime(np.arange(years[-1] + 1, years[-1] + horizon + 1).astype(str))})
+    forecasts = []
+    for y in Y:
+        if np.ptp(y) == 0:
+            forecasts.append(np.full(horizon, y[-1]))
+            continue
+        model = Prophet(yearly_seasonality=False, weekly_seasonality=False, daily_seasonality=False)
+        model.fit(pd.DataFrame({"ds": dates, "y": y}))
+        forecasts.append(model.predict(future)["yhat"].to_numpy())
+    return np.vstack(forecasts)
+
+
+def _lag_features(Y: np.ndarray, end: int, horizon: np.ndarray, region_codes: np.ndarray) -> tuple:
+    """Scaled last N_LAGS values up to the column `end` (exclusive), the horizon and the region, and the scale."""
+    lags = Y[:, end - N_LAGS:end]
+    scale = np.maximum(lags.mean(axis=1), 1.0)
+    X = np.column_stack([lags / scale[:, None], np.broadcast_to(horizon, len(Y)), region_codes])
+    return X, scale
+
+
+def xgboost_forecast(Y: np.ndarray, years: np.ndarray, horizon: int, region_codes: np.ndarray = None, cache_dir: str = CACHE_DIR, **context) -> np.ndarray:
+    """
+    Direct multi-horizon forecast with one global XGBoost model trained on all series up to the origin.
+
+    The model is cached under a hash of the training data, so it's fitted once per origin.
+    """
+    import xgboost as xgb
+
+    region_codes = np.zeros(len(Y)) if region_codes is None else region_codes
+    if Y.shape[1] <= N_LAGS:
+        return naive_forecast(Y, years, horizon)
+    # column of the first count of every series, the zeros before it aren't observations
+    observed = Y > 0
+    first = np.where(observed.any(axis=1), observed.argmax(axis=1), Y.shape[1])
+    key = hashlib.sha1(np.ascontiguousarray(Y).tobytes() + region_codes.tobytes() + f"{years[0]}-{horizon}".encode()).hexdigest()[:16]
+    path = os.path.join(cache_dir, f"xgboost_{years[-1]}_{key}.json")
+    model = xgb.XGBRegressor(n_estimators=200, max_depth=4, learning_rate=0.1, n_jobs=1)
+    if os.path.exists(path):
+        model.load_model(path)
+    else:
+        features, targets = [], []
+        for h in range(1, horizon + 1):
+            for end in range(N_LAGS, Y.shape[1] - h + 1):
+                X, scale = _lag_features(Y, end, h, region_codes)
+                # only windows of observed years with a count, all-zero lags give no scale
+                rows = (first <= end - N_LAGS) & (Y[:, end - N_LAGS:end] > 0).any(axis=1)
+                features.append(X[rows])
+                targets.append(Y[rows, end + h - 1] / scale[rows])
+        model.fit(np.vstack(features), np.concatenate(targets))
+        os.makedirs(cache_dir, exist_ok=True)
+        model.save_model(path)
+    forecasts = []
+    for h in range(1, horizon + 1):
+        X, scale = _lag_features(Y, Y.shape[1], h, region_codes)
+        forecasts.append(model.predict(X) * scale)
+    forecasts = np.maximum(np.column_stack(forecasts), 0)
+    # series with fewer than N_LAGS observed years get the last value, like `fit_forecast`
+    short = Y.shape[1] - first < N_LAGS
+    forecasts[short] = naive_forecast(Y[short], years, horizon)
+    return forecasts
+
+
+# name -> (function, fitted per series so the series are split into chunks)
+FORECASTERS = {
+    "naive": (naive_forecast, False),
+    "linear_trend": (linear_trend_forecast, False),
+    "ets": (ets_forecast, True),
+    "prophet": (prophet_forecast, True),
+    "xgboost": (xgboost_forecast, False),
+}
+
+
+def available_forecasters() -> list:
+    """All forecasters, prophet only if it's installed."""
+    try:
+        import prophet  # noqa: F401
+    except ImportError:
+        return [name for name in FORECASTERS if name != "prophet"]
+    return list(FORECASTERS)
+
+
+def series_matrix(df: pd.DataFrame, measure: str = MEASURE) -> tuple:
+    """
+    All (occupation, region) series of the states and of Deutschland.
+
+    Returns:
+        tuple: (Y of shape (n_series, n_years), years, pd.DataFrame with Beruf_clean and Region per series)
+    """
+    cube = DazubiCube(df, measures=[measure])
+    regions = cube.levels["state"] + [TOTAL_REGION]
+    occupations = cube.levels["occupation"]
+    values = cube.query(None, regions, occupations, measure)
+    Y = values.transpose(2, 1, 0).reshape(-1, len(cube.years))
+    keys = pd.DataFrame({"Beruf_clean": np.repeat(occupations, len(regions)), "Region": np.tile(regions, len(occupations))})
+    return Y, cube.years.to_numpy(), keys
+
+
+def _run_task(name: str, Y: np.ndarray, years: np.ndarray, horizon: int, context: dict) -> np.ndarray:
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return FORECASTERS[name][0](Y, years, horizon, **context)
+
+
+def backtest(Y: np.ndarray, years: np.ndarray, forecasters=None, first_origin: int = None, horizon: int = 3, n_jobs: int = None, chunk_size: int = 200, region_codes: np.ndarray = None, cache_dir: str = CACHE_DIR) -> pd.DataFrame:
+    """
+    Rolling-origin evaluation of the forecasters.
+
+    Args:
+        Y (np.ndarray): Series in the rows, shape (n_series, n_years).
+        years (np.ndarray): Years of the columns.
+        forecasters (list, optional): Names of FORECASTERS, default `available_forecasters()`.
+        first_origin (int, optional): First origin year, default 5 years after the first year.
+        horizon (int): Maximum number of years forecast from each origin.
+        n_jobs (int, optional): Number of processes, default the number of cores.
+        chunk_size (int): Series per task for the forecasters fitted per series.
+        region_codes (np.ndarray, optional): Integer region of each series, a feature of xgboost.
+        cache_dir (str): Directory of the cached xgboost models.
+
+    Returns:
+        pd.DataFrame: One row per forecaster, origin, horizon and series with 'actual' and 'forecast'.
+            Series without any count up to the origin are left out.
+    """
+    forecasters = available_forecasters() if forecasters is None else list(forecasters)
+    first_origin = int(years[0]) + 5 if first_origin is None else first_origin
+    origins = [int(year) for year in years if first_origin <= year < years[-1]]
+    context = {"cache_dir": cache_dir}
+    if region_codes is not None:
+        context["region_codes"] = np.asarray(region_codes, dtype=float)
+
+    tasks = []
+    for origin in origins:
+        end = int(np.searchsorted(years, origin, side="right"))
+        steps = min(horizon, len(years) - end)
+        active = np.flatnonzero((Y[:, :end] > 0).any(axis=1))
+        for name in forecasters:
+            chunked = FORECASTERS[name][1]
+            for start in range(0, len(active), chunk_size if chunked else len(active)):
+                rows = active[start:start + chunk_size] if chunked else active
+                task_context = context if "region_codes" not in context else context | {"region_codes": context["region_codes"][rows]}
+                tasks.append(((name, origin, rows), (name, Y[rows, :end], years[:end], steps, task_context)))
+
+    n_jobs = min(n_jobs or os.cpu_count() or 1, len(tasks)) if tasks else 1
+    start = time.perf_counter()
+    if n_jobs <= 1:
+        results = [_run_task(*args) for _, args in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            # the slow per-series tasks first, so the pool isn't waiting for them at the end
+            order = sorted(range(len(tasks)), key=lambda i: not FORECASTERS[tasks[i][0][0]][1])
+            futures = {i: executor.submit(_run_task, *tasks[i][1]) for i in order}
+            results = [futures[i].result() for i in range(len(tasks))]
+    logger.info(f"Ran {len(tasks)} tasks of {len(forecasters)} forecasters and {len(origins)} origins in {time.perf_counter() - start:.1f}s")
+
+    frames = []
+    for ((name, origin, rows), _), forecast in zip(tasks, results):
+        end = int(np.searchsorted(years, origin, side="right"))
+        steps = forecast.shape[1]
+        frames.append(pd.DataFrame({
+            "forecaster": name,
+            "origin": origin,
+            "horizon": np.tile(np.arange(1, steps + 1), len(rows)),
+            "series": np.repeat(rows, steps),
+            "actual": Y[rows, end:end + steps].ravel(),
+            "forecast": forecast.ravel(),
+        }))
+    errors = pd.concat(frames, ignore_index=True)
+    errors["forecaster"] = errors["forecaster"].astype("category")
+    return errors
+
+
+def leaderboard(errors: pd.DataFrame, by=("forecaster",)) -> pd.DataFrame:
+    """
+    MAE, RMSE, sMAPE (in %, pairs of zeros count as 0) and MAE relative to the naive forecast.
+
+    Args:
+        errors (pd.DataFrame): Result of `backtest`.
+        by (tuple): Grouping, e.g. ('forecaster', 'horizon').
+    """
+    error = errors["forecast"] - errors["actual"]
+    denominator = errors["forecast"].abs() + errors["actual"].abs()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        smape = np.where(denominator > 0, 2 * error.abs() / denominator, 0.0)
+    scores = errors[list(by)].assign(absolute_error=error.abs(), squared_error=error**2, smape=smape)
+    table = scores.groupby(list(by), observed=True).agg(
+        n=("absolute_error", "size"), mae=("absolute_error", "mean"), rmse=("squared_error", "mean"), smape=("smape", "mean")
+    )
+    table["rmse"] = np.sqrt(table["rmse"])
+    table["smape"] *= 100
+    if "naive" in table.index.get_level_values("forecaster"):
+        naive = table.xs("naive", level="forecaster")["mae"] if len(by) > 1 else table.loc["naive", "mae"]
+        table["relative_mae"] = table["mae"] / (naive.reindex(table.index.droplevel("forecaster")).to_numpy() if len(by) > 1 else naive)
+    return table.sort_values("mae") if len(by) == 1 else table.sort_index()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, description="Rolling-origin backtest of the forecasters")
+    parser.add_argument("data", nargs="?", default="data/dazubi_grouped_berufe.csv")
+    parser.add_argument("-m", "--measure", default=MEASURE)
+    parser.add_argument("-f", "--forecasters", nargs="*", help=f"Default all available of {', '.join(FORECASTERS)}")
+    parser.add_argument("--first-origin", type=int)
+    parser.add_argument("--horizon", type=int, default=3)
+    parser.add_argument("-j", "--jobs", type=int, help="Number of processes")
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    parser.add_argument("-o", "--output", help="Write the errors to this Parquet file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    import logging
+
+    logging.basicConfig(format="%(asctime)s: %(message)s", level=logging.INFO)
+    args = parse_arguments()
+    Y, years, keys = series_matrix(pd.read_csv(args.data, index_col=0), args.measure)
+    region_codes = pd.Categorical(keys["Region"]).codes
+    errors = backtest(Y, years, args.forecasters, args.first_origin, args.horizon, args.jobs, region_codes=region_codes, cache_dir=args.cache_dir)
+    if args.output:
+        errors.join(keys, on="series").to_parquet(args.output, index=False)
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(leaderboard(errors).to_string(float_format="{:.3f}".format))
+        print(leaderboard(errors, ("forecaster", "horizon")).to_string(float_format="{:.3f}".format))
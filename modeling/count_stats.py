@@ -0,0 +1,300 @@
+"""
+Statistical tests computed from count tables instead of one row per person.
+
+The synthetic population only repeats the rows of `dazubi_grouped_berufe`, every test of
+`statistical_analysis.ipynb` depends on how many persons have a value, not on the persons
+themselves. The tests in this module take a count table, a DataFrame with the values (categories or
+numeric values) as index and one column per sample, e.g. 'new' and 'terminated':
+
+                    new  terminated
+    16             1200         310
+    17             5400         980
+    ...
+
+- `welch_ttest`: Welch t-test of the numeric index between two columns, identical to
+  `ttest_ind(a, b, equal_var=False)` on the exploded samples
+- `chi2_test`: chi² test of independence, identical to `chi2_contingency` on the crosstab
+- `anova`: one-way ANOVA of the numeric index between the columns, identical to `f_oneway`
+- `fisher_test`: Fisher's exact test of a 2x2 table
+
+`population_counts` counts the values of a column of the synthetic populations
+(synthetic_population_new and synthetic_population_terminated) with a GROUP BY in DuckDB, so the
+persons are never loaded into pandas:
+
+    con = modeling.query.connect("data")
+    chi2_test(population_counts(con, "state"))
+
+The counts may be non-integral (weighted), e.g. the terminations per age group, which are only known
+in total and are split proportionally to the age distribution of the row (as in
+`data_analysis_dazubi.ipynb`). `count_table` builds these tables from `dazubi_grouped_berufe`:
+
+    df = pd.read_csv("data/dazubi_grouped_berufe.csv", index_col=0)
+    counts = count_table(df, "age")
+    welch_ttest(counts)
+
+Compare with the tests on the exploded individuals (run from the repository root):
+
+    python -m modeling.count_stats data/dazubi_grouped_berufe.csv
+"""
+import time
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+DROPOUT_COLUMN = "Vorzeitige Vertragslösungen Insgesamt"
+
+# lower bound of each age group
+AGE_COLUMNS = {
+    "im Alter von: 16 und jünger": 16,
+    "im Alter von: 17.0": 17,
+    "im Alter von: 18.0": 18,
+    "im Alter von: 19.0": 19,
+    "im Alter von: 20.0": 20,
+    "im Alter von: 21.0": 21,
+    "im Alter von: 22.0": 22,
+    "im Alter von: 23.0": 23,
+    "im Alter von: 24 bis 39": 24,
+    "im Alter von: 40 und älter": 40,
+}
+
+# ordinal level of the school certificate, like the `edu_map` of the notebook; not assignable is left out
+EDUCATION_COLUMNS = {
+    "Höchster allgemeinbildender Schulabschluss ohne Hauptschulabschluss": 0,
+    "Höchster allgemeinbildender Schulabschluss mit Hauptschulabschluss": 1,
+    "Höchster allgemeinbildender Schulabschluss Realschulabschluss": 2,
+    "Höchster allgemeinbildender Schulabschluss Studienberechtigung": 3,
+}
+
+GENDER_COLUMNS = {
+    "männlich": ["Deutsche Männer", "Ausländer/-innen Männer"],
+    "weiblich": ["Deutsche Frauen", "Ausländer/-innen Frauen"],
+}
+
+NATIONALITY_COLUMNS = {
+    "Deutsche": ["Deutsche Männer", "Deutsche Frauen"],
+    "Ausländer/-innen": ["Ausländer/-innen Männer", "Ausländer/-innen Frauen"],
+}
+
+# attributes that are a column of the rows, the total of a row is the sum of the gender columns
+GROUP_COLUMNS = {"state": "Region", "occupation": "Beruf_clean", "year": "Jahr"}
+
+# sample name of the count tables -> DuckDB view of the synthetic population, see modeling.query.DATASETS
+POPULATION_VIEWS = {"new": "synthetic_population_new", "terminated": "synthetic_population_terminated"}
+
+AnovaResult = namedtuple("AnovaResult", ["statistic", "pvalue"])
+
+
+def _category_counts(df: pd.DataFrame, attribute: str) -> pd.DataFrame:
+    """Counts of the new contracts per row (index of df) and category of the attribute."""
+    if attribute == "age":
+        return df[list(AGE_COLUMNS)].set_axis(list(AGE_COLUMNS.values()), axis=1)
+    if attribute == "education":
+        return df[list(EDUCATION_COLUMNS)].set_axis(list(EDUCATION_COLUMNS.values()), axis=1)
+    if attribute in ("gender", "nationality"):
+        columns = GENDER_COLUMNS if attribute == "gender" else NATIONALITY_COLUMNS
+        return pd.DataFrame({category: df[cols].sum(axis=1) for category, cols in columns.items()})
+    raise KeyError(f"Unknown attribute {attribute}, known attributes: age, education, gender, nationality, {', '.join(GROUP_COLUMNS)}")
+
+
+def count_table(df: pd.DataFrame, attribute: str, by: str = None) -> pd.DataFrame:
+    """
+    Weighted counts of new and terminated contracts per value of an attribute from `dazubi_grouped_berufe`.
+
+    The terminations of a row are only known in total ('Vorzeitige Vertragslösungen Insgesamt'),
+    they are split proportionally to the counts of the row.
+
+    Args:
+        df (pd.DataFrame): `dazubi_grouped_berufe`, one row per year, region and occupation.
+        attribute (str): 'age' (lower bound of the age group), 'education' (level 0-3), 'gender',
+            'nationality' or one of the row columns 'state', 'occupation', 'year'.
+        by (str, optional): A row column ('state', 'occupation', 'year'). The result then has one
+            column per group with the counts of the new contracts, and one column per group with
+            the terminations, as a column MultiIndex ('new'/'terminated', group).
+
+    Returns:
+        pd.DataFrame: Index are the values of the attribute, columns 'new' and 'terminated'.
+    """
+    dropouts = df[DROPOUT_COLUMN].fillna(0).to_numpy(dtype=float)
+    if attribute in GROUP_COLUMNS:
+        new = df[sum(GENDER_COLUMNS.values(), [])].sum(axis=1)
+        counts = pd.DataFrame({"new": new.to_numpy(dtype=float), "terminated": dropouts}, index=df[GROUP_COLUMNS[attribute]].to_numpy())
+        return counts.groupby(level=0).sum().rename_axis(attribute)
+    new = _category_counts(df, attribute).fillna(0)
+    total = new.sum(axis=1).to_numpy()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        share = np.nan_to_num(new.to_numpy(dtype=float) / total[:, None])
+    terminated = pd.DataFrame(share * dropouts[:, None], index=new.index, columns=new.columns)
+    if by is None:
+        return pd.DataFrame({"new": new.sum(), "terminated": terminated.sum()}).rename_axis(attribute)
+    groups = df[GROUP_COLUMNS[by]].to_numpy()
+    return pd.concat(
+        {"new": new.groupby(groups).sum().T, "terminated": terminated.groupby(groups).sum().T}, axis=1
+    ).rename_axis(attribute)
+
+
+def two_sample_counts(a: pd.Series, b: pd.Series, names=("new", "terminated")) -> pd.DataFrame:
+    """Count table of the values of two samples of individuals, replaces the crosstab of the concatenated samples."""
+    return pd.DataFrame({names[0]: a.value_counts(), names[1]: b.value_counts()}).fillna(0).sort_index()
+
+
+def population_counts(con, column: str, by: str = None, views: dict = POPULATION_VIEWS) -> pd.DataFrame:
+    """
+    Count table of a column of the synthetic populations, counted in DuckDB without loading the persons.
+
+    Args:
+        con: DuckDB connection with the views, see `modeling.query.connect`.
+        column (str): Column of the persons, e.g. 'age', 'education', 'state'. Missing values are left out.
+        by (str, optional): Second column, e.g. 'state'. The result then has one column per sample
+            and group, as a column MultiIndex (sample, group) like `count_table`. Persons without a
+            group are left out.
+        views (dict): Sample name -> view of its population.
+
+    Returns:
+        pd.DataFrame: Index are the values of the column, one column per sample, e.g. 'new' and 'terminated'.
+    """
+    keys = f'"{column}"' + (f', "{by}"' if by else "")
+    # a NULL group would become a NaN column, which anova would treat as a group of its own
+    condition = f'"{column}" IS NOT NULL' + (f' AND "{by}" IS NOT NULL' if by else "")
+    samples = {}
+    for name, view in views.items():
+        counts = con.execute(f'SELECT {keys}, count(*) AS n FROM "{view}" WHERE {condition} GROUP BY ALL').df()
+        samples[name] = counts.set_index([column, by])["n"].unstack(fill_value=0) if by else counts.set_index(column)["n"]
+    table = pd.concat(samples, axis=1) if by else pd.DataFrame(samples)
+    return table.fillna(0).astype(np.int64).sort_index().rename_axis(column)
+
+
+def weighted_moments(values, counts) -> tuple:
+    """
+    Size, mean and sample variance (ddof=1) of values with frequency weights.
+
+    Returns:
+        tuple: (n, mean, variance)
+    """
+    values = np.asarray(values, dtype=float)
+    counts = np.asarray(counts, dtype=float)
+    n = counts.sum()
+    mean = (counts * values).sum() / n
+    variance = (counts * (values - mean) ** 2).sum() / (n - 1)
+    return n, mean, variance
+
+
+def welch_ttest(counts: pd.DataFrame, a: str = "new", b: str = "terminated"):
+    """
+    Welch t-test of the numeric index between the columns a and b.
+
+    Returns:
+        TtestResult: Like `scipy.stats.ttest_ind(..., equal_var=False)`.
+    """
+    counts = counts[counts.index.notna()]
+    values = counts.index.to_numpy(dtype=float)
+    n_a, mean_a, var_a = weighted_moments(values, counts[a])
+    n_b, mean_b, var_b = weighted_moments(values, counts[b])
+    return stats.ttest_ind_from_stats(mean_a, np.sqrt(var_a), n_a, mean_b, np.sqrt(var_b), n_b, equal_var=False)
+
+
+def chi2_test(counts: pd.DataFrame):
+    """
+    chi² test of independence of a count table, rows without any count are left out like in a crosstab.
+
+    Returns:
+        Chi2ContingencyResult: Like `scipy.stats.chi2_contingency`.
+    """
+    table = counts.to_numpy(dtype=float)
+    return stats.chi2_contingency(table[table.sum(axis=1) > 0])
+
+
+def fisher_test(counts: pd.DataFrame):
+    """Fisher's exact test of a 2x2 count table, the counts are rounded to integers."""
+    table = np.rint(counts.to_numpy(dtype=float)).astype(np.int64)
+    if table.shape != (2, 2):
+        raise ValueError(f"Fisher's exact test needs a 2x2 table, got {table.shape}")
+    return stats.fisher_exact(table)
+
+
+def anova(counts: pd.DataFrame):
+    """
+    One-way ANOVA of the numeric index between the columns (groups) of the count table.
+
+    Groups without counts are left out, like the notebook leaves out empty groups, and so is a
+    missing (NaN) group.
+
+    Returns:
+        AnovaResult: F statistic and p-value like `scipy.stats.f_oneway` with one sample per column.
+    """
+    counts = counts.loc[counts.index.notna(), counts.columns.notna()]
+    values = counts.index.to_numpy(dtype=float)
+    weights = counts.to_numpy(dtype=float)
+    weights = weights[:, weights.sum(axis=0) > 0]
+    n = weights.sum(axis=0)
+    means = (weights * values[:, None]).sum(axis=0) / n
+    grand_mean = (weights * values[:, None]).sum() / n.sum()
+    ss_between = (n * (means - grand_mean) ** 2).sum()
+    ss_within = (weights * (values[:, None] - means) ** 2).sum()
+    df_between = len(n) - 1
+    df_within = n.sum() - len(n)
+    f = (ss_between / df_between) / (ss_within / df_within)
+    return AnovaResult(f, stats.f.sf(f, df_between, df_within))
+
+
+def explode(counts: pd.Series) -> np.ndarray:
+    """The individual values of a count column, the counts are rounded to integers. Only for comparisons."""
+    return np.repeat(counts.index.to_numpy(), np.rint(counts.to_numpy(dtype=float)).astype(np.int64))
+
+
+def compare_with_individuals(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Runs the tests from the counts and on the exploded individuals and compares statistics and run times.
+
+    The counts are rounded first, so both variants see the same data.
+
+    Returns:
+        pd.DataFrame: One row per test with both statistics, both p-values and both run times.
+    """
+    rows = []
+
+    def run(name, from_counts, from_individuals):
+        start = time.perf_counter()
+        result_counts = from_counts()
+        seconds_counts = time.perf_counter() - start
+        start = time.perf_counter()
+        result_individuals = from_individuals()
+        seconds_individuals = time.perf_counter() - start
+        rows.append({
+            "test": name,
+            "statistic_counts": result_counts[0], "statistic_individuals": result_individuals[0],
+            "pvalue_counts": result_counts[1], "pvalue_individuals": result_individuals[1],
+            "seconds_counts": seconds_counts, "seconds_individuals": seconds_individuals,
+        })
+
+    for attribute in ("age", "education"):
+        counts = count_table(df, attribute).round()
+        run(
+            f"welch_ttest {attribute}",
+            lambda: welch_ttest(counts),
+            lambda: stats.ttest_ind(explode(counts["new"]), explode(counts["terminated"]), equal_var=False),
+        )
+    for attribute in ("state", "gender", "nationality", "education"):
+        counts = count_table(df, attribute).round()
+
+        def crosstab():
+            samples = pd.DataFrame({
+                "value": np.concatenate([explode(counts["new"]), explode(counts["terminated"])]),
+                "contract": np.repeat(["new", "terminated"], [int(counts["new"].sum()), int(counts["terminated"].sum())]),
+            })
+            return stats.chi2_contingency(pd.crosstab(samples["value"], samples["contract"]))
+
+        run(f"chi2 {attribute}", lambda: chi2_test(counts), crosstab)
+    counts = count_table(df, "age", by="state")["new"].round()
+    run("anova age by state", lambda: anova(counts), lambda: stats.f_oneway(*[explode(counts[col]) for col in counts.columns if counts[col].sum() > 0]))
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    import sys
+
+    path = sys.argv[1] if len(sys.argv) > 1 else "data/dazubi_grouped_berufe.csv"
+    df = pd.read_csv(path, index_col=0)
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(compare_with_individuals(df).to_string(index=False))
@@ -0,0 +1,311 @@
+"""
+Pre-aggregated cube of the DAZUBI counts over year x region x occupation with all roll-ups.
+
+The dashboards sum the rows of `dazubi_grouped_berufe` on every interaction (e.g. the
+`groupby("Jahr").sum()` for all regions in `Dashboard/streamlit_4.py`), and `dazubi_split.ipynb`
+keeps the totals reported by BIBB for Deutschland, Westdeutschland, ... that can differ from the sum
+of the states. `DazubiCube` sums the state rows once into a dense array
+
+    values[year, region, occupation, measure]
+
+whose region axis holds the 16 states, the groups of states (`REGION_GROUPS`, e.g. Westdeutschland
+and Ostdeutschland) and Deutschland, and whose occupation axis holds the occupations, their
+families (optional mapping) and the total over all occupations. A query is a dictionary lookup of
+the labels and one NumPy index, a few microseconds for any slice. `check_totals` compares reported
+totals with the computed ones.
+
+Build the cube and compare it with the reported rows (run from the repository root):
+
+    python -m modeling.cube data/dazubi_grouped_berufe.csv --reported data/dazubi_deutschland.parquet data/dazubi_westdeutschland.parquet data/dazubi_ostdeutschland.parquet
+"""
+import argparse
+import json
+import time
+from logging import getLogger
+
+import numpy as np
+import pandas as pd
+
+logger = getLogger(__name__)
+
+TOTAL_REGION = "Deutschland"
+TOTAL_OCCUPATION = "Alle Berufe"
+OTHER_FAMILY = "Sonstige"
+
+WEST_STATES = [
+    "Baden-Württemberg", "Bayern", "Bremen", "Hamburg", "Hessen", "Niedersachsen",
+    "Nordrhein-Westfalen", "Rheinland-Pfalz", "Saarland", "Schleswig-Holstein",
+]
+EAST_STATES = ["Brandenburg", "Mecklenburg-Vorpommern", "Sachsen", "Sachsen-Anhalt", "Thüringen"]
+
+# groups of states like the regions of the BIBB tables, Berlin belongs to Ostdeutschland
+REGION_GROUPS = {
+    "Westdeutschland": WEST_STATES,
+    "Ostdeutschland": EAST_STATES + ["Berlin"],
+    "Alte Länder (ab 1991 mit Berlin-Ost)": WEST_STATES + ["Berlin"],
+    "Neue Länder (ohne Berlin)": EAST_STATES,
+}
+
+KEY_COLUMNS = ["Jahr", "Region", "Beruf_clean"]
+
+
+def clean_rows(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Rows of `dazubi_berufe` (or the reported region rows of `dazubi_split.ipynb`) summed per year, region and cleaned occupation.
+
+    The occupation is cleaned like in `dazubi_cleaning.ipynb`, the bracketed suffix is removed.
+    """
+    if "Beruf_clean" not in df.columns:
+        df = df.assign(Beruf_clean=df["Beruf"].str.replace(r"\s*\(.*\)", "", regex=True).str.strip())
+    # the compact tables have categorical keys, only the combinations that occur are summed
+    return df.groupby(KEY_COLUMNS, as_index=False, observed=True).sum(numeric_only=True)
+
+
+def _membership(members: pd.Index, groups: dict) -> np.ndarray:
+    """0/1 matrix of shape (len(groups), len(members)), unknown members of a group are ignored."""
+    matrix = np.zeros((len(groups), len(members)))
+    for row, names in enumerate(groups.values()):
+        positions = members.get_indexer(list(names))
+        matrix[row, positions[positions >= 0]] = 1
+    return matrix
+
+
+class DazubiCube:
+    """
+    Dense cube of summed measures with roll-ups of regions and occupations.
+
+    Args:
+        df (pd.DataFrame): Rows of the states with the columns 'Jahr', 'Region', 'Beruf_clean' and
+            numeric measures, e.g. `dazubi_grouped_berufe`. Rows of reported totals (Deutschland,
+            Westdeutschland, ...) are left out. Missing values count as 0.
+        measures (list, optional): Measures to aggregate, default all numeric columns.
+        region_groups (dict): Name of a group -> states, the groups may overlap.
+        occupation_families (dict, optional): Occupation -> family. Occupations without a family
+            are in the family 'Sonstige'. Without a mapping there are no families.
+
+    Attributes:
+        years, regions, occupations, measures (pd.Index): Labels of the axes. The regions are the
+            states, the groups and Deutschland, the occupations are the occupations, the families
+            and 'Alle Berufe'.
+        levels (dict): Labels per level: 'state', 'region_group', 'occupation', 'family'.
+        values (np.ndarray): float64 array of shape (years, regions, occupations, measures).
+    """
+
+    def __init__(self, df: pd.DataFrame, measures=None, region_groups: dict = REGION_GROUPS, occupation_families: dict = None):
+        excluded = set(region_groups) | {TOTAL_REGION}
+        df = df[~df["Region"].isin(excluded)]
+        if measures is None:
+            measures = [col for col in df.select_dtypes("number").columns if col not in KEY_COLUMNS and not col.startswith("Unnamed")]
+        years = pd.Index(np.sort(df["Jahr"].unique()))
+        states = pd.Index(np.sort(df["Region"].unique()))
+        occupations = pd.Index(np.sort(df["Beruf_clean"].unique()))
+
+        # base cube of the states and occupations
+        base = np.zeros((len(years), len(states), len(occupations), len(measures)))
+        np.add.at(
+            base,
+            (years.get_indexer(df["Jahr"]), states.get_indexer(df["Region"]), occupations.get_indexer(df["Beruf_clean"])),
+            df[measures].fillna(0).to_numpy(dtype=float),
+        )
+
+        # regions: states, groups, Deutschland
+        region_groups = {name: list(names) for name, names in region_groups.items()}
+        region_matrix = np.vstack([np.eye(len(states)), _membership(states, region_groups), np.ones((1, len(states)))])
+        # occupations: occupations, families, all occupations
+        families = {}
+        if occupation_families is not None:
+            for occupation in occupations:
+                families.setdefault(occupation_families.get(occupation, OTHER_FAMILY), []).append(occupation)
+        occupation_matrix = np.vstack([np.eye(len(occupations)), _membership(occupations, families), np.ones((1, len(occupations)))])
+
+        self.values = np.einsum("rs,ysom,po->yrpm", region_matrix, base, occupation_matrix, optimize=True)
+        self.years = years
+        self.regions = pd.Index(list(states) + list(region_groups) + [TOTAL_REGION])
+        self.occupations = pd.Index(list(occupations) + list(families) + [TOTAL_OCCUPATION])
+        self.measures = pd.Index(measures)
+        self.levels = {"state": list(states), "region_group": list(region_groups), "occupation": list(occupations), "family": list(families)}
+        self.region_groups = region_groups
+        self.occupation_families = families
+        self._index_positions()
+
+    def _index_positions(self):
+        self._positions = [{label: i for i, label in enumerate(axis)} for axis in (self.years, self.regions, self.occupations, self.measures)]
+
+    def _index(self, axis: int, labels):
+        """Position of a label, or array of positions of a list of labels, None selects the whole axis."""
+        positions = self._positions[axis]
+        if labels is None:
+            return slice(None)
+        if isinstance(labels, (list, tuple, np.ndarray, pd.Index)):
+            return np.array([positions[label] for label in labels])
+        return positions[labels]
+
+    def query(self, year=None, region=TOTAL_REGION, occupation=TOTAL_OCCUPATION, measure=None):
+        """
+        Slice of the cube.
+
+        Every argument is a label (the axis is dropped), a list of labels (the axis is kept in the
+        order of the list) or None (the whole axis). By default the totals over all regions and
+        occupations are returned for all years and measures.
+
+        Examples:
+            cube.query(2020, "Bayern", "Koch/Köchin", "Vorzeitige Vertragslösungen Insgesamt") -> float
+            cube.query(region="Ostdeutschland", measure=measure) -> array over the years
+
+        Raises:
+            KeyError: For an unknown label.
+        """
+        index = [self._index(axis, labels) for axis, labels in enumerate((year, region, occupation, measure))]
+        if sum(isinstance(i, np.ndarray) for i in index) > 1:
+            # several lists would be indexed pointwise, build the cross product of the kept axes instead
+            sizes = self.values.shape
+            kept = [axis for axis, i in enumerate(index) if not isinstance(i, (int, np.integer))]
+            grids = iter(np.ix_(*[np.arange(sizes[axis])[index[axis]] for axis in kept]))
+            index = [next(grids) if axis in kept else i for axis, i in enumerate(index)]
+        return self.values[tuple(index)]
+
+    def series(self, region=TOTAL_REGION, occupation=TOTAL_OCCUPATION, measure=None, years=None) -> pd.Series:
+        """One measure per year, e.g. the input of the forecasts of the dashboards."""
+        measure = self.measures[0] if measure is None else measure
+        years = self.years if years is None else self.years[(self.years >= years[0]) & (self.years <= years[1])]
+        return pd.Series(self.query(list(years), region, occupation, measure), index=years.rename("Jahr"), name=measure)
+
+    def to_frame(self, regions=None, occupations=None) -> pd.DataFrame:
+        """Long table with one row per year, region and occupation, default all roll-ups."""
+        regions = list(self.regions) if regions is None else list(regions)
+        occupations = list(self.occupations) if occupations is None else list(occupations)
+        values = self.values[:, self._index(1, regions)][:, :, self._index(2, occupations)]
+        index = pd.MultiIndex.from_product([self.years, regions, occupations], names=KEY_COLUMNS)
+        return pd.DataFrame(values.reshape(-1, len(self.measures)), index=index, columns=self.measures).reset_index()
+
+    def check_totals(self, reported: pd.DataFrame, rtol: float = 0.0, atol: float = 0.5) -> pd.DataFrame:
+        """
+        Compares reported totals with the sums of the cube.
+
+        Args:
+            reported (pd.DataFrame): Rows with 'Jahr', 'Region' (a region of the cube, e.g.
+                Deutschland or Westdeutschland), optionally 'Beruf_clean' (default 'Alle Berufe')
+                and measures, e.g. `clean_rows(pd.read_parquet("data/dazubi_deutschland.parquet"))`.
+                Rows with unknown labels are left out.
+            rtol, atol: Tolerances of `np.isclose`, the default allows rounding to integers.
+
+        Returns:
+            pd.DataFrame: One row per compared cell and measure that differ, with the reported and
+                computed value and the difference. Empty if everything is consistent.
+        """
+        if "Beruf_clean" not in reported.columns:
+            reported = reported.assign(Beruf_clean=TOTAL_OCCUPATION)
+        measures = [m for m in self.measures if m in reported.columns]
+        known = reported["Jahr"].isin(self.years) & reported["Region"].isin(self.regions) & reported["Beruf_clean"].isin(self.occupations)
+        if (~known).any():
+            logger.info(f"{(~known).sum()} reported rows with labels that are not in the cube are left out")
+        reported = reported[known]
+        positions = (
+            self.years.get_indexer(reported["Jahr"]),
+            self.regions.get_indexer(reported["Region"]),
+            self.occupations.get_indexer(reported["Beruf_clean"]),
+        )
+        computed = self.values[positions][:, self.measures.get_indexer(measures)]
+        values = reported[measures].to_numpy(dtype=float)
+        differs = ~np.isclose(values, computed, rtol=rtol, atol=atol) & ~np.isnan(values)
+        rows, columns = np.nonzero(differs)
+        return pd.DataFrame({
+            "Jahr": reported["Jahr"].to_numpy()[rows],
+            "Region": reported["Region"].to_numpy()[rows],
+            "Beruf_clean": reported["Beruf_clean"].to_numpy()[rows],
+            "measure": np.array(measures, dtype=object)[columns],
+            "reported": values[rows, columns],
+            "computed": computed[rows, columns],
+            "difference": values[rows, columns] - computed[rows, columns],
+        })
+
+    def save(self, path: str):
+        """Saves the values as .npz, the labels and groups as JSON inside of it."""
+        labels = {
+            "years": self.years.tolist(), "regions": self.regions.tolist(), "occupations": self.occupations.tolist(),
+            "measures": self.measures.tolist(), "levels": self.levels,
+            "region_groups": self.region_groups, "occupation_families": self.occupation_families,
+        }
+        np.savez_compressed(path, values=self.values, labels=np.array(json.dumps(labels)))
+
+    @classmethod
+    def load(cls, path: str) -> "DazubiCube":
+        with np.load(path) as data:
+            values = data["values"]
+            labels = json.loads(str(data["labels"]))
+        cube = cls.__new__(cls)
+        cube.values = values
+        cube.years = pd.Index(labels["years"])
+        cube.regions = pd.Index(labels["regions"])
+        cube.occupations = pd.Index(labels["occupations"])
+        cube.measures = pd.Index(labels["measures"])
+        cube.levels = labels["levels"]
+        cube.region_groups = labels["region_groups"]
+        cube.occupation_families = labels["occupation_families"]
+        cube._index_positions()
+        return cube
+
+
+def benchmark_queries(cube: DazubiCube, df: pd.DataFrame, n_queries: int = 1000, seed: int = 42) -> dict:
+    """
+    Mean time of a query of one measure per year for a region and an occupation, from the cube
+    and with the filter and groupby of the dashboards on the rows.
+
+    Returns:
+        dict: Mean seconds per query of both variants.
+    """
+    rng = np.random.default_rng(seed)
+    measure = cube.measures[0]
+    regions = rng.choice(cube.regions, n_queries)
+    occupations = rng.choice(cube.levels["occupation"], n_queries)
+
+    start = time.perf_counter()
+    for region, occupation in zip(regions, occupations):
+        cube.query(None, region, occupation, measure)
+    cube_seconds = (time.perf_counter() - start) / n_queries
+
+    n_pandas = min(n_queries, 100)
+    start = time.perf_counter()
+    for region, occupation in zip(regions[:n_pandas], occupations[:n_pandas]):
+        rows = df[df["Beruf_clean"] == occupation]
+        if region in cube.region_groups:
+            rows = rows[rows["Region"].isin(cube.region_groups[region])]
+        elif region != TOTAL_REGION:
+            rows = rows[rows["Region"] == region]
+        rows.groupby("Jahr")[measure].sum()
+    pandas_seconds = (time.perf_counter() - start) / n_pandas
+    return {"cube_seconds": cube_seconds, "pandas_seconds": pandas_seconds}
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, description="Build the DAZUBI cube and check reported totals")
+    parser.add_argument("data", nargs="?", default="data/dazubi_grouped_berufe.csv", help="Rows of the states per year and occupation")
+    parser.add_argument("-o", "--output", default="data/dazubi_cube.npz")
+    parser.add_argument("--reported", nargs="*", default=[], help="Parquet files of reported totals, e.g. data/dazubi_deutschland.parquet")
+    parser.add_argument("--families", help="CSV file with the columns Beruf_clean and family")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    import logging
+
+    logging.basicConfig(format="%(asctime)s: %(message)s", level=logging.INFO)
+    args = parse_arguments()
+    df = pd.read_csv(args.data, index_col=0)
+    families = None
+    if args.families:
+        families = pd.read_csv(args.families).set_index("Beruf_clean")["family"].to_dict()
+
+    start = time.perf_counter()
+    cube = DazubiCube(df, occupation_families=families)
+    logger.info(f"Built the cube {cube.values.shape} ({cube.values.nbytes:,} bytes) in {time.perf_counter() - start:.2f}s")
+    cube.save(args.output)
+
+    for path in args.reported:
+        differences = cube.check_totals(clean_rows(pd.read_parquet(path)))
+        logger.info(f"{path}: {len(differences)} cells differ from the sums of the states")
+        if len(differences):
+            print(differences.sort_values("difference", key=np.abs, ascending=False).head(20).to_string(index=False))
+
+    result = benchmark_queries(cube, df)
+    logger.info(f"Query per year: cube {result['cube_seconds'] * 1e6:.1f} µs, pandas {result['pandas_seconds'] * 1e3:.2f} ms")
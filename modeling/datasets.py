@@ -0,0 +1,181 @@
+"""
+Registry and local cache for the datasets used in the training.
+
+Each dataset is downloaded once, stored as Parquet file in `data/cache` and its SHA-256 checksum is
+written to `data/cache/manifest.json`. Later loads read the local file and verify the checksum, so a
+training run doesn't need the network. In offline mode (argument `offline=True` or the environment
+variable FINAPP_OFFLINE=1) nothing is downloaded and a missing dataset is an error.
+
+For air-gapped machines, fetch the datasets on a machine with network access and copy `data/cache`:
+
+    python -m modeling.datasets fetch
+    python -m modeling.datasets verify
+"""
+import argparse
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
+from io import BytesIO
+from logging import getLogger
+
+import pandas as pd
+
+logger = getLogger(__name__)
+
+CACHE_DIR = "data/cache"
+
+DATASETS = {
+    "robusta_features": "https://github.com/jldbc/coffee-quality-database/raw/master/data/robusta_data_cleaned.csv",
+    "robusta_ratings": "https://raw.githubusercontent.com/jldbc/coffee-quality-database/master/data/robusta_ratings_raw.csv",
+}
+
+
+class DatasetNotCachedError(RuntimeError):
+    pass
+
+
+def is_offline() -> bool:
+    return os.environ.get("FINAPP_OFFLINE", "0").lower() in ("1", "true", "yes")
+
+
+def sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(2**20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _manifest_path(cache_dir: str) -> str:
+    return os.path.join(cache_dir, "manifest.json")
+
+
+def read_manifest(cache_dir: str = CACHE_DIR) -> dict:
+    path = _manifest_path(cache_dir)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+
+def _write_atomic(path: str, write):
+    """Writes to a temporary file first and moves it to `path`, so readers never see a partial file."""
+    tmp_path = path + ".tmp"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except (KeyboardInterrupt, OSError, RuntimeError):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _write_manifest(manifest: dict, cache_dir: str):
+    def write(path):
+        with open(path, "w") as file:
+            json.dump(manifest, file, indent=2, sort_keys=True)
+
+    _write_atomic(_manifest_path(cache_dir), write)
+
+
+def fetch(name: str, cache_dir: str = CACHE_DIR) -> str:
+    """
+    Downloads a dataset of the registry into the cache.
+
+    Returns:
+        str: Path of the cached Parquet file.
+    """
+    import requests
+
+    url = DATASETS[name]
+    logger.info(f"Downloading {name} from {url}")
+    response = requests.get(url, timeout=60)
+    response.raise_for_status()
+    df = pd.read_csv(BytesIO(response.content))
+
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f"{name}.parquet")
+    _write_atomic(path, lambda tmp_path: df.to_parquet(tmp_path, index=False))
+    manifest = read_manifest(cache_dir)
+    manifest[name] = {
+        "url": url,
+        "source_sha256": hashlib.sha256(response.content).hexdigest(),
+        "sha256": sha256(path),
+        "fetched_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+    }
+    _write_manifest(manifest, cache_dir)
+    return path
+
+
+def verify(name: str, cache_dir: str = CACHE_DIR) -> bool:
+    """True if the dataset is cached and the file matches the checksum of the manifest."""
+    path = os.path.join(cache_dir, f"{name}.parquet")
+    entry = read_manifest(cache_dir).get(name)
+    return entry is not None and os.path.exists(path) and sha256(path) == entry["sha256"]
+
+
+def load_dataset(name: str, offline: bool = None, refresh: bool = False, cache_dir: str = CACHE_DIR) -> pd.DataFrame:
+    """
+    Loads a dataset of the registry from the local cache and downloads it if necessary.
+
+    Args:
+        name (str): Key of `DATASETS`.
+        offline (bool, optional): Never download. Defaults to the environment variable FINAPP_OFFLINE.
+        refresh (bool): Download again even if the dataset is cached.
+
+    Raises:
+        DatasetNotCachedError: In offline mode, if the dataset is not cached or the checksum doesn't match.
+
+    Returns:
+        pd.DataFrame: The dataset.
+    """
+    if name not in DATASETS:
+        raise KeyError(f"Unknown dataset {name}, known datasets: {', '.join(DATASETS)}")
+    if offline is None:
+        offline = is_offline()
+    path = os.path.join(cache_dir, f"{name}.parquet")
+    if refresh or not verify(name, cache_dir):
+        if offline:
+            raise DatasetNotCachedError(
+                f"Dataset {name} is not cached in {cache_dir} or its checksum doesn't match. "
+                "Run 'python -m modeling.datasets fetch' with network access first."
+            )
+        path = fetch(name, cache_dir)
+    return pd.read_parquet(path)
+
+
+def save_split(split: dict, data_dir: str = "data"):
+    """Saves DataFrames or Series of a train/test split as Parquet files, e.g. {'X_test': X_test}."""
+    for name, data in split.items():
+        df = data.to_frame() if isinstance(data, pd.Series) else data
+        path = os.path.join(data_dir, f"{name}.parquet")
+        _write_atomic(path, lambda tmp_path: df.to_parquet(tmp_path, index=False))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Fetch the training datasets into the local cache or verify the cache",
+    )
+    parser.add_argument("command", choices=["fetch", "verify"])
+    parser.add_argument("names", nargs="*", default=list(DATASETS), help="Datasets, default is all")
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    import logging
+    import sys
+
+    logging.basicConfig(format="%(asctime)s: %(message)s", level=logging.INFO)
+
+    args = parse_arguments()
+    ok = True
+    for name in args.names:
+        if args.command == "fetch":
+            fetch(name, args.cache_dir)
+        valid = verify(name, args.cache_dir)
+        logger.info(f"{name}: {'ok' if valid else 'missing or checksum mismatch'}")
+        ok &= valid
+    sys.exit(0 if ok else 1)
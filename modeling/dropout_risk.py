@@ -0,0 +1,163 @@
+"""
+Dropout-risk model of the dashboard, trained once and saved as a bundle.
+
+`Dashboard/dashboard_FinApprenticeship.py` trains an XGBoost regressor of the dropout rate per
+region, occupation, year and school certificate in every session, with row-wise `apply` for the
+certificate category and the rate and a `LabelEncoder` per column. This module does the same
+preparation vectorized, encodes the categories with `CategoricalEncoderRegistry` and saves model
+and encoder into one directory:
+
+    models/dropout_risk/
+        model.json      XGBoost model
+        encoder.json    categories of Region, Beruf_clean and abschluss_cat
+        meta.json       feature columns
+
+`DropoutRiskModel.load` reads the bundle once, `predict_frame` scores many requests with one
+vectorized call. The service in `modeling/serve.py` is built on it.
+
+Usage (run from the repository root):
+
+    python -m modeling.dropout_risk data/dazubi_grouped_berufe.csv --output models/dropout_risk
+"""
+import argparse
+import json
+import os
+from logging import getLogger
+
+import numpy as np
+import pandas as pd
+
+from modeling.encoding import CategoricalEncoderRegistry
+
+logger = getLogger(__name__)
+
+DROPOUT_COLUMN = "Vorzeitige Vertragslösungen Insgesamt"
+
+# labels of the dashboard, the first certificate column with a count is the category of a row
+ABSCHLUSS_MAP = {
+    "No Certificate": "Höchster allgemeinbildender Schulabschluss ohne Hauptschulabschluss",
+    "Hauptschule": "Höchster allgemeinbildender Schulabschluss mit Hauptschulabschluss",
+    "Realschule": "Höchster allgemeinbildender Schulabschluss Realschulabschluss",
+    "University Entrance (Abitur)": "Höchster allgemeinbildender Schulabschluss Studienberechtigung",
+    "Unknown": "Höchster allgemeinbildender Schulabschluss nicht zuzuordnen",
+}
+
+FEATURES = ["Region", "Beruf_clean", "Jahr", "abschluss_cat"]
+CATEGORICAL_FEATURES = ["Region", "Beruf_clean", "abschluss_cat"]
+
+# field names of the requests to the service
+REQUEST_FIELDS = {"region": "Region", "occupation": "Beruf_clean", "year": "Jahr", "certificate": "abschluss_cat"}
+
+
+def certificate_category(df: pd.DataFrame) -> pd.Series:
+    """Vectorized `bestimme_abschluss` of the dashboard: label of the first certificate column with a count > 0."""
+    labels = np.array(list(ABSCHLUSS_MAP), dtype=object)
+    positive = df[list(ABSCHLUSS_MAP.values())].fillna(0).to_numpy() > 0
+    first = positive.argmax(axis=1)
+    return pd.Series(np.where(positive.any(axis=1), labels[first], "Unknown"), index=df.index)
+
+
+def training_table(df: pd.DataFrame, min_year: int = 2010) -> pd.DataFrame:
+    """
+    Features and dropout rate of the dashboard from `dazubi_grouped_berufe`.
+
+    The rate is the number of terminations divided by the count of the certificate category,
+    rows without that count are dropped.
+
+    Returns:
+        pd.DataFrame: The FEATURES and 'dropout_rate'.
+    """
+    df = df[df["Jahr"] >= min_year]
+    category = certificate_category(df)
+    counts = df[list(ABSCHLUSS_MAP.values())].to_numpy(dtype=float)
+    positions = pd.Index(list(ABSCHLUSS_MAP)).get_indexer(category)
+    denominator = np.take_along_axis(counts, positions[:, None], axis=1)[:, 0]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rate = np.where(denominator > 0, df[DROPOUT_COLUMN].to_numpy(dtype=float) / denominator, np.nan)
+    table = df[["Region", "Beruf_clean", "Jahr"]].assign(abschluss_cat=category.to_numpy(), dropout_rate=rate)
+    return table.dropna(subset=["dropout_rate"]).reset_index(drop=True)
+
+
+class DropoutRiskModel:
+    """
+    Encoder and model of the dropout risk.
+
+    Args:
+        model: Fitted estimator on the encoded FEATURES, a classifier with `predict_proba` or a
+            regressor of the rate.
+        encoder (CategoricalEncoderRegistry): Fitted encoder of the CATEGORICAL_FEATURES.
+    """
+
+    def __init__(self, model, encoder: CategoricalEncoderRegistry):
+        self.model = model
+        self.encoder = encoder
+
+    @classmethod
+    def train(cls, table: pd.DataFrame, **params) -> "DropoutRiskModel":
+        """Fits the encoder and an XGBoost regressor (parameters of the dashboard by default) on a `training_table`."""
+        import xgboost as xgb
+
+        params = {"n_estimators": 100, "max_depth": 4} | params
+        encoder = CategoricalEncoderRegistry(columns=CATEGORICAL_FEATURES).fit(table)
+        model = xgb.XGBRegressor(**params)
+        model.fit(encoder.transform(table[FEATURES]), table["dropout_rate"])
+        return cls(model, encoder)
+
+    def predict_frame(self, X: pd.DataFrame) -> np.ndarray:
+        """
+        Dropout risk in [0, 1] for every row of X with the FEATURES.
+
+        Unknown categories are encoded as -1 and still get a prediction.
+        """
+        X = self.encoder.transform(X[FEATURES])
+        if hasattr(self.model, "predict_proba"):
+            return self.model.predict_proba(X)[:, 1]
+        return np.clip(self.model.predict(X), 0, 1)
+
+    def predict_records(self, records: list) -> np.ndarray:
+        """Dropout risk for requests like {"region": ..., "occupation": ..., "year": ..., "certificate": ...}."""
+        missing = {field for record in records for field in REQUEST_FIELDS if field not in record}
+        if missing:
+            raise KeyError(f"Fields missing in the request: {sorted(missing)}")
+        X = pd.DataFrame({column: [record[field] for record in records] for field, column in REQUEST_FIELDS.items()})
+        # a cast to int16 would wrap large years and truncate fractions silently
+        years = pd.to_numeric(X["Jahr"]).to_numpy(dtype=np.float64)
+        bounds = np.iinfo(np.int16)
+        invalid = ~np.isfinite(years) | (years != np.round(years)) | (years < bounds.min) | (years > bounds.max)
+        if invalid.any():
+            raise ValueError(f"Years must be integers between {bounds.min} and {bounds.max}, got {X['Jahr'][invalid].tolist()}")
+        X["Jahr"] = years.astype(np.int16)
+        return self.predict_frame(X)
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        self.model.save_model(os.path.join(path, "model.json"))
+        self.encoder.save(os.path.join(path, "encoder.json"))
+        with open(os.path.join(path, "meta.json"), "w") as file:
+            json.dump({"features": FEATURES, "estimator": type(self.model).__name__}, file, indent=2)
+
+    @classmethod
+    def load(cls, path: str) -> "DropoutRiskModel":
+        import xgboost as xgb
+
+        with open(os.path.join(path, "meta.json")) as file:
+            meta = json.load(file)
+        model = getattr(xgb, meta["estimator"])()
+        model.load_model(os.path.join(path, "model.json"))
+        return cls(model, CategoricalEncoderRegistry.load(os.path.join(path, "encoder.json")))
+
+
+if __name__ == "__main__":
+    import logging
+
+    logging.basicConfig(format="%(asctime)s: %(message)s", level=logging.INFO)
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, description="Train and save the dropout-risk model")
+    parser.add_argument("data", nargs="?", default="data/dazubi_grouped_berufe.csv")
+    parser.add_argument("-o", "--output", default="models/dropout_risk", help="Directory of the bundle")
+    parser.add_argument("--min-year", type=int, default=2010)
+    args = parser.parse_args()
+
+    table = training_table(pd.read_csv(args.data), args.min_year)
+    logger.info(f"Training on {len(table)} rows")
+    DropoutRiskModel.train(table).save(args.output)
+    logger.info(f"Saved the model to {args.output}")
@@ -0,0 +1,172 @@
+"""
+Ordinal encoding of categorical columns that is fitted once and reused.
+
+`encode_categorical_columns` in `modeling/utils.py` fits a new `OrdinalEncoder` on every frame it
+gets. Called separately on the train and the test data, the same category can get different codes,
+and every call copies the whole frame and returns float64 codes. `CategoricalEncoderRegistry`
+learns the categories of each column once from the training data. `transform` replaces only the
+encoded columns with codes in the smallest signed integer dtype (int8 for up to 127 categories),
+unknown categories and missing values get the code -1. With `inplace=True` the passed frame is
+modified, otherwise only a shallow copy is made, the other columns are shared.
+
+The registry is an sklearn transformer, so it can be the first step of a Pipeline and is saved
+with the model. It can also be saved on its own as JSON with `save` and read with `load`.
+
+Benchmark the encoding of the synthetic population (run from the repository root):
+
+    python -m modeling.encoding data/synth_combined.csv
+"""
+import json
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.preprocessing import OrdinalEncoder
+from sklearn.utils.validation import check_is_fitted
+
+UNKNOWN_CODE = -1
+
+
+def code_dtype(n_categories: int) -> np.dtype:
+    """Smallest signed integer dtype for the codes 0..n_categories-1 and the unknown code -1."""
+    # a signed type that holds -n_categories also holds n_categories - 1
+    return np.min_scalar_type(-max(n_categories, 1))
+
+
+class CategoricalEncoderRegistry(TransformerMixin, BaseEstimator):
+    """
+    Per column ordinal encoding with compact integer codes.
+
+    Args:
+        columns (list, optional): Columns to encode. Defaults to all columns with object,
+            string, category or boolean dtype at the time of `fit`.
+
+    Attributes:
+        categories_ (dict): Sorted categories per column, the code of a category is its position.
+        dtypes_ (dict): Integer dtype of the codes per column.
+    """
+
+    def __init__(self, columns=None):
+        self.columns = columns
+
+    def fit(self, X: pd.DataFrame, y=None):
+        columns = self.columns
+        if columns is None:
+            columns = [col for col in X.columns if X[col].dtype.kind in "OSUb" or isinstance(X[col].dtype, (pd.CategoricalDtype, pd.StringDtype))]
+        self.categories_ = {}
+        self.dtypes_ = {}
+        for col in columns:
+            values = X[col]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                values = values.cat.remove_unused_categories().cat.categories
+            self.categories_[col] = pd.Index(pd.unique(values.dropna())).sort_values()
+            self.dtypes_[col] = code_dtype(len(self.categories_[col]))
+        return self
+
+    @property
+    def columns_(self) -> list:
+        check_is_fitted(self)
+        return list(self.categories_)
+
+    def _encode(self, values: pd.Series, col: str) -> np.ndarray:
+        categories = self.categories_[col]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            # look up the few categories of the column instead of every row
+            lookup = np.append(categories.get_indexer(values.cat.categories), UNKNOWN_CODE)
+            codes = lookup[values.cat.codes.to_numpy()]
+        else:
+            codes = categories.get_indexer(values)
+        return codes.astype(self.dtypes_[col], copy=False)
+
+    def transform(self, X: pd.DataFrame, inplace: bool = False) -> pd.DataFrame:
+        """
+        Replaces the categorical columns with their codes.
+
+        Args:
+            X (pd.DataFrame): Frame with the columns of `fit`.
+            inplace (bool): Modify X instead of a shallow copy of it.
+
+        Returns:
+            pd.DataFrame: X or its copy with the encoded columns.
+        """
+        check_is_fitted(self)
+        missing = [col for col in self.categories_ if col not in X.columns]
+        if missing:
+            raise KeyError(f"Columns missing for the encoding: {missing}")
+        if not inplace:
+            X = X.copy(deep=False)
+        for col in self.categories_:
+            X[col] = self._encode(X[col], col)
+        return X
+
+    def inverse_transform(self, X: pd.DataFrame) -> pd.DataFrame:
+        """Replaces the codes with the categories, the unknown code becomes NaN."""
+        check_is_fitted(self)
+        X = X.copy(deep=False)
+        for col, categories in self.categories_.items():
+            X[col] = pd.Categorical.from_codes(X[col].to_numpy(), categories=categories)
+        return X
+
+    def save(self, path: str):
+        """Saves the categories as JSON."""
+        check_is_fitted(self)
+        categories = {col: categories.tolist() for col, categories in self.categories_.items()}
+        with open(path, "w") as file:
+            json.dump({"columns": self.columns, "categories": categories}, file, indent=2)
+
+    @classmethod
+    def from_categories(cls, categories: dict, columns=None) -> "CategoricalEncoderRegistry":
+        """Fitted registry from known categories per column, e.g. collected chunk by chunk from a file larger than the memory."""
+        registry = cls(columns=columns)
+        registry.categories_ = {col: pd.Index(values).sort_values() for col, values in categories.items()}
+        registry.dtypes_ = {col: code_dtype(len(values)) for col, values in registry.categories_.items()}
+        return registry
+
+    @classmethod
+    def load(cls, path: str) -> "CategoricalEncoderRegistry":
+        with open(path) as file:
+            state = json.load(file)
+        return cls.from_categories(state["categories"], columns=state["columns"])
+
+
+def benchmark_encoding(X: pd.DataFrame, cat_columns: list, repeat: int = 3) -> dict:
+    """
+    Time and memory of the registry compared with `OrdinalEncoder.fit_transform` on the same columns.
+
+    Returns:
+        dict: Best time of `repeat` runs in seconds, rows per second and memory of the encoded
+            frames in bytes for both variants.
+    """
+    registry = CategoricalEncoderRegistry(columns=cat_columns).fit(X)
+
+    def ordinal_encoder(df):
+        df = df.copy()
+        df[cat_columns] = OrdinalEncoder().fit_transform(df[cat_columns])
+        return df
+
+    result = {"rows": len(X), "input_bytes": int(X.memory_usage(deep=True).sum())}
+    for name, func in [("ordinal_encoder", ordinal_encoder), ("registry", registry.transform)]:
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            encoded = func(X)
+            best = min(best, time.perf_counter() - start)
+        result[f"{name}_seconds"] = best
+        result[f"{name}_rows_per_second"] = len(X) / best
+        result[f"{name}_bytes"] = int(encoded[cat_columns].memory_usage(index=False).sum())
+    return result
+
+
+if __name__ == "__main__":
+    import sys
+
+    path = sys.argv[1] if len(sys.argv) > 1 else "data/synth_combined.csv"
+    df = pd.read_csv(path, index_col=0)
+    X = df.drop("dropped_out", axis=1)
+    cat_columns = [col for col in X.columns if col != "year"]
+    result = benchmark_encoding(X, cat_columns)
+    print(
+        "{rows} rows: OrdinalEncoder {ordinal_encoder_rows_per_second:,.0f} rows/s, {ordinal_encoder_bytes:,} bytes; "
+        "registry {registry_rows_per_second:,.0f} rows/s, {registry_bytes:,} bytes".format(**result)
+    )
@@ -0,0 +1,216 @@
+"""
+State-year features as a small dimension table that is attached to the population by index lookup.
+
+The IAB and Destatis features have one value per state and year, but the notebooks merged them into
+the per-person population with pandas merges on string keys, each merge copying the whole
+population. `StateYearFeatures` keeps the features in a dense table with one row per combination
+of state and year. The row of a combination is the integer surrogate key
+
+    key = state_index * n_years + (year - first_year)
+
+so the features of every person are found with `np.take` on the key, no hashing of strings per
+merge and no copy of the population. The key of a person is computed once (`keys`), unknown states
+or years get the key -1, which points to an extra row of missing values.
+
+`attach` adds the feature columns to a (shallow copy of a) frame. `StateYearEnricher` does the same
+as the first step of a Pipeline, so the features are only materialized for the rows of the model
+input, e.g. chunk by chunk in `modeling/predict.py`.
+
+Benchmark against pandas merge (run from the repository root):
+
+    python -m modeling.enrichment --rows 10000000
+"""
+import argparse
+import time
+import tracemalloc
+from functools import reduce
+
+import numpy as np
+import pandas as pd
+from sklearn.base import BaseEstimator, TransformerMixin
+
+STATE_COLUMN = "state"
+YEAR_COLUMN = "year"
+
+
+class StateYearFeatures:
+    """
+    Dense dimension table of features per state and year.
+
+    Args:
+        df (pd.DataFrame): One row per state and year with the columns 'state', 'year' and the features.
+            Combinations without a row get missing values.
+        dtype: Dtype of the feature values, float32 by default to keep the attached columns small.
+
+    Attributes:
+        states (pd.Index): Sorted state names, the position is the state index of the key.
+        first_year (int): First year of the table.
+        n_years (int): Number of years, all years between the first and the last year are included.
+        columns (list): Names of the features.
+        values (np.ndarray): Matrix of shape (n_states * n_years + 1, n_features), the last row holds
+            the missing values for the key -1.
+    """
+
+    def __init__(self, df: pd.DataFrame, dtype=np.float32):
+        if df.duplicated([STATE_COLUMN, YEAR_COLUMN]).any():
+            raise ValueError("The features contain more than one row per state and year")
+        self.states = pd.Index(df[STATE_COLUMN].astype(str).unique()).sort_values()
+        years = df[YEAR_COLUMN].astype(int)
+        self.first_year = int(years.min())
+        self.n_years = int(years.max()) - self.first_year + 1
+        self.columns = [col for col in df.columns if col not in (STATE_COLUMN, YEAR_COLUMN)]
+        self.values = np.full((len(self.states) * self.n_years + 1, len(self.columns)), np.nan, dtype=dtype)
+        keys = self.keys(df[STATE_COLUMN], years)
+        self.values[keys] = df[self.columns].to_numpy(dtype=dtype, na_value=np.nan)
+
+    @classmethod
+    def from_frames(cls, *frames: pd.DataFrame, dtype=np.float32) -> "StateYearFeatures":
+        """Combines several state-year tables (e.g. IAB and nominal wages) with outer joins on state and year."""
+        frames = [frame.astype({STATE_COLUMN: str, YEAR_COLUMN: int}) for frame in frames]
+        df = reduce(lambda left, right: left.merge(right, on=[STATE_COLUMN, YEAR_COLUMN], how="outer"), frames)
+        return cls(df, dtype=dtype)
+
+    def __len__(self) -> int:
+        return len(self.states) * self.n_years
+
+    def state_codes(self, states) -> np.ndarray:
+        """Index of each state in `states`, -1 for unknown states. Categorical input is looked up per category."""
+        states = pd.Series(states) if not isinstance(states, pd.Series) else states
+        if isinstance(states.dtype, pd.CategoricalDtype):
+            lookup = np.append(self.states.get_indexer(states.cat.categories.astype(str)), -1)
+            return lookup[states.cat.codes.to_numpy()]
+        return self.states.get_indexer(states.astype(str))
+
+    def keys(self, states, years) -> np.ndarray:
+        """
+        Surrogate keys of the rows.
+
+        Returns:
+            np.ndarray: int32 key per row, -1 if the state or the year is not in the table.
+        """
+        state_codes = self.state_codes(states)
+        year_offsets = np.asarray(years, dtype=np.int64) - self.first_year
+        keys = state_codes * self.n_years + year_offsets
+        unknown = (state_codes < 0) | (year_offsets < 0) | (year_offsets >= self.n_years)
+        return np.where(unknown, -1, keys).astype(np.int32)
+
+    def lookup(self, keys: np.ndarray, columns=None) -> dict:
+        """Feature values for the keys as dict of arrays, the key -1 gives missing values."""
+        columns = self.columns if columns is None else list(columns)
+        positions = [self.columns.index(col) for col in columns]
+        return {col: np.take(self.values[:, pos], keys) for col, pos in zip(columns, positions)}
+
+    def attach(self, df: pd.DataFrame, columns=None, keys: np.ndarray = None, inplace: bool = False) -> pd.DataFrame:
+        """
+        Adds the features to the rows of df.
+
+        Args:
+            df (pd.DataFrame): Frame with the columns 'state' and 'year'.
+            columns (list, optional): Features to add, default all.
+            keys (np.ndarray, optional): Precomputed keys of df, see `keys`.
+            inplace (bool): Add the columns to df instead of a shallow copy of it.
+
+        Returns:
+            pd.DataFrame: df or its shallow copy with the feature columns.
+        """
+        if keys is None:
+            keys = self.keys(df[STATE_COLUMN], df[YEAR_COLUMN])
+        columns = self.columns if columns is None else list(columns)
+        positions = [self.columns.index(col) for col in columns]
+        # one take for all features, the result is a single block that pandas doesn't copy again
+        block = np.take(self.values[:, positions], keys, axis=0)
+        features = pd.DataFrame(block, index=df.index, columns=columns, copy=False)
+        if inplace:
+            df[columns] = features
+            return df
+        return pd.concat([df, features], axis=1, copy=False)
+
+    def to_frame(self) -> pd.DataFrame:
+        """The table in long format, one row per state and year."""
+        df = pd.DataFrame(self.values[:-1], columns=self.columns)
+        df.insert(0, STATE_COLUMN, np.repeat(self.states.to_numpy(), self.n_years))
+        df.insert(1, YEAR_COLUMN, np.tile(np.arange(self.first_year, self.first_year + self.n_years), len(self.states)))
+        return df
+
+    def save(self, path: str):
+        self.to_frame().to_parquet(path, index=False)
+
+    @classmethod
+    def load(cls, path: str) -> "StateYearFeatures":
+        df = pd.read_parquet(path)
+        return cls(df, dtype=df.drop(columns=[STATE_COLUMN, YEAR_COLUMN]).dtypes.iloc[0])
+
+
+class StateYearEnricher(TransformerMixin, BaseEstimator):
+    """
+    Adds state-year features at model-input time.
+
+    Args:
+        features (StateYearFeatures): The dimension table.
+        columns (list, optional): Features to add, default all.
+        drop_keys (bool): Remove the columns 'state' and 'year' after the lookup.
+    """
+
+    def __init__(self, features: StateYearFeatures, columns=None, drop_keys: bool = False):
+        self.features = features
+        self.columns = columns
+        self.drop_keys = drop_keys
+
+    def fit(self, X, y=None):
+        return self
+
+    def transform(self, X: pd.DataFrame) -> pd.DataFrame:
+        X = self.features.attach(X, self.columns)
+        if self.drop_keys:
+            X = X.drop(columns=[STATE_COLUMN, YEAR_COLUMN])
+        return X
+
+
+def benchmark_enrichment(n_rows: int = 10_000_000, n_features: int = 30, seed: int = 42) -> dict:
+    """
+    Compares `StateYearFeatures.attach` with a pandas merge on a random population.
+
+    Returns:
+        dict: Seconds and peak of the allocated memory in bytes for both variants and the size of the population.
+    """
+    rng = np.random.default_rng(seed)
+    states = [f"state_{i:02d}" for i in range(16)]
+    years = np.arange(2013, 2023)
+    dim = pd.DataFrame(
+        {STATE_COLUMN: np.repeat(states, len(years)), YEAR_COLUMN: np.tile(years, len(states))}
+        | {f"feature_{i}": rng.normal(size=len(states) * len(years)) for i in range(n_features)}
+    )
+    population = pd.DataFrame({
+        STATE_COLUMN: pd.Categorical(rng.choice(states, n_rows)),
+        YEAR_COLUMN: rng.choice(years, n_rows).astype(np.int16),
+        "age": rng.integers(16, 30, n_rows).astype(np.int8),
+    })
+    features = StateYearFeatures(dim)
+    dim = dim.astype({col: np.float32 for col in features.columns})
+
+    result = {"rows": n_rows, "population_bytes": int(population.memory_usage(deep=True).sum())}
+    variants = [
+        ("merge", lambda: population.merge(dim, on=[STATE_COLUMN, YEAR_COLUMN], how="left")),
+        ("attach", lambda: features.attach(population)),
+    ]
+    for name, func in variants:
+        tracemalloc.start()
+        start = time.perf_counter()
+        enriched = func()
+        result[f"{name}_seconds"] = time.perf_counter() - start
+        result[f"{name}_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del enriched
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, description="Benchmark the enrichment")
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--features", type=int, default=30)
+    args = parser.parse_args()
+    result = benchmark_enrichment(args.rows, args.features)
+    print(
+        "{rows:,} rows ({population_bytes:,} bytes): merge {merge_seconds:.2f}s, peak {merge_peak_bytes:,} bytes; "
+        "attach {attach_seconds:.2f}s, peak {attach_peak_bytes:,} bytes".format(**result)
+    )
@@ -0,0 +1,161 @@
+"""
+TreeSHAP explanations of the dropout-risk model for every cell, precomputed as an indexed table.
+
+The dashboard fills the tables "other states" and "higher school certificate" with one
+`model.predict` per row, and it can't show why a risk is high. This module computes the
+prediction and the TreeSHAP contribution of every feature (XGBoost `pred_contribs`) for all
+cells (Region, Beruf_clean, Jahr, abschluss_cat) of the model of `modeling.dropout_risk` at once.
+The cells are scored in chunks, and XGBoost computes the contributions of a chunk on all threads.
+The contributions and the bias add up to the raw prediction of the model, the margin (log odds
+for a classifier).
+
+The table is sorted by occupation, region, year and certificate and saved as Parquet with one row
+group per occupation, so `load_explanations` with an occupation reads one row group.
+`ExplanationTable` keeps the whole table indexed in memory (e.g. in `st.cache_resource`), and the
+comparisons of the dashboard are slices of it:
+
+    table = ExplanationTable.load()
+    table.regions("Kaufmann/-frau im Einzelhandel", 2026, "Realschule")       # other states
+    table.certificates("Berlin", "Kaufmann/-frau im Einzelhandel", 2026)      # other certificates
+    table.cell("Berlin", "Kaufmann/-frau im Einzelhandel", 2026, "Realschule")  # why this risk
+
+Usage (run from the repository root):
+
+    python -m modeling.explain models/dropout_risk --first-year 2010 --until 2030
+"""
+import argparse
+import os
+import time
+from logging import getLogger
+
+import numpy as np
+import pandas as pd
+
+from modeling.dropout_risk import CATEGORICAL_FEATURES, FEATURES, DropoutRiskModel
+
+logger = getLogger(__name__)
+
+EXPLANATIONS_PATH = "data/explanations/dropout_risk_shap.parquet"
+# order of the table, the first column is the row group
+INDEX = ["Beruf_clean", "Region", "Jahr", "abschluss_cat"]
+CONTRIBUTIONS = [f"contribution_{col}" for col in FEATURES]
+
+
+def cell_grid(model: DropoutRiskModel, years: range) -> pd.DataFrame:
+    """All combinations of the known categories of the model and the years, in the order of INDEX."""
+    levels = {col: model.encoder.categories_[col] for col in CATEGORICAL_FEATURES} | {"Jahr": pd.Index(years, dtype=np.int16)}
+    index = pd.MultiIndex.from_product([levels[col] for col in INDEX], names=INDEX)
+    return index.to_frame(index=False)
+
+
+def explain_frame(model: DropoutRiskModel, X: pd.DataFrame, n_jobs: int = None) -> pd.DataFrame:
+    """
+    Risk, bias and TreeSHAP contributions for the rows of X with the FEATURES.
+
+    Returns:
+        pd.DataFrame: 'risk' (like `DropoutRiskModel.predict_frame`), 'margin', 'bias' and one
+            CONTRIBUTIONS column per feature, bias + contributions = margin.
+    """
+    import xgboost as xgb
+
+    booster = model.model.get_booster()
+    booster.set_param({"nthread": n_jobs or os.cpu_count() or 1})
+    matrix = xgb.DMatrix(model.encoder.transform(X[FEATURES]), feature_names=FEATURES)
+    # one column per feature and the bias in the last column
+    contributions = booster.predict(matrix, pred_contribs=True)
+    margin = contributions.sum(axis=1)
+    risk = 1 / (1 + np.exp(-margin)) if hasattr(model.model, "predict_proba") else np.clip(margin, 0, 1)
+    result = pd.DataFrame(contributions[:, :-1], columns=CONTRIBUTIONS, index=X.index)
+    result.insert(0, "bias", contributions[:, -1])
+    result.insert(0, "margin", margin)
+    result.insert(0, "risk", risk)
+    return result.astype(np.float32)
+
+
+def explain_cells(model: DropoutRiskModel, years: range, chunk_size: int = 100_000, n_jobs: int = None) -> pd.DataFrame:
+    """
+    Explanations of all cells of `cell_grid`.
+
+    Args:
+        model (DropoutRiskModel): Model with an XGBoost estimator.
+        years (range): Years of the cells, including the forecast years of the dashboard.
+        chunk_size (int): Cells per call to XGBoost.
+        n_jobs (int, optional): Threads of XGBoost, default the number of cores.
+
+    Returns:
+        pd.DataFrame: The INDEX columns and the columns of `explain_frame`, sorted by INDEX.
+    """
+    grid = cell_grid(model, years)
+    start = time.perf_counter()
+    chunks = [explain_frame(model, grid.iloc[i:i + chunk_size], n_jobs) for i in range(0, len(grid), chunk_size)]
+    logger.info(f"Explained {len(grid)} cells in {time.perf_counter() - start:.1f}s")
+    return pd.concat([grid, pd.concat(chunks)], axis=1)
+
+
+def save_explanations(df: pd.DataFrame, path: str = EXPLANATIONS_PATH):
+    """Saves the table with one row group per occupation, the table must be sorted by INDEX."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    df = df.astype({col: "category" for col in CATEGORICAL_FEATURES} | {"Jahr": np.int16})
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    with pq.ParquetWriter(path, table.schema) as writer:
+        # the grid is a product, every occupation has the same number of rows
+        rows = len(df) // max(df[INDEX[0]].nunique(), 1)
+        for start in range(0, len(df), rows):
+            writer.write_table(table.slice(start, rows))
+
+
+def load_explanations(path: str = EXPLANATIONS_PATH, occupation: str = None, region: str = None, year: int = None, certificate: str = None) -> pd.DataFrame:
+    """Reads the explanations, optionally only the rows of one occupation, region, year and/or certificate."""
+    values = {"Beruf_clean": occupation, "Region": region, "Jahr": year, "abschluss_cat": certificate}
+    filters = [(col, "==", value) for col, value in values.items() if value is not None]
+    return pd.read_parquet(path, filters=filters or None)
+
+
+class ExplanationTable:
+    """
+    The explanations indexed by (Beruf_clean, Jahr, Region, abschluss_cat) for lookups without a model.
+
+    Args:
+        df (pd.DataFrame): Output of `explain_cells` or `load_explanations`.
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        lookup_order = ["Beruf_clean", "Jahr", "Region", "abschluss_cat"]
+        self.df = df.astype({col: str for col in CATEGORICAL_FEATURES}).set_index(lookup_order).sort_index()
+
+    @classmethod
+    def load(cls, path: str = EXPLANATIONS_PATH) -> "ExplanationTable":
+        return cls(load_explanations(path))
+
+    def cell(self, region: str, occupation: str, year: int, certificate: str) -> pd.Series:
+        """Risk, bias and contributions of one cell."""
+        return self.df.loc[(occupation, year, region, certificate)]
+
+    def regions(self, occupation: str, year: int, certificate: str) -> pd.DataFrame:
+        """Risk of every state for an occupation, year and certificate, lowest risk first."""
+        return self.df.xs((occupation, year, certificate), level=["Beruf_clean", "Jahr", "abschluss_cat"]).sort_values("risk")
+
+    def certificates(self, region: str, occupation: str, year: int) -> pd.DataFrame:
+        """Risk of every certificate for a state, occupation and year, lowest risk first."""
+        return self.df.loc[(occupation, year, region)].sort_values("risk")
+
+
+if __name__ == "__main__":
+    import logging
+
+    logging.basicConfig(format="%(asctime)s: %(message)s", level=logging.INFO)
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, description="Precompute the TreeSHAP explanations of all cells")
+    parser.add_argument("model", nargs="?", default="models/dropout_risk", help="Directory of the dropout-risk bundle")
+    parser.add_argument("--first-year", type=int, default=2010)
+    parser.add_argument("-u", "--until", type=int, default=2030, help="Last year, the dashboard shows forecasts until 2030")
+    parser.add_argument("--chunk-size", type=int, default=100_000, help="Cells per call to XGBoost")
+    parser.add_argument("-j", "--jobs", type=int, help="Threads of XGBoost")
+    parser.add_argument("-o", "--output", default=EXPLANATIONS_PATH)
+    args = parser.parse_args()
+
+    explanations = explain_cells(DropoutRiskModel.load(args.model), range(args.first_year, args.until + 1), args.chunk_size, args.jobs)
+    save_explanations(explanations, args.output)
+    logger.info(f"Saved {len(explanations)} cells to {args.output}")
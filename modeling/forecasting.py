@@ -0,0 +1,204 @@
+"""
+Forecasts of all occupation/region series of DAZUBI, fitted in a process pool and reconciled.
+
+The dashboards fit a Prophet model or a linear trend for every selection, and the forecasts of the
+states don't add up to the forecast of Deutschland. This module fits one damped-trend ETS model
+(statsmodels `ETSModel`, additive error and trend) per series of one measure:
+
+- every (Beruf_clean, state) series of `dazubi_grouped_berufe`
+- every Beruf_clean series of Deutschland, the sum of the states (from `modeling.cube.DazubiCube`)
+
+The series are fitted in chunks in a process pool. Series with fewer than `MIN_OBSERVATIONS` years
+since their first count, or whose fit fails, get the last value as forecast. The forecasts of each
+occupation are then reconciled so that the states add up to Deutschland:
+
+- 'ols': the coherent forecasts closest to all base forecasts (least squares projection). For one
+  parent with n children the projection is closed form, so all occupations and horizons are
+  reconciled at once. The projection spreads the incoherence equally over the states, so it can
+  give negative counts, and counts to states where the occupation doesn't exist. The states
+  with a base forecast of 0 therefore stay 0, negative forecasts are clipped, and the other
+  states are scaled to add up to the reconciled Deutschland.
+- 'bottom_up': Deutschland is the sum of the forecasts of the states.
+
+The groups of states (Westdeutschland, Ostdeutschland, ...) are added as sums of the reconciled
+states. The result is saved as Parquet, one row per occupation, region and forecast year.
+
+Usage (run from the repository root):
+
+    python -m modeling.forecasting data/dazubi_grouped_berufe.csv --until 2030 --jobs 8
+"""
+import argparse
+import os
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from logging import getLogger
+
+import numpy as np
+import pandas as pd
+
+from modeling.cube import REGION_GROUPS, TOTAL_REGION, DazubiCube
+
+logger = getLogger(__name__)
+
+MEASURE = "Vorzeitige Vertragslösungen Insgesamt"
+MIN_OBSERVATIONS = 5
+FORECAST_PATH = "data/forecasts/dazubi_forecasts.parquet"
+
+
+def fit_forecast(y: np.ndarray, horizon: int) -> np.ndarray:
+    """
+    Forecast of one yearly series with a damped additive ETS model, the last value if the series is too short.
+
+    Years before the first count > 0 are ignored (the occupation didn't exist yet).
+    """
+    from statsmodels.tsa.exponential_smoothing.ets import ETSModel
+
+    y = np.nan_to_num(np.asarray(y, dtype=float))
+    observed = y[np.argmax(y > 0):] if (y > 0).any() else y[-1:]
+    if len(observed) < MIN_OBSERVATIONS or np.ptp(observed) == 0:
+        return np.full(horizon, observed[-1])
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            result = ETSModel(observed, error="add", trend="add", damped_trend=True).fit(disp=False)
+            forecast = np.asarray(result.forecast(horizon))
+    except (ValueError, np.linalg.LinAlgError):
+        return np.full(horizon, observed[-1])
+    if not np.isfinite(forecast).all():
+        return np.full(horizon, observed[-1])
+    # counts can't be negative
+    return np.maximum(forecast, 0)
+
+
+def _forecast_chunk(Y: np.ndarray, horizon: int) -> np.ndarray:
+    return np.vstack([fit_forecast(y, horizon) for y in Y]) if len(Y) else np.empty((0, horizon))
+
+
+def forecast_series(Y: np.ndarray, horizon: int, n_jobs: int = None, chunk_size: int = 100) -> np.ndarray:
+    """
+    Base forecasts of many series.
+
+    Args:
+        Y (np.ndarray): Series in the rows, shape (n_series, n_years).
+        horizon (int): Number of years to forecast.
+        n_jobs (int, optional): Number of processes, default the number of cores.
+        chunk_size (int): Series per task of the pool.
+
+    Returns:
+        np.ndarray: Forecasts of shape (n_series, horizon).
+    """
+    chunks = [Y[start:start + chunk_size] for start in range(0, len(Y), chunk_size)]
+    n_jobs = n_jobs or os.cpu_count() or 1
+    if n_jobs <= 1:
+        return np.vstack([_forecast_chunk(chunk, horizon) for chunk in chunks])
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        return np.vstack(list(executor.map(_forecast_chunk, chunks, [horizon] * len(chunks))))
+
+
+def reconcile(children: np.ndarray, parent: np.ndarray, method: str = "ols") -> tuple:
+    """
+    Makes the forecasts of the children (states) add up to the forecast of the parent (Deutschland).
+
+    Args:
+        children (np.ndarray): Base forecasts of shape (n_groups, n_children, horizon).
+        parent (np.ndarray): Base forecasts of shape (n_groups, horizon).
+        method (str): 'ols' or 'bottom_up'.
+
+    Returns:
+        tuple: (children, parent), parent is the sum of the children. With 'ols' the children are
+            non-negative, and children with a base forecast of 0 stay 0.
+    """
+    if method == "bottom_up":
+        return children, children.sum(axis=1)
+    if method != "ols":
+        raise ValueError(f"Unknown reconciliation method {method}, use 'ols' or 'bottom_up'")
+    # OLS with S = [1'; I]: b = (S'S)^-1 S' y = (I - 11'/(n+1)) (children + parent)
+    n = children.shape[1]
+    combined = children + parent[:, None, :]
+    reconciled = combined - combined.sum(axis=1, keepdims=True) / (n + 1)
+    total = np.maximum(reconciled.sum(axis=1, keepdims=True), 0)
+    # counts can't be negative, and children without a base forecast (no counts) stay 0,
+    # the others are scaled to add up to the reconciled parent again
+    reconciled = np.where(children > 0, np.maximum(reconciled, 0), 0)
+    kept = reconciled.sum(axis=1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        reconciled = np.where(kept > 0, reconciled * total / kept, 0)
+    return reconciled, reconciled.sum(axis=1)
+
+
+def build_forecasts(df: pd.DataFrame, measure: str = MEASURE, until: int = 2030, method: str = "ols", n_jobs: int = None) -> pd.DataFrame:
+    """
+    Fits and reconciles the forecasts of all occupation/region series.
+
+    Args:
+        df (pd.DataFrame): Rows of the states, e.g. `dazubi_grouped_berufe`.
+        measure (str): Column to forecast.
+        until (int): Last forecast year.
+        method (str): Reconciliation, 'ols' or 'bottom_up'.
+        n_jobs (int, optional): Number of processes.
+
+    Returns:
+        pd.DataFrame: Columns 'Beruf_clean', 'Region', 'Jahr', 'base_forecast' (NaN for the groups
+            of states) and 'forecast'. The forecasts of the states add up to Deutschland.
+    """
+    cube = DazubiCube(df, measures=[measure])
+    states = cube.levels["state"]
+    occupations = cube.levels["occupation"]
+    horizon = until - int(cube.years[-1])
+    if horizon < 1:
+        raise ValueError(f"The data already ends in {cube.years[-1]}, nothing to forecast until {until}")
+
+    # (years, states + Deutschland, occupations) -> series in the rows, occupation-major
+    values = cube.query(None, states + [TOTAL_REGION], occupations, measure)
+    Y = values.transpose(2, 1, 0).reshape(-1, len(cube.years))
+    start = time.perf_counter()
+    base = forecast_series(Y, horizon, n_jobs).reshape(len(occupations), len(states) + 1, horizon)
+    logger.info(f"Fitted {len(Y)} series in {time.perf_counter() - start:.1f}s")
+
+    children, parent = reconcile(base[:, :-1], base[:, -1], method)
+    group_names = [name for name in REGION_GROUPS]
+    membership = np.array([[state in REGION_GROUPS[name] for state in states] for name in group_names], dtype=float)
+    groups = np.einsum("gs,osh->ogh", membership, children)
+
+    regions = states + [TOTAL_REGION] + group_names
+    forecast = np.concatenate([children, parent[:, None], groups], axis=1)
+    base_forecast = np.concatenate([base, np.full(groups.shape, np.nan)], axis=1)
+    years = np.arange(int(cube.years[-1]) + 1, until + 1)
+    index = pd.MultiIndex.from_product([occupations, regions, years], names=["Beruf_clean", "Region", "Jahr"])
+    result = pd.DataFrame({"base_forecast": base_forecast.ravel(), "forecast": forecast.ravel()}, index=index).reset_index()
+    result.attrs.update(measure=measure, method=method)
+    return result
+
+
+def save_forecasts(df: pd.DataFrame, path: str = FORECAST_PATH):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    df.astype({"Beruf_clean": "category", "Region": "category", "Jahr": np.int16}).to_parquet(path, index=False)
+
+
+def load_forecasts(path: str = FORECAST_PATH, occupation: str = None, region: str = None) -> pd.DataFrame:
+    """Reads the saved forecasts, optionally only the rows of one occupation and/or region."""
+    filters = [(col, "==", value) for col, value in (("Beruf_clean", occupation), ("Region", region)) if value is not None]
+    return pd.read_parquet(path, filters=filters or None)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, description="Forecast all occupation/region series")
+    parser.add_argument("data", nargs="?", default="data/dazubi_grouped_berufe.csv")
+    parser.add_argument("-m", "--measure", default=MEASURE)
+    parser.add_argument("-u", "--until", type=int, default=2030, help="Last forecast year")
+    parser.add_argument("--method", default="ols", choices=["ols", "bottom_up"], help="Reconciliation")
+    parser.add_argument("-j", "--jobs", type=int, help="Number of processes")
+    parser.add_argument("-o", "--output", default=FORECAST_PATH)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    import logging
+
+    logging.basicConfig(format="%(asctime)s: %(message)s", level=logging.INFO)
+    args = parse_arguments()
+    start = time.perf_counter()
+    forecasts = build_forecasts(pd.read_csv(args.data, index_col=0), args.measure, args.until, args.method, args.jobs)
+    save_forecasts(forecasts, args.output)
+    logger.info(f"Saved {len(forecasts)} forecasts to {args.output} in {time.perf_counter() - start:.1f}s")
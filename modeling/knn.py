@@ -0,0 +1,237 @@
+"""
+Nearest neighbours for purely categorical features.
+
+The optuna notebook used ``KNeighborsClassifier(metric=simple_matching)`` with a python
+function as metric. sklearn then has to call the interpreter once per pair of rows, which
+makes cross validation on the synthetic population impractical. The classifier in this
+module computes the same simple matching (Hamming) distance on ordinal encoded matrices
+in blocks with numpy and can be used as a drop-in replacement.
+
+The synthetic population contains many identical rows, so the training data is reduced
+to the unique feature combinations with a count per class. Because the distance can only
+take the values 0..n_features, the neighbours are collected level by level: all rows with
+distance 0, then 1, ... until ``n_neighbors`` rows are reached. If the last level holds
+more rows than needed, every row of that level contributes proportionally. sklearn breaks
+these ties by the row order of the training data instead, so predictions can differ for
+queries where equally distant neighbours disagree.
+
+Usage (run from the repository root):
+
+    python -m modeling.knn data/synth_combined.csv
+"""
+from logging import getLogger
+import time
+
+import numpy as np
+from sklearn import get_config
+from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.utils.validation import check_is_fitted
+
+logger = getLogger(__name__)
+
+
+def simple_matching(x, y):
+    """The python metric used so far in the notebooks, kept for comparisons."""
+    return np.sum(x != y)
+
+
+def to_codes(X) -> np.ndarray:
+    """
+    Converts an ordinal encoded matrix into the smallest integer dtype that holds it.
+
+    Args:
+        X: Array like with integral values, e.g. the output of an `OrdinalEncoder`.
+           Unknown categories may be encoded as negative values.
+
+    Raises:
+        ValueError: If X contains values that are not integral.
+
+    Returns:
+        np.ndarray: 2d array with an integer dtype.
+    """
+    X = np.asarray(X)
+    if X.ndim != 2:
+        raise ValueError(f"Expected a 2d array, got {X.ndim} dimensions")
+    if X.dtype.kind in "iub":
+        codes = X
+    else:
+        codes = X.astype(np.int64)
+        if not np.array_equal(codes, X):
+            raise ValueError("Expected ordinal encoded features with integral values")
+    if codes.size == 0:
+        return codes.astype(np.uint8)
+    low, high = codes.min(), codes.max()
+    dtype = np.result_type(np.min_scalar_type(low), np.min_scalar_type(high))
+    return codes.astype(dtype, copy=False)
+
+
+def hamming_distances(A: np.ndarray, B: np.ndarray) -> np.ndarray:
+    """
+    Number of differing features between every row of A and every row of B.
+
+    The loop runs over the features only, each step compares a whole block of rows.
+
+    Returns:
+        np.ndarray: Distance matrix of shape (len(A), len(B)).
+    """
+    n_features = A.shape[1]
+    if B.shape[1] != n_features:
+        raise ValueError(f"A has {n_features} features, B has {B.shape[1]}")
+    dtype = np.uint8 if n_features < 256 else np.uint16
+    dist = np.zeros((A.shape[0], B.shape[0]), dtype=dtype)
+    for j in range(n_features):
+        dist += A[:, j, None] != B[None, :, j]
+    return dist
+
+
+class HammingKNeighborsClassifier(ClassifierMixin, BaseEstimator):
+    """
+    k nearest neighbours classifier with the simple matching distance.
+
+    Args:
+        n_neighbors (int): Number of neighbours used for the vote.
+        weights (str): 'uniform' or 'distance'. With 'distance' each neighbour votes with
+            1 / distance. Like sklearn, if there are neighbours with distance 0, only they vote.
+        working_memory (int or None): Maximum size in MiB of the temporary arrays of one
+            block of queries. Defaults to sklearn's `working_memory` setting.
+    """
+
+    def __init__(self, n_neighbors=5, weights="uniform", working_memory=None):
+        self.n_neighbors = n_neighbors
+        self.weights = weights
+        self.working_memory = working_memory
+
+    def fit(self, X, y):
+        if self.weights not in ("uniform", "distance"):
+            raise ValueError(f"weights must be 'uniform' or 'distance', got {self.weights!r}")
+        if self.n_neighbors < 1:
+            raise ValueError(f"n_neighbors must be positive, got {self.n_neighbors}")
+        codes = to_codes(X)
+        y = np.asarray(y)
+        if len(y) != len(codes):
+            raise ValueError(f"X has {len(codes)} rows, y has {len(y)}")
+
+        self.classes_, y_idx = np.unique(y, return_inverse=True)
+        self.cells_, cell_idx = np.unique(codes, axis=0, return_inverse=True)
+        # counts of every class for every unique feature combination
+        self.cell_counts_ = np.zeros((len(self.cells_), len(self.classes_)))
+        np.add.at(self.cell_counts_, (cell_idx.ravel(), y_idx), 1)
+        self.n_features_in_ = codes.shape[1]
+        self.n_samples_fit_ = len(codes)
+        return self
+
+    def _block_size(self) -> int:
+        working_memory = self.working_memory or get_config()["working_memory"]
+        # distance matrix (1 byte) + mask per level converted to float for the matmul (8 bytes)
+        bytes_per_query = len(self.cells_) * 9
+        return max(1, int(working_memory * 2**20 // bytes_per_query))
+
+    def _votes(self, dist: np.ndarray) -> np.ndarray:
+        n_levels = self.n_features_in_ + 1
+        k = min(self.n_neighbors, self.n_samples_fit_)
+        # class counts of the training rows per query and distance level
+        levels = np.stack(
+            [(dist == d) @ self.cell_counts_ for d in range(n_levels)], axis=1
+        )
+        totals = levels.sum(axis=2)
+        closer = np.cumsum(totals, axis=1) - totals
+        taken = np.clip(k - closer, 0, totals)
+        fraction = np.divide(taken, totals, out=np.zeros_like(taken), where=totals > 0)
+        votes = levels * fraction[:, :, None]
+        if self.weights == "uniform":
+            return votes.sum(axis=1)
+        inverse = 1.0 / np.maximum(np.arange(n_levels), 1)
+        weighted = np.einsum("qlc,l->qc", votes[:, 1:], inverse[1:])
+        exact = taken[:, 0] > 0
+        weighted[exact] = votes[exact, 0]
+        return weighted
+
+    def predict_proba(self, X) -> np.ndarray:
+        check_is_fitted(self, "cells_")
+        codes = to_codes(X)
+        if codes.shape[1] != self.n_features_in_:
+            raise ValueError(
+                f"X has {codes.shape[1]} features, but the classifier was fitted with {self.n_features_in_}"
+            )
+        proba = np.empty((len(codes), len(self.classes_)))
+        block_size = self._block_size()
+        for start in range(0, len(codes), block_size):
+            block = codes[start : start + block_size]
+            votes = self._votes(hamming_distances(block, self.cells_))
+            proba[start : start + len(block)] = votes / votes.sum(axis=1, keepdims=True)
+        return proba
+
+    def predict(self, X) -> np.ndarray:
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
+
+
+def benchmark(X, y, n_train: int = 5000, n_test: int = 500, n_neighbors: int = 5, seed: int = 42) -> dict:
+    """
+    Compares the runtime of sklearn with the python `simple_matching` metric and the vectorized classifier.
+
+    The python metric is far too slow for the whole population, so both are timed on a
+    random sample of `n_train` training and `n_test` query rows. Additionally the vectorized
+    classifier is timed on all rows (fit on all, predict on `n_test` rows).
+
+    Args:
+        X: Ordinal encoded features.
+        y: Target.
+
+    Returns:
+        dict: Timings in seconds, speedup and the share of equal predictions.
+    """
+    from sklearn.neighbors import KNeighborsClassifier
+
+    codes = to_codes(X)
+    y = np.asarray(y)
+    rng = np.random.default_rng(seed)
+    idx = rng.permutation(len(codes))
+    train, test = idx[:n_train], idx[n_train : n_train + n_test]
+
+    start = time.perf_counter()
+    reference = KNeighborsClassifier(n_neighbors=n_neighbors, metric=simple_matching)
+    y_reference = reference.fit(codes[train], y[train]).predict(codes[test])
+    time_callable = time.perf_counter() - start
+
+    start = time.perf_counter()
+    model = HammingKNeighborsClassifier(n_neighbors=n_neighbors)
+    y_pred = model.fit(codes[train], y[train]).predict(codes[test])
+    time_vectorized = time.perf_counter() - start
+
+    start = time.perf_counter()
+    HammingKNeighborsClassifier(n_neighbors=n_neighbors).fit(codes, y).predict(codes[test])
+    time_full = time.perf_counter() - start
+
+    return {
+        "n_train": len(train),
+        "n_test": len(test),
+        "time_callable": time_callable,
+        "time_vectorized": time_vectorized,
+        "speedup": time_callable / time_vectorized,
+        "agreement": float(np.mean(y_pred == y_reference)),
+        "n_rows_full": len(codes),
+        "time_vectorized_full": time_full,
+    }
+
+
+if __name__ == "__main__":
+    import logging
+    import sys
+
+    import pandas as pd
+    from sklearn.preprocessing import OrdinalEncoder
+
+    logging.basicConfig(format="%(asctime)s: %(message)s", level=logging.INFO)
+
+    path = sys.argv[1] if len(sys.argv) > 1 else "data/synth_combined.csv"
+    df = pd.read_csv(path, index_col=0)
+    col_target = "dropped_out"
+    X = OrdinalEncoder().fit_transform(df.drop(col_target, axis=1))
+    result = benchmark(X, df[col_target].to_numpy())
+    logger.info(
+        "simple_matching: {time_callable:.2f}s, vectorized: {time_vectorized:.3f}s, "
+        "speedup: {speedup:.0f}x, agreement: {agreement:.1%} ({n_train} train / {n_test} test rows)".format(**result)
+    )
+    logger.info(
+        "vectorized on all {n_rows_full} rows: {time_vectorized_full:.2f}s for {n_test} predictions".format(**result)
+    )
@@ -0,0 +1,267 @@
+"""
+XGBoost training on a population larger than the memory, from memory-mapped integer shards.
+
+The notebooks read the whole synthetic population with pandas, encode it with
+`encode_categorical_columns` (float64 codes) and pass the frame to XGBoost, so the population,
+its encoded copy and the DMatrix are in memory at the same time. Here the population is read in
+chunks twice:
+
+1. `scan_population` collects the categories of every categorical column into a
+   `CategoricalEncoderRegistry` and the minimum, maximum and missing values of every numeric
+   column, chunk by chunk. The feature dtype is the smallest integer dtype that holds the codes
+   and the ranges of all columns (int16 if the year is a feature), float32 if a column has missing
+   or non-integral values.
+2. `write_shards` encodes every chunk and writes its features as one `.npy` file in that dtype
+   and its target as int8, with a `manifest.json` that points to the shards and the encoder.
+
+`ShardIterator` is an `xgboost.DataIter` that memory-maps one shard after the other. XGBoost builds
+its quantized pages from it in external-memory mode (`ExtMemQuantileDMatrix`), so only one shard
+and the compressed pages are in memory. HistGradientBoostingClassifier has no external-memory
+interface (it converts the whole input to float64), it can only be trained on a sample of the shards
+(`load_shards`).
+
+Compare peak RSS and throughput with the in-memory training (run from the repository root):
+
+    python -m modeling.out_of_core data/synth_combined.csv --chunk-size 1000000 --rounds 50
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from logging import getLogger
+
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+
+from modeling.encoding import UNKNOWN_CODE, CategoricalEncoderRegistry
+
+logger = getLogger(__name__)
+
+SHARD_DIR = "data/cache/shards"
+TARGET = "dropped_out"
+INTEGER_DTYPES = [np.int8, np.int16, np.int32, np.int64]
+PARAMS = {"objective": "binary:logistic", "tree_method": "hist", "max_depth": 6, "eta": 0.3, "max_bin": 64, "eval_metric": "logloss"}
+
+
+def read_chunks(path: str, chunk_size: int):
+    """Chunks of a CSV (first column is the index) or Parquet file."""
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, index_col=0, chunksize=chunk_size)
+
+
+def scan_population(path: str, target: str = TARGET, chunk_size: int = 1_000_000) -> tuple:
+    """
+    Categories of the non-numeric columns and ranges of the numeric columns, collected chunk by chunk.
+
+    Returns:
+        tuple: (CategoricalEncoderRegistry, dict column -> (minimum, maximum, integral) of the
+            numeric columns, integral is False if the column has missing or non-integral values)
+    """
+    categories, ranges = {}, {}
+    for chunk in read_chunks(path, chunk_size):
+        for col in chunk.columns:
+            if col == target:
+                continue
+            if not pd.api.types.is_numeric_dtype(chunk[col]):
+                categories.setdefault(col, set()).update(chunk[col].dropna().unique())
+                continue
+            values = chunk[col].to_numpy(dtype=np.float64, na_value=np.nan)
+            low, high, integral = ranges.get(col, (np.inf, -np.inf, True))
+            integral = integral and bool(np.isfinite(values).all() and (values == np.round(values)).all())
+            if len(values) and not np.isnan(values).all():
+                low, high = min(low, np.nanmin(values)), max(high, np.nanmax(values))
+            ranges[col] = (low, high, integral)
+    encoder = CategoricalEncoderRegistry.from_categories({col: sorted(values) for col, values in categories.items()})
+    return encoder, ranges
+
+
+def feature_dtype(encoder: CategoricalEncoderRegistry, ranges: dict) -> np.dtype:
+    """Smallest integer dtype of the codes (unknown is -1) and the numeric ranges, float32 if a column isn't integral."""
+    bounds = [(UNKNOWN_CODE, len(categories) - 1) for categories in encoder.categories_.values()]
+    for low, high, integral in ranges.values():
+        if not integral:
+            return np.dtype(np.float32)
+        if low <= high:
+            bounds.append((low, high))
+    low, high = min((bound[0] for bound in bounds), default=0), max((bound[1] for bound in bounds), default=0)
+    for dtype in INTEGER_DTYPES:
+        if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.float32)
+
+
+def write_shards(path: str, out_dir: str = SHARD_DIR, encoder: CategoricalEncoderRegistry = None, dtype: np.dtype = None, target: str = TARGET, chunk_size: int = 1_000_000) -> dict:
+    """
+    Encodes the population chunk by chunk into memory-mappable shards.
+
+    Args:
+        path (str): CSV or Parquet file of the population.
+        out_dir (str): Directory of the shards, the manifest and the encoder.
+        encoder (CategoricalEncoderRegistry, optional): Fitted encoder, default the encoder of
+            `scan_population(path)`.
+        dtype (np.dtype, optional): dtype of the features, default `feature_dtype` of the encoder
+            and the ranges of `scan_population(path)`.
+        target (str): Target column.
+        chunk_size (int): Rows per shard.
+
+    Returns:
+        dict: The manifest with the columns, the dtype and the file and number of rows of every shard.
+    """
+    if encoder is None or dtype is None:
+        scanned_encoder, ranges = scan_population(path, target, chunk_size)
+        encoder = scanned_encoder if encoder is None else encoder
+        dtype = feature_dtype(encoder, ranges) if dtype is None else dtype
+    dtype = np.dtype(dtype)
+    os.makedirs(out_dir, exist_ok=True)
+    encoder.save(os.path.join(out_dir, "encoder.json"))
+    manifest = {"target": target, "encoder": "encoder.json", "dtype": dtype.str, "shards": []}
+    for i, chunk in enumerate(read_chunks(path, chunk_size)):
+        y = chunk.pop(target).to_numpy(dtype=np.int8)
+        X = encoder.transform(chunk, inplace=True)
+        manifest.setdefault("columns", list(X.columns))
+        features = X[manifest["columns"]].to_numpy(dtype=dtype)
+        name = f"shard_{i:05d}"
+        np.save(os.path.join(out_dir, f"{name}_X.npy"), features)
+        np.save(os.path.join(out_dir, f"{name}_y.npy"), y)
+        manifest["shards"].append({"X": f"{name}_X.npy", "y": f"{name}_y.npy", "rows": len(y)})
+        logger.info(f"Wrote {name} with {len(y)} rows")
+    with open(os.path.join(out_dir, "manifest.json"), "w") as file:
+        json.dump(manifest, file, indent=2)
+    return manifest
+
+
+def read_manifest(shard_dir: str = SHARD_DIR) -> dict:
+    with open(os.path.join(shard_dir, "manifest.json")) as file:
+        return json.load(file)
+
+
+class ShardIterator(xgb.DataIter):
+    """Feeds the shards one by one as memory maps to XGBoost."""
+
+    def __init__(self, shard_dir: str = SHARD_DIR, cache_prefix: str = None):
+        self.shard_dir = shard_dir
+        self.manifest = read_manifest(shard_dir)
+        self.position = 0
+        super().__init__(cache_prefix=cache_prefix or os.path.join(shard_dir, "xgb_cache"))
+
+    def next(self, input_data) -> bool:
+        if self.position == len(self.manifest["shards"]):
+            return False
+        shard = self.manifest["shards"][self.position]
+        X = np.load(os.path.join(self.shard_dir, shard["X"]), mmap_mode="r")
+        y = np.load(os.path.join(self.shard_dir, shard["y"]), mmap_mode="r")
+        input_data(data=X, label=y, feature_names=self.manifest["columns"])
+        self.position += 1
+        return True
+
+    def reset(self):
+        self.position = 0
+
+
+def load_shards(shard_dir: str = SHARD_DIR, max_rows: int = None) -> tuple:
+    """Features and target of the first shards with at most max_rows rows in memory, e.g. for sklearn estimators."""
+    manifest = read_manifest(shard_dir)
+    features, targets, rows = [], [], 0
+    for shard in manifest["shards"]:
+        if max_rows is not None and rows >= max_rows:
+            break
+        take = shard["rows"] if max_rows is None else min(shard["rows"], max_rows - rows)
+        features.append(np.load(os.path.join(shard_dir, shard["X"]), mmap_mode="r")[:take])
+        targets.append(np.load(os.path.join(shard_dir, shard["y"]), mmap_mode="r")[:take])
+        rows += take
+    return pd.DataFrame(np.concatenate(features), columns=manifest["columns"]), np.concatenate(targets)
+
+
+def train_external(shard_dir: str = SHARD_DIR, params: dict = PARAMS, num_boost_round: int = 50) -> xgb.Booster:
+    """Trains XGBoost in external-memory mode on the shards."""
+    matrix = xgb.ExtMemQuantileDMatrix(ShardIterator(shard_dir), max_bin=params.get("max_bin", 256))
+    return xgb.train(params, matrix, num_boost_round=num_boost_round)
+
+
+def train_in_memory(path: str, params: dict = PARAMS, num_boost_round: int = 50, target: str = TARGET) -> xgb.Booster:
+    """The way of the notebooks: the whole population in a frame, float codes like `encode_categorical_columns`, one DMatrix."""
+    from sklearn.preprocessing import OrdinalEncoder
+
+    df = pd.read_csv(path, index_col=0) if not path.endswith(".parquet") else pd.read_parquet(path)
+    y = df.pop(target).to_numpy()
+    cat_columns = [col for col in df.columns if not pd.api.types.is_numeric_dtype(df[col])]
+    X = df.copy()
+    X[cat_columns] = OrdinalEncoder().fit_transform(X[cat_columns])
+    matrix = xgb.QuantileDMatrix(X, label=y, max_bin=params.get("max_bin", 256))
+    return xgb.train(params, matrix, num_boost_round=num_boost_round)
+
+
+def _measure(variant: str, path: str, shard_dir: str, num_boost_round: int) -> dict:
+    start = time.perf_counter()
+    if variant == "external":
+        train_external(shard_dir, num_boost_round=num_boost_round)
+    else:
+        train_in_memory(path, num_boost_round=num_boost_round)
+    return {"variant": variant, "seconds": time.perf_counter() - start, "peak_rss_bytes": peak_rss()}
+
+
+def peak_rss() -> int:
+    """Peak resident memory of this process in bytes."""
+    # ru_maxrss survives execve, so a spawned child would report the peak of its parent; VmHWM doesn't
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # KiB on Linux, bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+def benchmark(path: str, shard_dir: str = SHARD_DIR, num_boost_round: int = 50, chunk_size: int = 1_000_000) -> pd.DataFrame:
+    """
+    Peak RSS and throughput of the in-memory and the external-memory training.
+
+    Every variant runs in a fresh process, so the peaks don't include each other. The time of the
+    external variant doesn't include writing the shards, which is done once.
+
+    Returns:
+        pd.DataFrame: One row per variant with seconds, rows per second and peak RSS.
+    """
+    start = time.perf_counter()
+    manifest = write_shards(path, shard_dir, chunk_size=chunk_size)
+    shard_seconds = time.perf_counter() - start
+    rows = sum(shard["rows"] for shard in manifest["shards"])
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for variant in ("in_memory", "external"):
+        with context.Pool(1) as pool:
+            results.append(pool.apply(_measure, (variant, path, shard_dir, num_boost_round)))
+    table = pd.DataFrame(results).set_index("variant")
+    table["rows_per_second"] = rows / table["seconds"]
+    table.attrs.update(rows=rows, shard_seconds=shard_seconds)
+    return table
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, description="Compare out-of-core with in-memory XGBoost training")
+    parser.add_argument("data", nargs="?", default="data/synth_combined.csv")
+    parser.add_argument("--shard-dir", default=SHARD_DIR)
+    parser.add_argument("--chunk-size", type=int, default=1_000_000, help="Rows per shard")
+    parser.add_argument("--rounds", type=int, default=50, help="Boosting rounds")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    import logging
+
+    logging.basicConfig(format="%(asctime)s: %(message)s", level=logging.INFO)
+    args = parse_arguments()
+    table = benchmark(args.data, args.shard_dir, args.rounds, args.chunk_size)
+    print(f"{table.attrs['rows']:,} rows, shards written in {table.attrs['shard_seconds']:.1f}s")
+    print(table.to_string(formatters={"peak_rss_bytes": "{:,}".format, "rows_per_second": "{:,.0f}".format, "seconds": "{:.1f}".format}))
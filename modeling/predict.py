@@ -1,40 +1,200 @@
-import sys
+import argparse
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator
+
+import numpy as np
 import pandas as pd
-import pickle
-from sklearn.metrics import mean_squared_error
 import warnings
-import mlflow
 from mlflow.sklearn import load_model
 
 warnings.filterwarnings("ignore")
 
-from feature_engineering import (
-    fill_missing_values,
-    drop_column,
-    transform_altitude,
-)
-
-print("Number of arguments:", len(sys.argv), "arguments.")
-print("Argument List:", str(sys.argv))
-
-# in an ideal world this would validated
-model_path = sys.argv[1]
-X_test_path = sys.argv[2]
-y_test_path = sys.argv[3]
-
-# load the model from disk
-# model_path = "models/linear"
-loaded_model = load_model(model_path)
-X_test = pd.read_csv(X_test_path)
-y_test = pd.read_csv(y_test_path)
-
-# feature eng on test data
-print("Feature engineering")
-X_test = transform_altitude(X_test)
-X_test = drop_column(X_test, col_name="Unnamed: 0")
-X_test = drop_column(X_test, col_name="Quakers")
-X_test = fill_missing_values(X_test)
-
-y_test_pred = loaded_model.predict(X_test)
-mse_test = mean_squared_error(y_test, y_test_pred)
-print(f"MSE on test is: {mse_test}")
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Predict with a saved model. The input is processed in chunks, so it can be larger than the memory.",
+    )
+    parser.add_argument("model_path", help="Path of the model saved with mlflow, e.g. models/linear")
+    parser.add_argument("X_test_path", help="Features as CSV or Parquet file")
+    parser.add_argument("y_test_path", nargs="?", help="Optional target as CSV or Parquet file to compute the metrics")
+    parser.add_argument("-o", "--output", help="Write the predictions to this file, .parquet or .csv")
+    parser.add_argument("-c", "--chunk-size", type=int, default=100_000, help="Number of rows per chunk")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of processes used for the predictions")
+    return parser.parse_args()
+
+
+def read_chunks(path: str, chunk_size: int) -> Iterator[pd.DataFrame]:
+    """Reads a CSV or Parquet file in chunks of `chunk_size` rows."""
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, chunksize=chunk_size)
+
+
+_model = None
+
+
+def _load_model(model_path: str):
+    global _model
+    _model = load_model(model_path)
+
+
+def _predict_chunk(X: pd.DataFrame) -> np.ndarray:
+    # the feature engineering is part of the saved pipeline
+    return np.asarray(_model.predict(X)).ravel()
+
+
+class PredictionWriter:
+    """Appends the predictions chunk by chunk to a CSV or Parquet file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.parquet_writer = None
+        self.first_chunk = True
+
+    def write(self, predictions: np.ndarray):
+        df = pd.DataFrame({"prediction": predictions})
+        if self.path.endswith(".parquet"):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self.parquet_writer is None:
+                self.parquet_writer = pq.ParquetWriter(self.path, table.schema)
+            self.parquet_writer.write_table(table)
+        else:
+            df.to_csv(self.path, mode="w" if self.first_chunk else "a", header=self.first_chunk, index=False)
+        self.first_chunk = False
+
+    def close(self):
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+
+
+class RunningMetrics:
+    """
+    MSE and R2 from running statistics, so only the current chunk has to be in memory.
+
+    The total sum of squares is kept as the sum of squared deviations from the running mean (M2)
+    and the chunks are merged with the update of Chan et al. The textbook formula
+    sum(y²) - sum(y)²/n subtracts two huge, nearly equal numbers for targets with a large mean
+    and a small variance (e.g. years) and loses all digits.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.sum_squared_error = 0.0
+        self.mean_y = 0.0
+        self.m2_y = 0.0
+
+    def update(self, y_true: np.ndarray, y_pred: np.ndarray):
+        y_true = np.asarray(y_true, dtype=float).ravel()
+        if len(y_true) == 0:
+            return
+        self.sum_squared_error += float(np.sum((y_true - y_pred) ** 2))
+        n_chunk = len(y_true)
+        mean_chunk = float(np.mean(y_true))
+        m2_chunk = float(np.sum((y_true - mean_chunk) ** 2))
+        n = self.n + n_chunk
+        delta = mean_chunk - self.mean_y
+        self.mean_y += delta * n_chunk / n
+        self.m2_y += m2_chunk + delta**2 * self.n * n_chunk / n
+        self.n = n
+
+    @property
+    def mse(self) -> float:
+        return self.sum_squared_error / self.n
+
+    @property
+    def r2(self) -> float:
+        return 1 - self.sum_squared_error / self.m2_y
+
+
+class TargetReader:
+    """Target values in slices of any length, so they line up with the predictions whatever the chunks of the files."""
+
+    def __init__(self, chunks: Iterator[pd.DataFrame]):
+        self.chunks = chunks
+        self.buffer = np.empty(0)
+
+    def _next_chunk(self):
+        chunk = next(self.chunks, None)
+        return None if chunk is None else chunk.iloc[:, 0].to_numpy(dtype=float)
+
+    def take(self, n: int) -> np.ndarray:
+        """The next n target values, raises a ValueError if the target has fewer rows."""
+        parts, available = [self.buffer], len(self.buffer)
+        while available < n:
+            values = self._next_chunk()
+            if values is None:
+                raise ValueError(f"The target has fewer rows than the features, {n - available} predictions have no target")
+            parts.append(values)
+            available += len(values)
+        values = np.concatenate(parts) if len(parts) > 1 else self.buffer
+        self.buffer = values[n:]
+        return values[:n]
+
+    def check_exhausted(self):
+        """Raises a ValueError if target rows are left after the last prediction."""
+        left = len(self.buffer)
+        while (values := self._next_chunk()) is not None:
+            left += len(values)
+        if left:
+            raise ValueError(f"The target has {left} more rows than the features")
+
+
+def predict_chunks(chunks: Iterator[pd.DataFrame], model_path: str, jobs: int = 1) -> Iterator[np.ndarray]:
+    """
+    Yields the predictions for each chunk in the order of the input.
+
+    With more than one job the chunks are distributed to a process pool, each process loads
+    the model once. At most two chunks per process are read ahead, so the memory stays flat.
+    """
+    if jobs <= 1:
+        _load_model(model_path)
+        for X in chunks:
+            yield _predict_chunk(X)
+        return
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_load_model, initargs=(model_path,)) as executor:
+        pending = deque()
+        for X in chunks:
+            pending.append(executor.submit(_predict_chunk, X))
+            if len(pending) >= 2 * jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def main(args: argparse.Namespace):
+    start = time.time()
+    writer = PredictionWriter(args.output) if args.output else None
+    metrics = RunningMetrics() if args.y_test_path else None
+    y_test = TargetReader(read_chunks(args.y_test_path, args.chunk_size)) if metrics else None
+    n_rows = 0
+    try:
+        for y_pred in predict_chunks(read_chunks(args.X_test_path, args.chunk_size), args.model_path, args.jobs):
+            n_rows += len(y_pred)
+            if writer:
+                writer.write(y_pred)
+            if metrics:
+                metrics.update(y_test.take(len(y_pred)), y_pred)
+        if metrics:
+            y_test.check_exhausted()
+    finally:
+        if writer:
+            writer.close()
+    print(f"Predicted {n_rows} rows in {time.time() - start:.1f}s")
+    if metrics:
+        print(f"MSE on test is: {metrics.mse}")
+        print(f"R2 on test is: {metrics.r2}")
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
@@ -0,0 +1,149 @@
+"""
+SQL over the DAZUBI and synthetic datasets with DuckDB, without reading whole files into pandas.
+
+The analysis notebooks read whole CSV files with `pd.read_csv` and then select columns and rows in
+pandas, and `tableau_preperation.ipynb` writes a projected copy with `to_csv`. `connect` registers
+every dataset of `DATASETS` that exists in the data directory as a view:
+
+- dazubi_complete and the files of `dazubi_split.ipynb` (dazubi_berufe, dazubi_bundeslaender, ...)
+- dazubi_grouped_berufe
+- the synthetic populations (synth_combined, synthetic_population, ...)
+- the outputs of the modeling (forecasts, explanations, state_year_features)
+
+DuckDB only reads the columns a query uses and, for Parquet, skips the row groups its filters
+exclude. It runs the query on all cores. `query` returns the (small) result as a DataFrame,
+`batches` yields it in chunks, and `export` writes it with `COPY ... TO` directly to CSV or
+Parquet, so the rows never become a DataFrame. The CSV files are parsed in parallel as well, but
+only Parquet files can skip rows without reading them.
+
+A connection can be shared, e.g. with `st.cache_resource` in a dashboard: `query`, `batches` and
+`export` run on a cursor of their own, so they can be called from several threads.
+
+    con = connect()
+    query("SELECT Jahr, sum(\\"Vorzeitige Vertragslösungen Insgesamt\\") AS n FROM dazubi_grouped_berufe WHERE Region = ? GROUP BY Jahr", ["Berlin"], con)
+
+Usage (run from the repository root):
+
+    python -m modeling.query --list
+    python -m modeling.query "SELECT Region, count(*) FROM synth_combined GROUP BY Region"
+    python -m modeling.query "SELECT * FROM dazubi_grouped_berufe WHERE Jahr >= 2020" -o export/dazubi_2020.parquet
+"""
+import argparse
+import os
+import time
+from logging import getLogger
+
+import duckdb
+import pandas as pd
+
+logger = getLogger(__name__)
+
+DATA_DIR = "data"
+
+# view name -> file relative to the data directory
+DATASETS = {
+    "dazubi_complete": "dazubi_complete.parquet",
+    **{
+        f"dazubi_{name}": f"dazubi_{name}.parquet"
+        for name in ("deutschland", "westdeutschland", "ostdeutschland", "alte_laender", "neue_laender", "bundeslaender", "insgesamt", "berufe")
+    },
+    "dazubi_grouped_berufe": "dazubi_grouped_berufe.csv",
+    "synth_combined": "synth_combined.csv",
+    "synthetic_population": "synthetic_population.csv",
+    "synthetic_population_new": "synthetic_population_new.csv",
+    "synthetic_population_terminated": "synthetic_population_terminated.csv",
+    "state_year_features": "state_year_features.parquet",
+    "forecasts": "forecasts/dazubi_forecasts.parquet",
+    "explanations": "explanations/dropout_risk_shap.parquet",
+}
+
+
+def _quote(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _reader(path: str) -> str:
+    if path.endswith(".parquet"):
+        return f"read_parquet({_quote(path)})"
+    # pandas writes the index as first column without a name, DuckDB calls it column0
+    return f"read_csv({_quote(path)}, header = true)"
+
+
+def connect(data_dir: str = DATA_DIR, datasets: dict = DATASETS, threads: int = None, database: str = ":memory:") -> duckdb.DuckDBPyConnection:
+    """
+    Connection with a view per dataset that exists in data_dir, missing files are skipped.
+
+    Args:
+        data_dir (str): Directory of the datasets, '../data' from the notebooks.
+        datasets (dict): View name -> file relative to data_dir.
+        threads (int, optional): Threads of DuckDB, default the number of cores.
+        database (str): DuckDB database file, by default in memory.
+    """
+    con = duckdb.connect(database, config={"threads": threads} if threads else {})
+    for name, file in datasets.items():
+        path = os.path.join(data_dir, file)
+        if os.path.exists(path):
+            con.execute(f'CREATE OR REPLACE VIEW "{name}" AS SELECT * FROM {_reader(path)}')
+        else:
+            logger.debug(f"Skipped the view {name}, {path} doesn't exist")
+    return con
+
+
+def views(con: duckdb.DuckDBPyConnection) -> list:
+    """Names of the registered views."""
+    return [name for (name,) in con.execute("SELECT view_name FROM duckdb_views() WHERE NOT internal ORDER BY view_name").fetchall()]
+
+
+def query(sql: str, params: list = None, con: duckdb.DuckDBPyConnection = None) -> pd.DataFrame:
+    """Result of a query as a DataFrame, for results that fit into the memory. The parameters are bound to the ? in sql."""
+    cursor = (con or connect()).cursor()
+    return cursor.execute(sql, params or []).df()
+
+
+def batches(sql: str, params: list = None, con: duckdb.DuckDBPyConnection = None, batch_size: int = 1_000_000):
+    """Result of a query as DataFrames of at most batch_size rows, only one batch is in memory."""
+    cursor = (con or connect()).cursor()
+    reader = cursor.execute(sql, params or []).fetch_record_batch(batch_size)
+    for batch in reader:
+        yield batch.to_pandas()
+
+
+def export(sql: str, path: str, params: list = None, con: duckdb.DuckDBPyConnection = None) -> int:
+    """
+    Writes the result of a query to a CSV or Parquet file (by the extension) without a DataFrame.
+
+    Returns:
+        int: Number of exported rows.
+    """
+    file_format = "parquet" if path.endswith(".parquet") else "csv"
+    options = "FORMAT parquet" if file_format == "parquet" else "FORMAT csv, HEADER"
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    cursor = (con or connect()).cursor()
+    (rows,) = cursor.execute(f"COPY ({sql}) TO {_quote(path)} ({options})", params or []).fetchone()
+    return rows
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, description="Query the datasets with SQL")
+    parser.add_argument("sql", nargs="?", help="Query over the views")
+    parser.add_argument("-d", "--data-dir", default=DATA_DIR)
+    parser.add_argument("-o", "--output", help="Export the result to a .csv or .parquet file instead of printing it")
+    parser.add_argument("-j", "--threads", type=int, help="Threads of DuckDB")
+    parser.add_argument("--list", action="store_true", help="List the views")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    import logging
+
+    logging.basicConfig(format="%(asctime)s: %(message)s", level=logging.INFO)
+    args = parse_arguments()
+    con = connect(args.data_dir, threads=args.threads)
+    if args.list or not args.sql:
+        print("\n".join(views(con)))
+    elif args.output:
+        start = time.perf_counter()
+        rows = export(args.sql, args.output, con=con)
+        logger.info(f"Exported {rows} rows to {args.output} in {time.perf_counter() - start:.1f}s")
+    else:
+        print(query(args.sql, con=con).to_string())
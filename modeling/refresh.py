@@ -0,0 +1,310 @@
+"""
+Refresh of a trained model with the rows of a new reporting year.
+
+Currently a new DAZUBI year means retraining the models of `model_optuna.ipynb` and the dropout-risk
+regressor of the dashboard from scratch on all years. `refresh` trains on the new year only, and
+what it does depends on the estimator:
+
+- XGBoost (sklearn API): boosting continues from the booster of the old model (`xgb_model`). The
+  new rounds fit the residuals of the old trees on the new rows.
+- HistGradientBoosting, RandomForest, ExtraTrees and GradientBoosting: `warm_start`. The fitted
+  trees are kept, and `max_iter` or `n_estimators` more are added that are fitted on the new rows.
+- All other estimators (e.g. the logistic regression pipeline, kNN): a full refit on all years.
+
+Before it refreshes, `drift_report` compares the new year with the history. It computes the
+population stability index (PSI) of every feature except the year, and of the target. If a PSI
+exceeds the threshold (0.2 by default, a "significant shift"), the old trees describe a different
+population. The same applies when the new year has categories the encoder doesn't know, because
+these would all get the unknown code. In both cases the model is refit on all years.
+
+The old model is read from MLflow (e.g. `runs:/<run_id>/model` of an autologged run) or from a
+bundle of `modeling.dropout_risk`. The models of the notebook are trained on features encoded
+with `CategoricalEncoderRegistry`, which isn't logged with the model. The encoder is therefore fit
+again on the history, and its sorted categories give the same codes as in the notebook. Pipelines
+get the raw features. With `--compare` the full refit is timed as well and reported next to the
+refresh.
+
+Usage (run from the repository root):
+
+    python -m modeling.refresh runs:/<run_id>/model data/synth_combined.csv --year 2024 --compare
+    python -m modeling.refresh models/dropout_risk data/dazubi_grouped_berufe.csv --year 2024 --compare
+"""
+import argparse
+import copy
+import math
+import os
+import time
+from logging import getLogger
+
+import numpy as np
+import pandas as pd
+from sklearn.base import clone
+from sklearn.pipeline import Pipeline
+
+from modeling.dropout_risk import FEATURES, DropoutRiskModel, training_table
+from modeling.encoding import CategoricalEncoderRegistry
+
+logger = getLogger(__name__)
+
+PSI_THRESHOLD = 0.2
+NEW_ROUNDS_FRACTION = 0.1
+
+# parameter that counts the trees of the estimators with an additive warm start
+WARM_START_PARAMETERS = {
+    "HistGradientBoostingClassifier": "max_iter",
+    "HistGradientBoostingRegressor": "max_iter",
+    "RandomForestClassifier": "n_estimators",
+    "RandomForestRegressor": "n_estimators",
+    "ExtraTreesClassifier": "n_estimators",
+    "ExtraTreesRegressor": "n_estimators",
+    "GradientBoostingClassifier": "n_estimators",
+    "GradientBoostingRegressor": "n_estimators",
+}
+
+
+def population_stability(expected: pd.Series, actual: pd.Series, bins: int = 10, epsilon: float = 1e-4) -> float:
+    """
+    Population stability index of a column, sum((actual - expected) * ln(actual / expected)) over its bins.
+
+    Numerical columns with more than `bins` values are cut at the quantiles of `expected`, all
+    other columns are compared by value. Missing values are a bin of their own.
+    """
+    if pd.api.types.is_numeric_dtype(expected) and not pd.api.types.is_bool_dtype(expected) and expected.nunique() > bins:
+        edges = np.unique(np.quantile(expected.dropna(), np.linspace(0, 1, bins + 1)))
+        edges[0], edges[-1] = -np.inf, np.inf
+        expected, actual = pd.cut(expected, edges), pd.cut(actual, edges)
+    p = expected.value_counts(normalize=True, dropna=False)
+    q = actual.value_counts(normalize=True, dropna=False)
+    p, q = p.align(q, fill_value=0)
+    p, q = np.clip(p.to_numpy(dtype=float), epsilon, None), np.clip(q.to_numpy(dtype=float), epsilon, None)
+    return float(((q - p) * np.log(q / p)).sum())
+
+
+def drift_report(X_history: pd.DataFrame, y_history, X_new: pd.DataFrame, y_new, exclude: tuple = ("year", "Jahr")) -> pd.Series:
+    """
+    PSI of every feature and of the target between the history and the new year.
+
+    Args:
+        exclude (tuple): Columns that change by definition, e.g. the year.
+
+    Returns:
+        pd.Series: PSI per column, the target is 'target', sorted descending.
+    """
+    psi = {col: population_stability(X_history[col], X_new[col]) for col in X_history.columns if col not in exclude}
+    psi["target"] = population_stability(pd.Series(np.asarray(y_history)), pd.Series(np.asarray(y_new)))
+    return pd.Series(psi).sort_values(ascending=False)
+
+
+def unseen_categories(encoder: CategoricalEncoderRegistry, X: pd.DataFrame) -> dict:
+    """Categories of X per column that the encoder doesn't know."""
+    unseen = {}
+    for col, categories in encoder.categories_.items():
+        values = pd.Index(X[col].dropna().unique())
+        new = values[categories.get_indexer(values) == -1]
+        if len(new):
+            unseen[col] = new.tolist()
+    return unseen
+
+
+def refresh_strategy(model) -> str:
+    """'continue' for XGBoost, 'warm_start' for the WARM_START_PARAMETERS estimators, otherwise 'refit'."""
+    if type(model).__module__.startswith("xgboost"):
+        return "continue"
+    if type(model).__name__ in WARM_START_PARAMETERS:
+        return "warm_start"
+    return "refit"
+
+
+def _new_rounds(trees: int, n_rounds: int = None) -> int:
+    return n_rounds if n_rounds is not None else max(1, math.ceil(trees * NEW_ROUNDS_FRACTION))
+
+
+def continue_boosting(model, X_new: pd.DataFrame, y_new, n_rounds: int = None):
+    """
+    Copy of an XGBoost model with n_rounds more boosting rounds on the new rows.
+
+    Args:
+        n_rounds (int, optional): New rounds, default NEW_ROUNDS_FRACTION of the existing ones.
+    """
+    booster = model.get_booster()
+    n_rounds = _new_rounds(booster.num_boosted_rounds(), n_rounds)
+    refreshed = clone(model).set_params(n_estimators=n_rounds)
+    # with xgb_model, fit adds n_estimators rounds to the trees of the booster
+    refreshed.fit(X_new, y_new, xgb_model=booster)
+    # a clone of the refreshed model (e.g. a refit after a drift) trains as many rounds as the original
+    return refreshed.set_params(n_estimators=model.get_params()["n_estimators"])
+
+
+def warm_start(model, X_new: pd.DataFrame, y_new, n_rounds: int = None):
+    """Copy of a tree ensemble with n_rounds more trees (or iterations) fitted on the new rows."""
+    parameter = WARM_START_PARAMETERS[type(model).__name__]
+    # HistGradientBoosting can stop early, the fitted iterations are n_iter_
+    trees = getattr(model, "n_iter_", None) or model.get_params()[parameter]
+    refreshed = copy.deepcopy(model)
+    refreshed.set_params(warm_start=True, **{parameter: trees + _new_rounds(trees, n_rounds)})
+    return refreshed.fit(X_new, y_new)
+
+
+def refit(model, X: pd.DataFrame, y):
+    """Unfitted copy of the model with the same parameters, fitted on X."""
+    return clone(model).fit(X, y)
+
+
+def _refit_all_years(model, X_history: pd.DataFrame, y_history, X_new: pd.DataFrame, y_new, encoder: CategoricalEncoderRegistry = None) -> tuple:
+    X = pd.concat([X_history, X_new], ignore_index=True)
+    y = np.concatenate([np.asarray(y_history), np.asarray(y_new)])
+    if encoder is not None:
+        # the refit learns the new categories, so the codes can change
+        encoder = CategoricalEncoderRegistry(columns=encoder.columns_).fit(X)
+        X = encoder.transform(X)
+    return refit(model, X, y), encoder
+
+
+def refresh(model, X_history: pd.DataFrame, y_history, X_new: pd.DataFrame, y_new, n_rounds: int = None,
+            threshold: float = PSI_THRESHOLD, encoder: CategoricalEncoderRegistry = None, compare: bool = False) -> tuple:
+    """
+    Updates a fitted model with the rows of a new year, or refits it on all years after a drift.
+
+    Args:
+        model: Fitted estimator. If an encoder is given, it was trained on encoded features.
+        X_history (pd.DataFrame): Features of the years the model was trained on.
+        y_history: Target of the history.
+        X_new (pd.DataFrame): Features of the new year.
+        y_new: Target of the new year.
+        n_rounds (int, optional): New boosting rounds or trees, default NEW_ROUNDS_FRACTION of the existing ones.
+        threshold (float): Largest PSI that is still refreshed instead of refit.
+        encoder (CategoricalEncoderRegistry, optional): Fitted encoder of the categorical features.
+        compare (bool): Also time the full refit on all years, even if the model was refreshed.
+
+    Returns:
+        tuple: (model, report), report is a dict with the 'strategy' ('continue', 'warm_start' or
+            'refit'), the 'reason' of a refit, the 'drift' (PSI per column), 'new_rows', the
+            'encoder' of the returned model, 'refresh_seconds' unless it was refit and, with
+            compare or after a refit, 'full_refit_seconds'.
+    """
+    drift = drift_report(X_history, y_history, X_new, y_new)
+    strategy = refresh_strategy(model)
+    report = {"strategy": strategy, "reason": None, "drift": drift, "new_rows": len(X_new)}
+    unseen = unseen_categories(encoder, X_new) if encoder is not None else {}
+    if strategy == "refit":
+        report["reason"] = f"{type(model).__name__} can't be updated incrementally"
+    elif unseen:
+        strategy, report["reason"] = "refit", f"new categories {unseen}"
+    elif drift.iloc[0] > threshold:
+        strategy, report["reason"] = "refit", f"PSI of {drift.index[0]} is {drift.iloc[0]:.3f} > {threshold}"
+    report["strategy"] = strategy
+
+    if strategy == "refit" or compare:
+        start = time.perf_counter()
+        full, full_encoder = _refit_all_years(model, X_history, y_history, X_new, y_new, encoder)
+        report["full_refit_seconds"] = time.perf_counter() - start
+        if strategy == "refit":
+            logger.info(f"Refit on all years, {report['reason']}")
+            return full, report | {"encoder": full_encoder}
+
+    start = time.perf_counter()
+    X_new = encoder.transform(X_new) if encoder is not None else X_new
+    refreshed = continue_boosting(model, X_new, y_new, n_rounds) if strategy == "continue" else warm_start(model, X_new, y_new, n_rounds)
+    report["refresh_seconds"] = time.perf_counter() - start
+    logger.info(f"Refreshed with {strategy} on {len(X_new)} rows in {report['refresh_seconds']:.2f}s")
+    return refreshed, report | {"encoder": encoder}
+
+
+def load_logged_model(model_uri: str) -> tuple:
+    """Model logged to MLflow and its flavor, 'xgboost' or 'sklearn'."""
+    import mlflow
+
+    flavor = "xgboost" if "xgboost" in mlflow.models.get_model_info(model_uri).flavors else "sklearn"
+    return getattr(mlflow, flavor).load_model(model_uri), flavor
+
+
+def log_refreshed_model(model, report: dict, flavor: str, parent_uri: str, year: int) -> str:
+    """
+    Logs the refreshed model with its report as a new run in the experiment of the old model.
+
+    Returns:
+        str: URI of the new model.
+    """
+    import tempfile
+
+    import mlflow
+
+    from modeling.tracking import AsyncTracker
+
+    parent_run_id = mlflow.models.get_model_info(parent_uri).run_id
+    experiment_id = mlflow.get_run(parent_run_id).info.experiment_id if parent_run_id else None
+    seconds = {key: report[key] for key in ("refresh_seconds", "full_refit_seconds") if key in report}
+    with mlflow.start_run(experiment_id=experiment_id, run_name=f"refresh_{year}") as run, AsyncTracker() as tracker:
+        tracker.set_tag("refreshed_from", parent_uri)
+        tracker.log_params({"year": year, "strategy": report["strategy"], "reason": report["reason"], "new_rows": report["new_rows"]})
+        tracker.log_metrics(seconds | {f"psi_{col}": value for col, value in report["drift"].items()})
+        getattr(mlflow, flavor).log_model(model, "model")
+        if report["encoder"] is not None:
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, "encoder.json")
+                report["encoder"].save(path)
+                mlflow.log_artifact(path)
+    return f"runs:/{run.info.run_id}/model"
+
+
+def split_year(X: pd.DataFrame, y, year: int, time_column: str) -> tuple:
+    """(X_history, y_history, X_new, y_new): the rows before the year and the rows of the year."""
+    y = np.asarray(y)
+    history, new = (X[time_column] < year).to_numpy(), (X[time_column] == year).to_numpy()
+    if not new.any():
+        raise ValueError(f"No rows of {year} in the data")
+    return X[history], y[history], X[new], y[new]
+
+
+def print_report(report: dict):
+    print(f"strategy: {report['strategy']}" + (f" ({report['reason']})" if report["reason"] else ""))
+    print(f"new rows: {report['new_rows']:,}, largest PSI: {report['drift'].index[0]} {report['drift'].iloc[0]:.3f}")
+    if "refresh_seconds" in report:
+        print(f"refresh: {report['refresh_seconds']:.2f}s")
+    if "full_refit_seconds" in report:
+        print(f"full refit: {report['full_refit_seconds']:.2f}s")
+    if "refresh_seconds" in report and "full_refit_seconds" in report:
+        print(f"speedup: {report['full_refit_seconds'] / report['refresh_seconds']:.1f}x")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, description="Refresh a model with the rows of a new year")
+    parser.add_argument("model", help="MLflow model URI or directory of a dropout-risk bundle")
+    parser.add_argument("data", help="All years, the synthetic population for MLflow models, dazubi_grouped_berufe for a bundle")
+    parser.add_argument("-y", "--year", type=int, required=True, help="The new year, earlier years are the history")
+    parser.add_argument("-n", "--rounds", type=int, help="New boosting rounds or trees, default 10%% of the existing ones")
+    parser.add_argument("--threshold", type=float, default=PSI_THRESHOLD, help="Largest PSI that is refreshed instead of refit")
+    parser.add_argument("--compare", action="store_true", help="Also time the full refit on all years")
+    parser.add_argument("-o", "--output", help="Directory of the refreshed bundle, default <model>_<year>")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    import logging
+
+    logging.basicConfig(format="%(asctime)s: %(message)s", level=logging.INFO)
+    args = parse_arguments()
+
+    if os.path.exists(os.path.join(args.model, "meta.json")):
+        bundle = DropoutRiskModel.load(args.model)
+        table = training_table(pd.read_csv(args.data))
+        parts = split_year(table[FEATURES], table["dropout_rate"], args.year, "Jahr")
+        model, report = refresh(bundle.model, *parts, n_rounds=args.rounds, threshold=args.threshold, encoder=bundle.encoder, compare=args.compare)
+        output = args.output or f"{args.model.rstrip('/')}_{args.year}"
+        DropoutRiskModel(model, report["encoder"]).save(output)
+        logger.info(f"Saved the refreshed model to {output}")
+    else:
+        import mlflow
+
+        from modeling.config import TRACKING_URI
+
+        mlflow.set_tracking_uri(TRACKING_URI)
+        old_model, flavor = load_logged_model(args.model)
+        df = pd.read_csv(args.data, index_col=0)
+        y = df.pop("dropped_out").to_numpy()
+        parts = split_year(df, y, args.year, "year")
+        # the notebook encodes all columns except the year for the models without a pipeline
+        encoder = None if isinstance(old_model, Pipeline) else CategoricalEncoderRegistry(columns=[col for col in df.columns if col != "year"]).fit(parts[0])
+        model, report = refresh(old_model, *parts, n_rounds=args.rounds, threshold=args.threshold, encoder=encoder, compare=args.compare)
+        logger.info(f"Logged the refreshed model as {log_refreshed_model(model, report, flavor, args.model, args.year)}")
+    print_report(report)
@@ -0,0 +1,261 @@
+"""
+Bootstrap confidence intervals and permutation p-values for dropout rates by group.
+
+Resampling the persons of the synthetic population one by one is slow: 10,000 bootstrap
+replicates of 10M persons are 10^11 random indices. For rates by group the persons only matter
+through the counts of a group table with the trainees `n` and the dropouts `dropouts` per group
+(state, school certificate, occupation, ...), so the replicates are drawn on the counts:
+
+- bootstrap: the persons of a group are resampled with replacement, so the dropouts of a
+  replicate are binomial(n, rate) per group (stratified bootstrap, the group sizes are fixed)
+- permutation test: permuting the dropout labels between the groups distributes the total number
+  of dropouts without replacement over the groups, a multivariate hypergeometric draw
+
+Both are exactly the distributions of the resampling of the individuals. For statistics that don't
+reduce to counts, `bootstrap_statistic` resamples index arrays in batches.
+
+The replicates are drawn in batches of `batch_size`, all replicates of a batch with one call of
+the generator (e.g. `rng.binomial(n, p, size=(batch_size, groups))`). A draw on the counts is so
+cheap that a process pool costs more than it saves, so `n_jobs` defaults to 1; more processes only
+pay off for expensive statistics of `bootstrap_statistic`. Every batch gets its own random stream
+from `np.random.SeedSequence(seed).spawn`, so the result only depends on the seed and not on the
+number of processes.
+
+Usage (run from the repository root):
+
+    python -m modeling.resampling data/synth_combined.csv --by state --replicates 10000
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+SEED = 42
+BATCH_SIZE = 1000
+# memory of the indices (and resampled arrays) of one batch of bootstrap_statistic
+MAX_BATCH_BYTES = 256 * 2**20
+
+
+def group_counts(df: pd.DataFrame, by: str, target: str = "dropped_out") -> pd.DataFrame:
+    """
+    Trainees and dropouts per group of a population with one row per person.
+
+    Returns:
+        pd.DataFrame: Index are the groups, columns 'n' and 'dropouts'.
+    """
+    grouped = df.groupby(by, observed=True)[target]
+    return pd.DataFrame({"n": grouped.size(), "dropouts": grouped.sum()}).astype(np.int64)
+
+
+def from_count_table(counts: pd.DataFrame, n: str = "new", dropouts: str = "terminated") -> pd.DataFrame:
+    """Converts a (weighted) table of `modeling.count_stats.count_table` into integer group counts."""
+    return pd.DataFrame({"n": np.rint(counts[n]), "dropouts": np.rint(counts[dropouts])}, index=counts.index).astype(np.int64)
+
+
+def _draw_binomial(seed, size: int, n: np.ndarray, p: np.ndarray) -> np.ndarray:
+    return np.random.default_rng(seed).binomial(n, p, size=(size, len(n)))
+
+
+def _draw_hypergeometric(seed, size: int, colors: np.ndarray, nsample: int) -> np.ndarray:
+    return np.random.default_rng(seed).multivariate_hypergeometric(colors, nsample, size=size)
+
+
+def _draw_statistic(seed, size: int, arrays: tuple, statistic, vectorized: bool) -> np.ndarray:
+    # the indices of all replicates of the batch in one draw, shape (size, n)
+    indices = np.random.default_rng(seed).integers(0, len(arrays[0]), size=(size, len(arrays[0])))
+    if vectorized:
+        return np.asarray(statistic(*(array[indices] for array in arrays)))
+    return np.asarray([statistic(*(array[row] for array in arrays)) for row in indices])
+
+
+def replicate(draw, n_replicates: int, *args, seed: int = SEED, batch_size: int = BATCH_SIZE, n_jobs: int = 1) -> np.ndarray:
+    """
+    Calls `draw(seed_sequence, size, *args)` for batches of replicates and stacks the results.
+
+    Args:
+        draw: Picklable function that returns an array with `size` replicates in the first axis.
+        n_replicates (int): Total number of replicates.
+        seed (int): Root seed, every batch gets a child of `np.random.SeedSequence(seed)`.
+        batch_size (int): Replicates per batch.
+        n_jobs (int, optional): Number of processes, None for the number of cores. With 1 no pool is used.
+
+    Returns:
+        np.ndarray: The replicates, independent of n_jobs.
+    """
+    sizes = [batch_size] * (n_replicates // batch_size)
+    if n_replicates % batch_size:
+        sizes.append(n_replicates % batch_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    n_jobs = min(n_jobs or os.cpu_count() or 1, len(sizes))
+    if n_jobs <= 1:
+        return np.concatenate([draw(s, size, *args) for s, size in zip(seeds, sizes)])
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        futures = [executor.submit(draw, s, size, *args) for s, size in zip(seeds, sizes)]
+        return np.concatenate([future.result() for future in futures])
+
+
+def bootstrap_rates(counts: pd.DataFrame, n_replicates: int = 10_000, confidence: float = 0.95, **kwargs) -> pd.DataFrame:
+    """
+    Bootstrap confidence intervals of the dropout rate of each group and of its difference to all other groups.
+
+    Args:
+        counts (pd.DataFrame): Columns 'n' and 'dropouts' per group, see `group_counts`.
+        n_replicates (int): Number of bootstrap replicates.
+        confidence (float): Level of the percentile intervals.
+        **kwargs: seed, batch_size and n_jobs of `replicate`.
+
+    Returns:
+        pd.DataFrame: Per group the rate, its interval (rate_low, rate_high), the difference to the rate of
+            all other groups (diff_to_rest) and its interval (diff_low, diff_high).
+    """
+    n = counts["n"].to_numpy(dtype=np.int64)
+    k = counts["dropouts"].to_numpy(dtype=np.int64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rates = k / n
+    dropouts = replicate(_draw_binomial, n_replicates, n, np.nan_to_num(rates), **kwargs)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        replicate_rates = dropouts / n
+        rest = (dropouts.sum(axis=1, keepdims=True) - dropouts) / (n.sum() - n)
+        diff_to_rest = (k / n) - (k.sum() - k) / (n.sum() - n)
+    alpha = (1 - confidence) / 2
+    rate_low, rate_high = np.nanquantile(replicate_rates, [alpha, 1 - alpha], axis=0)
+    diff_low, diff_high = np.nanquantile(replicate_rates - rest, [alpha, 1 - alpha], axis=0)
+    return pd.DataFrame(
+        {
+            "n": n, "dropouts": k, "rate": rates, "rate_low": rate_low, "rate_high": rate_high,
+            "diff_to_rest": diff_to_rest, "diff_low": diff_low, "diff_high": diff_high,
+        },
+        index=counts.index,
+    )
+
+
+def rate_difference_ci(counts: pd.DataFrame, a, b, n_replicates: int = 10_000, confidence: float = 0.95, **kwargs) -> tuple:
+    """
+    Bootstrap interval of the difference of the dropout rates of the groups a and b.
+
+    Returns:
+        tuple: (difference, low, high)
+    """
+    pair = counts.loc[[a, b]]
+    n = pair["n"].to_numpy(dtype=np.int64)
+    k = pair["dropouts"].to_numpy(dtype=np.int64)
+    dropouts = replicate(_draw_binomial, n_replicates, n, k / n, **kwargs)
+    differences = dropouts[:, 0] / n[0] - dropouts[:, 1] / n[1]
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(differences, [alpha, 1 - alpha])
+    return k[0] / n[0] - k[1] / n[1], low, high
+
+
+def _chi2_statistic(dropouts: np.ndarray, n: np.ndarray) -> np.ndarray:
+    """chi² statistic of the groups x (dropout, no dropout) table for every row of dropouts."""
+    total_rate = dropouts.sum(axis=-1, keepdims=True) / n.sum()
+    expected = n * total_rate
+    with np.errstate(divide="ignore", invalid="ignore"):
+        terms = (dropouts - expected) ** 2 / expected + (dropouts - expected) ** 2 / (n - expected)
+    return np.nansum(terms, axis=-1)
+
+
+def permutation_test(counts: pd.DataFrame, n_replicates: int = 10_000, **kwargs) -> pd.DataFrame:
+    """
+    Permutation test of the dropout rates between the groups.
+
+    Under the null hypothesis the group doesn't matter, the dropout labels are permuted between all
+    persons. Per group the p-value is two-sided for the difference of its rate to all other groups,
+    the p-value of the chi² statistic over all groups is in `result.attrs`.
+
+    Args:
+        counts (pd.DataFrame): Columns 'n' and 'dropouts' per group, see `group_counts`.
+        n_replicates (int): Number of permutations.
+        **kwargs: seed, batch_size and n_jobs of `replicate`.
+
+    Returns:
+        pd.DataFrame: Per group the rate, diff_to_rest and pvalue. attrs: 'chi2', 'chi2_pvalue', 'n_replicates'.
+    """
+    n = counts["n"].to_numpy(dtype=np.int64)
+    k = counts["dropouts"].to_numpy(dtype=np.int64)
+    total, total_k = n.sum(), k.sum()
+    dropouts = replicate(_draw_hypergeometric, n_replicates, n, int(total_k), **kwargs)
+
+    def diff_to_rest(d):
+        return d / n - (total_k - d) / (total - n)
+
+    observed = diff_to_rest(k)
+    # the observed arrangement is one of the permutations, so the p-values are never 0
+    exceedances = (np.abs(diff_to_rest(dropouts)) >= np.abs(observed) - 1e-12).sum(axis=0)
+    chi2 = _chi2_statistic(k, n)
+    chi2_exceedances = (_chi2_statistic(dropouts, n) >= chi2 - 1e-9).sum()
+    result = pd.DataFrame(
+        {"n": n, "dropouts": k, "rate": k / n, "diff_to_rest": observed, "pvalue": (exceedances + 1) / (n_replicates + 1)},
+        index=counts.index,
+    )
+    result.attrs.update(chi2=float(chi2), chi2_pvalue=float((chi2_exceedances + 1) / (n_replicates + 1)), n_replicates=n_replicates)
+    return result
+
+
+def bootstrap_statistic(arrays, statistic, n_replicates: int = 1000, confidence: float = 0.95, vectorized: bool = False, **kwargs) -> tuple:
+    """
+    Percentile bootstrap of any statistic of the persons by resampling index arrays.
+
+    A batch holds batch_size x len(arrays[0]) indices (and resampled values, if vectorized). By
+    default batch_size is chosen so that a batch takes at most MAX_BATCH_BYTES, for 10M persons
+    that is 3 replicates per batch instead of 1000 (80 GB of indices).
+
+    Args:
+        arrays: Tuple of arrays of the same length, resampled with the same indices.
+        statistic: Picklable function of the resampled arrays, e.g. `np.mean`.
+        vectorized (bool): statistic takes the arrays of a whole batch with the replicates in the
+            rows and reduces the last axis, e.g. `functools.partial(np.mean, axis=-1)`, instead of
+            being called once per replicate.
+        **kwargs: seed, batch_size and n_jobs of `replicate`.
+
+    Returns:
+        tuple: (statistic, low, high)
+    """
+    arrays = tuple(np.asarray(array) for array in arrays)
+    if "batch_size" not in kwargs:
+        # int64 indices, a vectorized statistic also gets the resampled arrays of the whole batch
+        bytes_per_value = np.dtype(np.int64).itemsize + (sum(array.itemsize for array in arrays) if vectorized else 0)
+        bytes_per_replicate = len(arrays[0]) * bytes_per_value
+        kwargs["batch_size"] = int(np.clip(MAX_BATCH_BYTES // max(bytes_per_replicate, 1), 1, BATCH_SIZE))
+    replicates = replicate(_draw_statistic, n_replicates, arrays, statistic, vectorized, **kwargs)
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(replicates, [alpha, 1 - alpha], axis=0)
+    return statistic(*arrays), low, high
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Bootstrap intervals and permutation p-values of the dropout rates by group",
+    )
+    parser.add_argument("data", nargs="?", default="data/synth_combined.csv", help="CSV file of the synthetic population")
+    parser.add_argument("-b", "--by", default="state", help="Column of the groups, e.g. state, education, sector")
+    parser.add_argument("-r", "--replicates", type=int, default=10_000)
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of processes")
+    parser.add_argument("-s", "--seed", type=int, default=SEED)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    df = pd.read_csv(args.data, usecols=[args.by, "dropped_out"])
+    counts = group_counts(df, args.by)
+    options = {"seed": args.seed, "n_jobs": args.jobs}
+
+    start = time.perf_counter()
+    intervals = bootstrap_rates(counts, args.replicates, **options)
+    bootstrap_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    permutation = permutation_test(counts, args.replicates, **options)
+    permutation_seconds = time.perf_counter() - start
+
+    intervals["pvalue"] = permutation["pvalue"]
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(intervals.to_string(float_format="{:.4f}".format))
+    print(
+        f"{len(df):,} persons, {args.replicates:,} replicates: bootstrap {bootstrap_seconds:.2f}s, "
+        f"permutation {permutation_seconds:.2f}s, chi² = {permutation.attrs['chi2']:.2f} (p = {permutation.attrs['chi2_pvalue']:.4f})"
+    )
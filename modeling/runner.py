@@ -0,0 +1,257 @@
+"""
+Trains several models in parallel and compares them.
+
+The models are described declaratively, e.g.
+
+    {"name": "random_forest", "estimator": "sklearn.ensemble.RandomForestClassifier",
+     "params": {"n_estimators": 100}, "encoding": "ordinal", "threads": 2}
+
+- estimator: import path of the class
+- params: parameters of the estimator
+- encoding: 'onehot' or 'ordinal' encoding of the categorical columns, the numerical columns are passed through
+- categorical: only for 'ordinal', pass the positions of the encoded columns as `categorical_features`
+  (HistGradientBoostingClassifier)
+- threads: number of threads the model may use (default 1)
+
+Every model is trained in its own process of a process pool. The thread pools of numpy, OpenMP
+and the estimators are limited to the `threads` of the spec, so the processes don't oversubscribe
+the cores. With tracking, every model is logged as nested MLflow run below one parent run, which
+also gets the comparison table as artifact.
+
+Usage (run from the repository root):
+
+    python -m modeling.runner data/synth_combined.csv --jobs 4
+    python -m modeling.runner data/synth_combined.csv --specs my_models.json --no-tracking
+"""
+import argparse
+import importlib
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from logging import getLogger
+
+import numpy as np
+import pandas as pd
+from sklearn.compose import ColumnTransformer
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OneHotEncoder, OrdinalEncoder
+from threadpoolctl import threadpool_limits
+
+from modeling.aggregation import classification_metrics
+
+logger = getLogger(__name__)
+
+SEED = 42
+
+DEFAULT_SPECS = [
+    {
+        "name": "logistic_regression",
+        "estimator": "sklearn.linear_model.LogisticRegression",
+        "params": {"max_iter": 500, "random_state": SEED},
+        "encoding": "onehot",
+    },
+    {
+        "name": "hist_gradient_boosting",
+        "estimator": "sklearn.ensemble.HistGradientBoostingClassifier",
+        "params": {"random_state": SEED},
+        "encoding": "ordinal",
+        "categorical": True,
+        "threads": 2,
+    },
+    {
+        "name": "random_forest",
+        "estimator": "sklearn.ensemble.RandomForestClassifier",
+        "params": {"n_estimators": 100, "max_depth": 10, "random_state": SEED},
+        "encoding": "ordinal",
+        "threads": 2,
+    },
+    {
+        "name": "xgboost",
+        "estimator": "xgboost.XGBClassifier",
+        "params": {"random_state": SEED, "eval_metric": "logloss"},
+        "encoding": "ordinal",
+        "threads": 2,
+    },
+    {
+        "name": "knn",
+        "estimator": "modeling.knn.HammingKNeighborsClassifier",
+        "params": {"n_neighbors": 5},
+        "encoding": "ordinal",
+    },
+]
+
+
+def build_pipeline(spec: dict, cat_columns: list) -> Pipeline:
+    """Creates the encoder and the estimator of a spec as Pipeline."""
+    module_name, class_name = spec["estimator"].rsplit(".", 1)
+    estimator_class = getattr(importlib.import_module(module_name), class_name)
+    params = dict(spec.get("params", {}))
+    threads = spec.get("threads", 1)
+    if "n_jobs" in estimator_class().get_params():
+        params.setdefault("n_jobs", threads)
+
+    encoding = spec.get("encoding", "ordinal")
+    if encoding == "onehot":
+        encoder = OneHotEncoder(drop="first", handle_unknown="ignore")
+    elif encoding == "ordinal":
+        encoder = OrdinalEncoder(handle_unknown="use_encoded_value", unknown_value=-1)
+        if spec.get("categorical"):
+            # the encoded columns come first in the output of the ColumnTransformer
+            params["categorical_features"] = list(range(len(cat_columns)))
+    else:
+        raise ValueError(f"Unknown encoding {encoding!r} of model {spec['name']}")
+    preprocessing = ColumnTransformer([("encode", encoder, cat_columns)], remainder="passthrough")
+    return Pipeline([("preprocessing", preprocessing), ("model", estimator_class(**params))])
+
+
+_data = {}
+
+
+def _init_worker(X_train, y_train, X_test, y_test):
+    # the data is sent once per process instead of once per model
+    _data.update(X_train=X_train, y_train=y_train, X_test=X_test, y_test=y_test)
+
+
+def _train_and_evaluate(spec: dict, cat_columns: list) -> dict:
+    with threadpool_limits(limits=spec.get("threads", 1)):
+        pipeline = build_pipeline(spec, cat_columns)
+        start = time.perf_counter()
+        pipeline.fit(_data["X_train"], _data["y_train"])
+        fit_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        y_train_pred = pipeline.predict(_data["X_train"])
+        y_test_pred = pipeline.predict(_data["X_test"])
+        predict_seconds = time.perf_counter() - start
+
+    metrics = {f"train-{key}": value for key, value in classification_metrics(_data["y_train"], y_train_pred).items()}
+    metrics.update({f"test-{key}": value for key, value in classification_metrics(_data["y_test"], y_test_pred).items()})
+    metrics.update(fit_seconds=fit_seconds, predict_seconds=predict_seconds)
+    return {"name": spec["name"], "spec": spec, "metrics": metrics, "pid": os.getpid()}
+
+
+def _log_nested_run(result: dict):
+    import mlflow
+
+    from modeling.tracking import AsyncTracker
+
+    spec = result["spec"]
+    with mlflow.start_run(run_name=result["name"], nested=True), AsyncTracker() as tracker:
+        tracker.log_params(spec.get("params", {}))
+        tracker.log_params({"estimator": spec["estimator"], "encoding": spec.get("encoding", "ordinal"), "threads": spec.get("threads", 1)})
+        tracker.log_metrics(result["metrics"])
+
+
+def run_models(specs: list, X_train: pd.DataFrame, y_train, X_test: pd.DataFrame, y_test, num_columns=("year",), n_jobs: int = None, tracking: bool = True) -> pd.DataFrame:
+    """
+    Trains and evaluates the models of the specs concurrently.
+
+    Args:
+        specs (list): Model specs, see the module docstring.
+        num_columns: Columns that are not encoded.
+        n_jobs (int, optional): Number of processes, defaults to the number of cores divided by the
+            largest number of threads of a spec.
+        tracking (bool): Log a parent run with one nested run per model. The tracking URI and the
+            experiment have to be set before.
+
+    Returns:
+        pd.DataFrame: Comparison table with one row per model, sorted by the F1 score on the test data.
+    """
+    names = [spec["name"] for spec in specs]
+    if len(set(names)) != len(names):
+        raise ValueError(f"The names of the specs are not unique: {names}")
+    cat_columns = [col for col in X_train.columns if col not in num_columns]
+    if n_jobs is None:
+        n_jobs = max(1, (os.cpu_count() or 1) // max(spec.get("threads", 1) for spec in specs))
+    n_jobs = min(n_jobs, len(specs))
+
+    parent = None
+    if tracking:
+        import mlflow
+
+        parent = mlflow.start_run(run_name="model_zoo")
+    try:
+        results = []
+        start = time.perf_counter()
+        with ProcessPoolExecutor(
+            max_workers=n_jobs, initializer=_init_worker, initargs=(X_train, np.asarray(y_train), X_test, np.asarray(y_test))
+        ) as executor:
+            futures = [executor.submit(_train_and_evaluate, spec, cat_columns) for spec in specs]
+            for future in as_completed(futures):
+                result = future.result()
+                logger.info(f"{result['name']}: test-f1 = {result['metrics']['test-f1']:.3f}, fit in {result['metrics']['fit_seconds']:.1f}s")
+                if tracking:
+                    _log_nested_run(result)
+                results.append(result)
+        wall_seconds = time.perf_counter() - start
+
+        table = pd.DataFrame([{"model": r["name"], **r["metrics"]} for r in results])
+        table = table.sort_values("test-f1", ascending=False).reset_index(drop=True)
+        table.attrs.update(wall_seconds=wall_seconds, sequential_seconds=float(table["fit_seconds"].sum() + table["predict_seconds"].sum()), n_jobs=n_jobs)
+        logger.info(
+            "{} models in {:.1f}s wall time with {} processes, {:.1f}s when run one after another".format(
+                len(table), wall_seconds, n_jobs, table.attrs["sequential_seconds"]
+            )
+        )
+        if tracking:
+            import mlflow
+
+            mlflow.log_metric("wall_seconds", wall_seconds)
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                path = os.path.join(tmp_dir, "model_comparison.csv")
+                table.to_csv(path, index=False)
+                mlflow.log_artifact(path)
+        return table
+    finally:
+        if parent is not None:
+            import mlflow
+
+            mlflow.end_run()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Train the model zoo in parallel and compare the models",
+    )
+    parser.add_argument("data", nargs="?", default="data/synth_combined.csv", help="CSV file of the synthetic population")
+    parser.add_argument("-s", "--specs", help="JSON file with a list of model specs, default is the built-in zoo")
+    parser.add_argument("-j", "--jobs", type=int, help="Number of processes")
+    parser.add_argument("--no-tracking", action="store_true", help="Don't log to MLflow")
+    parser.add_argument("-o", "--output", help="Save the comparison table as CSV")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    import logging
+
+    from sklearn.model_selection import train_test_split
+
+    logging.basicConfig(format="%(asctime)s: %(message)s", level=logging.INFO)
+
+    args = parse_arguments()
+    specs = DEFAULT_SPECS
+    if args.specs:
+        with open(args.specs) as file:
+            specs = json.load(file)
+
+    df = pd.read_csv(args.data, index_col=0)
+    col_target = "dropped_out"
+    X = df.drop(col_target, axis=1)
+    y = df[col_target].to_numpy()
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, stratify=y, random_state=SEED)
+
+    if not args.no_tracking:
+        import mlflow
+
+        from modeling.config import TRACKING_URI
+
+        mlflow.set_tracking_uri(TRACKING_URI)
+        mlflow.set_experiment(experiment_name="model_zoo")
+
+    table = run_models(specs, X_train, y_train, X_test, y_test, n_jobs=args.jobs, tracking=not args.no_tracking)
+    print(table.to_string())
+    if args.output:
+        table.to_csv(args.output, index=False)
@@ -0,0 +1,133 @@
+"""
+Hyperparameter search with cached feature encoding.
+
+In `model_pipeline.ipynb` the OneHotEncoder is fitted and applied again for every candidate of
+the HalvingGridSearchCV, although it only depends on the fold. With the `memory` argument of the
+Pipeline the fitted encoder and its output are cached with joblib, the key is a hash of the
+encoder parameters and the data of the fold. All candidates of the same fold then reuse the
+encoded sparse (CSR) matrix, only the model is fitted per candidate.
+
+Hashing the data is much faster for categorical columns than for python strings, so the
+features should be converted with `to_categorical` first.
+
+Usage (run from the repository root):
+
+    python -m modeling.search data/synth_combined.csv
+"""
+from logging import getLogger
+import tempfile
+import time
+
+import pandas as pd
+from joblib import Memory
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import HalvingGridSearchCV
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OneHotEncoder
+
+logger = getLogger(__name__)
+
+CACHE_DIR = ".cache/pipeline"
+
+
+def to_categorical(X: pd.DataFrame) -> pd.DataFrame:
+    """Converts all string columns to the pandas category dtype."""
+    columns = X.select_dtypes(["object", "string"]).columns
+    return X.astype({col: "category" for col in columns})
+
+
+def make_onehot_pipeline(memory=None, **logreg_params) -> Pipeline:
+    """
+    The pipeline of `model_pipeline.ipynb`: one-hot encoding and logistic regression.
+
+    Args:
+        memory: Location of the cache (str or joblib.Memory) or None to disable caching.
+        **logreg_params: Parameters of the LogisticRegression.
+
+    Returns:
+        Pipeline: The encoder produces a sparse CSR matrix, which is passed to the model as is.
+    """
+    return Pipeline(
+        [
+            ("enc_onehot", OneHotEncoder(drop="first", sparse_output=True, handle_unknown="ignore")),
+            ("model_logreg", LogisticRegression(**logreg_params)),
+        ],
+        memory=memory,
+    )
+
+
+def timed_search(pipe: Pipeline, param_grid, X, y, **search_params) -> tuple[HalvingGridSearchCV, float]:
+    """
+    Runs a HalvingGridSearchCV and measures the wall time.
+
+    Returns:
+        tuple: (fitted search, seconds)
+    """
+    search = HalvingGridSearchCV(pipe, param_grid, **search_params)
+    start = time.perf_counter()
+    search.fit(X, y)
+    return search, time.perf_counter() - start
+
+
+def compare_search_time(param_grid, X, y, cache_dir: str = None, **search_params) -> dict:
+    """
+    Runs the same search without and with cached encoding and reports the wall times.
+
+    Args:
+        param_grid: Grid for the parameters of the pipeline steps ('model_logreg__C', ...).
+        cache_dir (str): Directory of the cache, a temporary directory is used if None.
+            An existing cache would make the cached run look faster than it is.
+        **search_params: Passed to HalvingGridSearchCV, e.g. cv, scoring, n_jobs.
+
+    Returns:
+        dict: Wall times, speedup and whether both searches found the same parameters.
+    """
+    X = to_categorical(X)
+    search_params.setdefault("random_state", 42)
+    search_uncached, time_uncached = timed_search(make_onehot_pipeline(), param_grid, X, y, **search_params)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        memory = Memory(cache_dir or tmp_dir, verbose=0)
+        search, time_cached = timed_search(make_onehot_pipeline(memory), param_grid, X, y, **search_params)
+        memory.clear(warn=False)
+    return {
+        "time_uncached": time_uncached,
+        "time_cached": time_cached,
+        "speedup": time_uncached / time_cached,
+        "same_best_params": search.best_params_ == search_uncached.best_params_,
+        "best_params": search.best_params_,
+    }
+
+
+if __name__ == "__main__":
+    import logging
+    import sys
+
+    from sklearn.model_selection import train_test_split
+
+    logging.basicConfig(format="%(asctime)s: %(message)s", level=logging.INFO)
+
+    path = sys.argv[1] if len(sys.argv) > 1 else "data/synth_combined.csv"
+    df = pd.read_csv(path, index_col=0)
+    col_target = "dropped_out"
+    X = df.drop(col_target, axis=1)
+    y = df[col_target].to_numpy()
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, stratify=y, random_state=42)
+
+    # param3 of model_pipeline.ipynb
+    param_grid = [
+        {
+            "model_logreg__penalty": ["elasticnet"],
+            "model_logreg__C": [0.6, 0.8, 1.0, 10, 100],
+            "model_logreg__l1_ratio": [0.1, 0.25, 0.5, 0.75, 0.9],
+            "model_logreg__solver": ["saga"],
+            "model_logreg__max_iter": [200, 500, 1000],
+        }
+    ]
+    result = compare_search_time(
+        param_grid, X_train, y_train, cv=5, aggressive_elimination=True, scoring="f1", n_jobs=-1
+    )
+    logger.info(
+        "search without cache: {time_uncached:.1f}s, with cache: {time_cached:.1f}s, "
+        "speedup: {speedup:.2f}x, same best parameters: {same_best_params}".format(**result)
+    )
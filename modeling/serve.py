@@ -0,0 +1,290 @@
+"""
+Local HTTP service for the dropout risk with micro-batching of concurrent requests.
+
+The model bundle of `modeling/dropout_risk.py` is loaded once. Requests are JSON, a single
+request or a list of them:
+
+    POST /predict  {"region": "Bayern", "occupation": "Koch/Köchin", "year": 2024, "certificate": "Realschule"}
+    -> {"risk": [0.27]}
+
+    POST /predict  [{...}, {...}]
+    -> {"risk": [0.27, 0.19]}
+
+    GET /health -> {"status": "ok"}
+    GET /stats  -> number of model calls (batches) and rows per call
+
+Every request is answered by its own thread of the `ThreadingHTTPServer`, but the threads don't
+call the model themselves. They put their rows into the queue of the `MicroBatcher` and wait. One
+worker thread takes everything that arrived within `max_wait_ms` after the first queued request
+(at most `max_batch_size` rows) and scores it with one vectorized call, the per-call overhead of
+XGBoost and the encoding is shared by all requests of the batch.
+
+Usage (run from the repository root):
+
+    python -m modeling.serve models/dropout_risk --port 8000
+    python -m modeling.serve models/dropout_risk --benchmark --requests 5000 --concurrency 32
+"""
+import argparse
+import http.client
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import getLogger
+
+import numpy as np
+
+from modeling.dropout_risk import DropoutRiskModel
+
+logger = getLogger(__name__)
+
+
+class MicroBatcher:
+    """
+    Collects the records of concurrent requests and scores them together.
+
+    Args:
+        predict: Function of a list of records that returns one value per record.
+        max_batch_size (int): Maximum number of records per call of predict.
+        max_wait_ms (float): How long the first request of a batch waits for more requests.
+    """
+
+    def __init__(self, predict, max_batch_size: int = 1024, max_wait_ms: float = 2.0):
+        self.predict = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        # running totals for /stats, a list of all batch sizes would grow without bound
+        self.batches = 0
+        self.rows = 0
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, records: list) -> Future:
+        """Queues the records of one request, the future gets their predictions."""
+        future = Future()
+        self.queue.put((records, future))
+        return future
+
+    def _collect(self) -> list:
+        items = [self.queue.get()]
+        size = len(items[0][0])
+        deadline = time.perf_counter() + self.max_wait
+        while size < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            items.append(item)
+            size += len(item[0])
+        return items
+
+    def _run(self):
+        while True:
+            items = self._collect()
+            records = [record for request, _ in items for record in request]
+            self.batches += 1
+            self.rows += len(records)
+            try:
+                predictions = np.asarray(self.predict(records), dtype=float)
+            except Exception as error:
+                # a bad record fails its whole batch, score the requests one by one to find it
+                if len(items) == 1:
+                    items[0][1].set_exception(error)
+                    continue
+                for request, future in items:
+                    try:
+                        future.set_result(np.asarray(self.predict(request), dtype=float))
+                    except Exception as request_error:
+                        future.set_exception(request_error)
+                continue
+            start = 0
+            for request, future in items:
+                future.set_result(predictions[start:start + len(request)])
+                start += len(request)
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    # keep-alive, the load generator reuses its connections
+    protocol_version = "HTTP/1.1"
+    # headers and body are two writes, with Nagle the body waits for the delayed ACK of the client
+    disable_nagle_algorithm = True
+    batcher: MicroBatcher = None
+
+    def _send(self, status: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send(200, {"status": "ok"})
+        elif self.path == "/stats":
+            batches, rows = self.batcher.batches, self.batcher.rows
+            self._send(200, {"batches": batches, "rows": rows, "mean_batch_rows": rows / batches if batches else 0.0})
+        else:
+            self._send(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/predict":
+            self._send(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            records = body if isinstance(body, list) else [body]
+            risk = self.batcher.submit(records).result() if records else []
+        except (ValueError, KeyError, TypeError) as error:
+            self._send(400, {"error": str(error)})
+            return
+        except Exception as error:
+            logger.exception("Prediction failed")
+            self._send(500, {"error": str(error)})
+            return
+        self._send(200, {"risk": [round(float(value), 6) for value in risk]})
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class PredictionServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # the default backlog of 5 resets connections when many clients connect at once
+    request_queue_size = 128
+
+
+def make_server(model: DropoutRiskModel, host: str = "127.0.0.1", port: int = 8000, max_batch_size: int = 1024, max_wait_ms: float = 2.0) -> PredictionServer:
+    """HTTP server with its own batcher, port 0 picks a free port."""
+    batcher = MicroBatcher(model.predict_records, max_batch_size, max_wait_ms)
+    handler = type("BoundPredictionHandler", (PredictionHandler,), {"batcher": batcher})
+    server = PredictionServer((host, port), handler)
+    server.batcher = batcher
+    return server
+
+
+def sample_records(model: DropoutRiskModel, n: int, seed: int = 42) -> list:
+    """Random requests from the categories known to the model."""
+    rng = np.random.default_rng(seed)
+    categories = model.encoder.categories_
+    return [
+        {
+            "region": str(rng.choice(categories["Region"])),
+            "occupation": str(rng.choice(categories["Beruf_clean"])),
+            "year": int(rng.integers(2010, 2031)),
+            "certificate": str(rng.choice(categories["abschluss_cat"])),
+        }
+        for _ in range(n)
+    ]
+
+
+def load_test(host: str, port: int, records: list, n_requests: int = 5000, concurrency: int = 32, rows_per_request: int = 1) -> dict:
+    """
+    Sends n_requests POST requests from `concurrency` threads with one keep-alive connection each.
+
+    Returns:
+        dict: Requests and rows per second and the p50/p99 latency in milliseconds.
+    """
+    bodies = [json.dumps(records[i % len(records):i % len(records) + rows_per_request]).encode() for i in range(0, n_requests * rows_per_request, rows_per_request)]
+    per_thread = np.array_split(np.arange(n_requests), concurrency)
+
+    def client(indices) -> list:
+        connection = http.client.HTTPConnection(host, port)
+        latencies = []
+        for i in indices:
+            start = time.perf_counter()
+            connection.request("POST", "/predict", body=bodies[i], headers={"Content-Type": "application/json"})
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                raise RuntimeError(f"Request failed with status {response.status}")
+            latencies.append(time.perf_counter() - start)
+        connection.close()
+        return latencies
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = np.concatenate([np.asarray(result) for result in executor.map(client, per_thread)])
+    seconds = time.perf_counter() - start
+    return {
+        "requests": n_requests,
+        "seconds": seconds,
+        "requests_per_second": n_requests / seconds,
+        "rows_per_second": n_requests * rows_per_request / seconds,
+        "p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "p99_ms": float(np.percentile(latencies, 99) * 1000),
+    }
+
+
+def _serve(model_path: str, max_batch_size: int, max_wait_ms: float, addresses):
+    server = make_server(DropoutRiskModel.load(model_path), port=0, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+    addresses.put(server.server_address)
+    server.serve_forever()
+
+
+def benchmark_service(model_path: str, n_requests: int = 5000, concurrency: int = 32, rows_per_request: int = 1, max_wait_ms: float = 2.0) -> list:
+    """
+    Load test of the service with micro-batching and without (batches of one request).
+
+    The server runs in its own process, so the load generator doesn't compete with it for the GIL.
+    """
+    import multiprocessing
+
+    records = sample_records(DropoutRiskModel.load(model_path), 1000)
+    results = []
+    for name, max_batch_size in [("single", 1), ("micro-batch", 1024)]:
+        addresses = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_serve, args=(model_path, max_batch_size, max_wait_ms if max_batch_size > 1 else 0, addresses), daemon=True)
+        process.start()
+        try:
+            host, port = addresses.get(timeout=60)
+            result = load_test(host, port, records, n_requests, concurrency, rows_per_request)
+            connection = http.client.HTTPConnection(host, port)
+            connection.request("GET", "/stats")
+            stats = json.loads(connection.getresponse().read())
+            connection.close()
+        finally:
+            process.terminate()
+            process.join()
+        results.append({"mode": name, **result, "mean_batch_rows": stats["mean_batch_rows"]})
+    return results
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, description="Serve the dropout-risk model over HTTP")
+    parser.add_argument("model_path", nargs="?", default="models/dropout_risk", help="Directory of the bundle of modeling.dropout_risk")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch-size", type=int, default=1024, help="Maximum number of rows per model call")
+    parser.add_argument("--max-wait-ms", type=float, default=2.0, help="Time the first request of a batch waits for more")
+    parser.add_argument("--benchmark", action="store_true", help="Run the load generator against a local server instead")
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--rows-per-request", type=int, default=1)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    import logging
+
+    logging.basicConfig(format="%(asctime)s: %(message)s", level=logging.INFO)
+    args = parse_arguments()
+    if args.benchmark:
+        for result in benchmark_service(args.model_path, args.requests, args.concurrency, args.rows_per_request, args.max_wait_ms):
+            print(
+                "{mode:>12}: {requests_per_second:,.0f} requests/s, {rows_per_second:,.0f} rows/s, "
+                "p50 {p50_ms:.1f} ms, p99 {p99_ms:.1f} ms, {mean_batch_rows:.1f} rows per model call".format(**result)
+            )
+    else:
+        server = make_server(DropoutRiskModel.load(args.model_path), args.host, args.port, args.max_batch_size, args.max_wait_ms)
+        logger.info(f"Serving {args.model_path} on http://{args.host}:{args.port}/predict")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
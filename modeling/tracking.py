@@ -0,0 +1,339 @@
+"""
+Non-blocking MLflow logging.
+
+Every `mlflow.log_metric`, `mlflow.log_param` or `mlflow.log_figure` is a request to the tracking
+server, the training waits for each of them. `AsyncTracker` only puts the values into a queue and
+returns. A background thread collects them and sends them with one `log_batch` call per batch
+(MLflow accepts up to 1000 metrics, 100 params and 100 tags, and 1000 entities in total, per
+batch), artifacts are uploaded by the same thread. Figures are rendered to a PNG file in the
+calling thread, because matplotlib is not thread safe.
+
+If the tracking server can't be reached (connection errors, timeouts and 5xx responses), the data
+is written to a spool directory (`.mlflow_spool/<run_id>.jsonl` and the artifacts next to it) and
+can be sent later with `replay_spool`. After such a failure the tracker spools for
+`retry_interval` seconds without trying the server again, so a missing server doesn't slow down
+the training either. A request the server rejects (e.g. a param logged twice with different
+values) would be rejected again on replay, it is logged as an error and counted in
+`stats["rejected"]`, and the tracker stays online.
+
+Usage:
+
+    with mlflow.start_run(), AsyncTracker() as tracker:
+        tracker.log_params({"C": 1.0})
+        tracker.log_metric("test-f1", 0.8)
+
+    # with optuna, log the value and the numeric parameters of each trial as metrics
+    study.optimize(objective, n_trials=100, callbacks=[tracker.optuna_callback])
+
+Measure the overhead per trial compared with the blocking calls (run from the repository root):
+
+    python -m modeling.tracking
+"""
+import json
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from logging import getLogger
+
+import mlflow
+from mlflow.entities import Metric, Param, RunTag
+from mlflow.exceptions import MlflowException
+from mlflow.tracking import MlflowClient
+
+logger = getLogger(__name__)
+
+SPOOL_DIR = ".mlflow_spool"
+
+MAX_METRICS_PER_BATCH = 1000
+MAX_PARAMS_PER_BATCH = 100
+MAX_TAGS_PER_BATCH = 100
+MAX_ENTITIES_PER_BATCH = 1000
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def _server_unavailable(error: Exception) -> bool:
+    """True for errors of an unreachable or failing server, False if the server rejected the request."""
+    if isinstance(error, MlflowException):
+        # MLflow reports exhausted retries of a connection as INTERNAL_ERROR (500)
+        return error.get_http_status_code() >= 500
+    # ConnectionError and Timeout of requests are OSErrors
+    return isinstance(error, OSError)
+
+
+class AsyncTracker:
+    """
+    Queues metrics, params, tags and artifacts of one run and logs them in a background thread.
+
+    Args:
+        run_id (str, optional): Run to log to. Defaults to the active run.
+        spool_dir (str): Directory for the data that couldn't be sent to the server.
+        flush_interval (float): Maximum time in seconds values wait in the queue.
+        retry_interval (float): Time in seconds after a failure before the server is tried again.
+        client (MlflowClient, optional): Client for the tracking server.
+
+    Attributes:
+        stats (dict): Number of calls, time spent in the calling thread, number of batches and
+            artifacts sent, items written to the spool and items rejected by the server.
+    """
+
+    def __init__(self, run_id=None, spool_dir=SPOOL_DIR, flush_interval=1.0, retry_interval=60.0, client=None):
+        if run_id is None:
+            active_run = mlflow.active_run()
+            if active_run is None:
+                raise RuntimeError("No active run, start a run or pass a run_id")
+            run_id = active_run.info.run_id
+        self.run_id = run_id
+        self.spool_dir = spool_dir
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval
+        self.client = client or MlflowClient()
+        self.stats = {"calls": 0, "caller_seconds": 0.0, "batches": 0, "artifacts": 0, "spooled": 0, "rejected": 0}
+        self._tmp_dir = tempfile.mkdtemp(prefix="mlflow_tracker_")
+        self._queue = queue.Queue()
+        self._offline_until = 0.0
+        self._thread = threading.Thread(target=self._run, name="mlflow-tracker", daemon=True)
+        self._thread.start()
+
+    # ---- API of the calling thread ----
+
+    def _put(self, item):
+        start = time.perf_counter()
+        self._queue.put(item)
+        self.stats["calls"] += 1
+        self.stats["caller_seconds"] += time.perf_counter() - start
+
+    def log_metric(self, key: str, value: float, step: int = 0):
+        self._put(("metric", Metric(key, float(value), _now_ms(), step)))
+
+    def log_metrics(self, metrics: dict, step: int = 0):
+        timestamp = _now_ms()
+        for key, value in metrics.items():
+            self._put(("metric", Metric(key, float(value), timestamp, step)))
+
+    def log_param(self, key: str, value):
+        self._put(("param", Param(key, str(value))))
+
+    def log_params(self, params: dict):
+        for key, value in params.items():
+            self.log_param(key, value)
+
+    def set_tag(self, key: str, value):
+        self._put(("tag", RunTag(key, str(value))))
+
+    def log_artifact(self, local_path: str, artifact_path: str = None):
+        """Uploads a file. It is copied first, so the caller may delete or change it right away."""
+        start = time.perf_counter()
+        target = os.path.join(tempfile.mkdtemp(dir=self._tmp_dir), os.path.basename(local_path))
+        shutil.copy2(local_path, target)
+        self.stats["caller_seconds"] += time.perf_counter() - start
+        self._put(("artifact", target, artifact_path))
+
+    def log_figure(self, figure, artifact_file: str):
+        """Renders a matplotlib figure in the calling thread and uploads the image in the background."""
+        start = time.perf_counter()
+        directory, filename = os.path.split(artifact_file)
+        target = os.path.join(tempfile.mkdtemp(dir=self._tmp_dir), filename)
+        figure.savefig(target)
+        self.stats["caller_seconds"] += time.perf_counter() - start
+        self._put(("artifact", target, directory or None))
+
+    def optuna_callback(self, study, trial):
+        """Callback for `study.optimize`: logs the value and the numeric parameters with the trial number as step."""
+        metrics = {f"trial-{key}": value for key, value in trial.params.items() if isinstance(value, (int, float))}
+        if trial.value is not None:
+            metrics["trial-value"] = trial.value
+        self.log_metrics(metrics, step=trial.number)
+
+    def flush(self, timeout: float = None):
+        """Blocks until everything queued so far is sent or spooled."""
+        done = threading.Event()
+        self._queue.put(("flush", done))
+        done.wait(timeout)
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(("close", None))
+            self._thread.join()
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # ---- background thread ----
+
+    def _run(self):
+        metrics, params, tags = [], [], []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                kind, *payload = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                kind, payload = "timeout", None
+            if kind == "metric":
+                metrics.append(payload[0])
+            elif kind == "param":
+                params.append(payload[0])
+            elif kind == "tag":
+                tags.append(payload[0])
+            elif kind == "artifact":
+                self._send_artifact(*payload)
+            if deadline is None and (metrics or params or tags):
+                deadline = time.monotonic() + self.flush_interval
+            full = (
+                len(metrics) >= MAX_METRICS_PER_BATCH
+                or len(params) >= MAX_PARAMS_PER_BATCH
+                or len(tags) >= MAX_TAGS_PER_BATCH
+                or len(metrics) + len(params) + len(tags) >= MAX_ENTITIES_PER_BATCH
+            )
+            if full or kind in ("timeout", "flush", "close"):
+                self._send_batch(metrics, params, tags)
+                metrics, params, tags = [], [], []
+                deadline = None
+            if kind == "flush":
+                payload[0].set()
+            elif kind == "close":
+                return
+
+    def _online(self) -> bool:
+        return time.monotonic() >= self._offline_until
+
+    def _failed(self, error: Exception, n_items: int) -> bool:
+        """Goes offline if the server is unavailable and returns True, the caller spools then."""
+        if not _server_unavailable(error):
+            logger.error(f"MLflow rejected {n_items} items: {type(error).__name__} - {error}")
+            self.stats["rejected"] += n_items
+            return False
+        logger.warning(f"MLflow tracking failed, spooling to {self.spool_dir}: {type(error).__name__} - {error}")
+        self._offline_until = time.monotonic() + self.retry_interval
+        return True
+
+    def _send_batch(self, metrics: list, params: list, tags: list):
+        if not (metrics or params or tags):
+            return
+        if self._online():
+            try:
+                self.client.log_batch(self.run_id, metrics=metrics, params=params, tags=tags)
+                self.stats["batches"] += 1
+                return
+            except Exception as e:
+                if not self._failed(e, len(metrics) + len(params) + len(tags)):
+                    return
+        records = (
+            [{"type": "metric", "key": m.key, "value": m.value, "timestamp": m.timestamp, "step": m.step} for m in metrics]
+            + [{"type": "param", "key": p.key, "value": p.value} for p in params]
+            + [{"type": "tag", "key": t.key, "value": t.value} for t in tags]
+        )
+        self._spool(records)
+
+    def _send_artifact(self, local_path: str, artifact_path: str):
+        if self._online():
+            try:
+                self.client.log_artifact(self.run_id, local_path, artifact_path)
+                self.stats["artifacts"] += 1
+                return
+            except Exception as e:
+                if not self._failed(e, 1):
+                    return
+        target_dir = os.path.join(self.spool_dir, self.run_id, "artifacts", artifact_path or "")
+        os.makedirs(target_dir, exist_ok=True)
+        target = os.path.join(target_dir, os.path.basename(local_path))
+        shutil.copy2(local_path, target)
+        self._spool([{"type": "artifact", "local_path": target, "artifact_path": artifact_path}])
+
+    def _spool(self, records: list):
+        os.makedirs(self.spool_dir, exist_ok=True)
+        with open(os.path.join(self.spool_dir, f"{self.run_id}.jsonl"), "a") as file:
+            for record in records:
+                file.write(json.dumps(record) + "\n")
+        self.stats["spooled"] += len(records)
+
+
+def replay_spool(spool_dir: str = SPOOL_DIR, client: MlflowClient = None) -> int:
+    """
+    Sends the spooled data of all runs to the tracking server and removes it from the spool.
+
+    Returns:
+        int: Number of sent records.
+    """
+    client = client or MlflowClient()
+    if not os.path.isdir(spool_dir):
+        return 0
+    sent = 0
+    for filename in sorted(os.listdir(spool_dir)):
+        if not filename.endswith(".jsonl"):
+            continue
+        run_id = filename[: -len(".jsonl")]
+        with open(os.path.join(spool_dir, filename)) as file:
+            records = [json.loads(line) for line in file if line.strip()]
+        metrics = [Metric(r["key"], r["value"], r["timestamp"], r["step"]) for r in records if r["type"] == "metric"]
+        params = [Param(r["key"], r["value"]) for r in records if r["type"] == "param"]
+        tags = [RunTag(r["key"], r["value"]) for r in records if r["type"] == "tag"]
+        for start in range(0, len(metrics), MAX_METRICS_PER_BATCH):
+            client.log_batch(run_id, metrics=metrics[start : start + MAX_METRICS_PER_BATCH])
+        for start in range(0, len(params), MAX_PARAMS_PER_BATCH):
+            client.log_batch(run_id, params=params[start : start + MAX_PARAMS_PER_BATCH])
+        for start in range(0, len(tags), MAX_TAGS_PER_BATCH):
+            client.log_batch(run_id, tags=tags[start : start + MAX_TAGS_PER_BATCH])
+        for record in records:
+            if record["type"] == "artifact":
+                client.log_artifact(run_id, record["local_path"], record["artifact_path"])
+        os.remove(os.path.join(spool_dir, filename))
+        shutil.rmtree(os.path.join(spool_dir, run_id), ignore_errors=True)
+        sent += len(records)
+    return sent
+
+
+def measure_overhead(n_trials: int = 100, metrics_per_trial: int = 10) -> dict:
+    """
+    Time per trial spent on logging with blocking `mlflow.log_metric` calls and with `AsyncTracker`.
+
+    Both variants log into a new run of the current experiment.
+
+    Returns:
+        dict: Seconds per trial for both variants.
+    """
+    result = {}
+    with mlflow.start_run(run_name="tracking_overhead_blocking"):
+        start = time.perf_counter()
+        for trial in range(n_trials):
+            for i in range(metrics_per_trial):
+                mlflow.log_metric(f"metric_{i}", trial * i, step=trial)
+        result["blocking_seconds_per_trial"] = (time.perf_counter() - start) / n_trials
+    with mlflow.start_run(run_name="tracking_overhead_async"), AsyncTracker() as tracker:
+        start = time.perf_counter()
+        for trial in range(n_trials):
+            tracker.log_metrics({f"metric_{i}": trial * i for i in range(metrics_per_trial)}, step=trial)
+        result["async_seconds_per_trial"] = (time.perf_counter() - start) / n_trials
+        start = time.perf_counter()
+        tracker.flush()
+        result["async_flush_seconds"] = time.perf_counter() - start
+    return result
+
+
+if __name__ == "__main__":
+    import logging
+
+    from modeling.config import TRACKING_URI, EXPERIMENT_NAME
+
+    logging.basicConfig(format="%(asctime)s: %(message)s", level=logging.INFO)
+
+    mlflow.set_tracking_uri(TRACKING_URI)
+    mlflow.set_experiment(EXPERIMENT_NAME)
+    result = measure_overhead()
+    logger.info(
+        "logging overhead per trial: blocking {:.2f}ms, async {:.3f}ms (final flush {:.2f}s)".format(
+            result["blocking_seconds_per_trial"] * 1000,
+            result["async_seconds_per_trial"] * 1000,
+            result["async_flush_seconds"],
+        )
+    )
@@ -1,23 +1,20 @@
 from logging import getLogger
+import shutil
 import pandas as pd
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import mean_squared_error, r2_score
 from sklearn.linear_model import LinearRegression
+from sklearn.pipeline import Pipeline
 import pickle
 import warnings
 import mlflow
 from mlflow.sklearn import save_model  # , log_model
 
-from modeling.feature_engineering import (
-    fill_missing_values,
-    drop_column,
-    transform_altitude,
-    altitude_high_meters_mean,
-    altitude_mean_log_mean,
-    altitude_low_meters_mean,
-)
+from modeling.feature_engineering import CoffeeFeatures
 
 from modeling.config import TRACKING_URI, EXPERIMENT_NAME
+from modeling.datasets import load_dataset, save_split
+from modeling.tracking import AsyncTracker
 
 warnings.filterwarnings("ignore")
 logger = getLogger(__name__)
@@ -25,14 +22,12 @@ logger = getLogger(__name__)
 
 def __get_data():
     logger.info("Getting the data")
+    # the datasets are downloaded only once into data/cache, with FINAPP_OFFLINE=1 nothing is downloaded
     # coffee data
-    url = "https://github.com/jldbc/coffee-quality-database/raw/master/data/robusta_data_cleaned.csv"
-    coffee_features = pd.read_csv(url)
+    coffee_features = load_dataset("robusta_features")
 
     # coffee score
-
-    url = "https://raw.githubusercontent.com/jldbc/coffee-quality-database/master/data/robusta_ratings_raw.csv"
-    coffee_quality = pd.read_csv(url)
+    coffee_quality = load_dataset("robusta_ratings")
 
     # cleaning data and preparing
     Y = coffee_quality["quality_score"]
@@ -44,27 +39,14 @@ def __get_data():
     )
     ## in order to exemplify how the predict will work.. we will save the y_train
     logger.info("Saving test data in the data folder .. wo feat eng")
-    X_test.to_csv("data/X_test.csv", index=False)
-    y_test.to_csv("data/y_test.csv", index=False)
-
-    logger.info("Feature engineering on train")
-    X_train = transform_altitude(X_train)
-    X_train = drop_column(X_train, col_name="Unnamed: 0")
-    X_train = drop_column(X_train, col_name="Quakers")
-    X_train = fill_missing_values(X_train)
-
-    # feature eng on test data
-    logger.info("Feature engineering on test")
-    X_test = transform_altitude(X_test)
-    X_test = drop_column(X_test, col_name="Unnamed: 0")
-    X_test = drop_column(X_test, col_name="Quakers")
-    X_test = fill_missing_values(X_test)
+    save_split({"X_test": X_test, "y_test": y_test})
 
+    # the feature engineering is the first step of the model pipeline
     return X_train, X_test, y_train, y_test
 
 
 def __compute_and_log_metrics(
-    y_true: pd.Series, y_pred: pd.Series, prefix: str = "train"
+    y_true: pd.Series, y_pred: pd.Series, tracker: AsyncTracker, prefix: str = "train"
 ):
     mse = mean_squared_error(y_true, y_pred)
     r2 = r2_score(y_true, y_pred)
@@ -74,8 +56,7 @@ def __compute_and_log_metrics(
         + str(prefix)
         + " set: MSE = {:.1f}, R2 = {:.1%},".format(mse, r2)
     )
-    mlflow.log_metric(prefix + "-" + "MSE", mse)
-    mlflow.log_metric(prefix + "-" + "R2", r2)
+    tracker.log_metrics({prefix + "-" + "MSE": mse, prefix + "-" + "R2": r2})
 
     return mse, r2
 
@@ -89,29 +70,33 @@ def run_training():
     mlflow.set_experiment(EXPERIMENT_NAME)
     # model
     logger.info("Training a simple linear regression")
-    with mlflow.start_run():
-        reg = LinearRegression().fit(X_train, y_train)
+    # the tracker sends the params and metrics in the background, the training doesn't wait for the server
+    with mlflow.start_run(), AsyncTracker() as tracker:
+        # the statistics for the feature engineering are learned on the train data and saved with the model
+        reg = Pipeline(
+            [("features", CoffeeFeatures()), ("model", LinearRegression())]
+        ).fit(X_train, y_train)
         # taking some parameters out of the feature eng.. in your case you can use the params from CV
         params = {
-            "altitude_low_meters_mean": altitude_low_meters_mean,
-            "altitude_high_meters_mean": altitude_high_meters_mean,
-            "altitude_mean_log_mean": altitude_mean_log_mean,
+            **reg.named_steps["features"].statistics_,
             "fit_intercept": True,
         }
-        mlflow.log_params(params)
-        mlflow.set_tag("worst_model", "True")
+        tracker.log_params(params)
+        tracker.set_tag("worst_model", "True")
         y_train_pred = reg.predict(X_train)
 
-        __compute_and_log_metrics(y_train, y_train_pred)
+        __compute_and_log_metrics(y_train, y_train_pred, tracker)
 
         y_test_pred = reg.predict(X_test)
-        __compute_and_log_metrics(y_test, y_test_pred, "test")
+        __compute_and_log_metrics(y_test, y_test_pred, tracker, "test")
 
         logger.info("this is obviously fishy")
-        # saving the model
-        # logger.info("Saving model in the model folder")
-        # path = "models/linear"
-        # save_model(sk_model=reg, path=path)
+        # saving the model together with the feature engineering, the code is copied into the model
+        # folder, so predict.py can load the pipeline without the repository on the path
+        logger.info("Saving model in the model folder")
+        path = "models/linear"
+        shutil.rmtree(path, ignore_errors=True)
+        save_model(sk_model=reg, path=path, code_paths=["modeling"])
         # logging the model to mlflow will not work without a AWS Connection setup.. too complex for now
 
 
@@ -1,29 +1,144 @@
-from sklearn.metrics import classification_report, ConfusionMatrixDisplay
+from sklearn.metrics import ConfusionMatrixDisplay, roc_auc_score
 from sklearn.preprocessing import OrdinalEncoder
 import matplotlib.pyplot as plt
 import mlflow
+import numpy as np
 
-def check_classification_binary(model, X_train, X_test, y_train, y_test, normalize=None):
+def binary_confusion_counts(y_true, y_pred, labels=(0, 1)):
+    """
+    Confusion matrix of a binary classification, computed with a single `np.bincount`.
+
+    Args:
+        y_true: True labels.
+        y_pred: Predicted labels.
+        labels (tuple): The negative and the positive label, in this order.
+
+    Raises:
+        ValueError: If y_true or y_pred contain other values than the labels.
+
+    Returns:
+        np.ndarray: 2x2 matrix, rows are the true labels, columns the predicted labels.
+    """
+    y_true = np.asarray(y_true).ravel()
+    y_pred = np.asarray(y_pred).ravel()
+    true_pos = y_true == labels[1]
+    pred_pos = y_pred == labels[1]
+    if not (true_pos | (y_true == labels[0])).all() or not (pred_pos | (y_pred == labels[0])).all():
+        raise ValueError(f'Expected only the labels {labels}')
+    return np.bincount(2 * true_pos + pred_pos, minlength=4).reshape(2, 2)
+
+def metrics_from_confusion(cm):
+    """
+    Precision, recall, f1-score and support per class, accuracy and the averages from a 2x2 confusion matrix.
+
+    Returns:
+        dict: Keys 0 and 1 (index of the class), 'accuracy', 'macro avg' and 'weighted avg'
+            with the same structure as `classification_report(..., output_dict=True)`.
+    """
+    cm = np.asarray(cm, dtype=float)
+    support = cm.sum(axis=1)
+    predicted = cm.sum(axis=0)
+    correct = np.diag(cm)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.nan_to_num(correct / predicted)
+        recall = np.nan_to_num(correct / support)
+        f1 = np.nan_to_num(2 * precision * recall / (precision + recall))
+    total = support.sum()
+    metrics = {
+        i: {'precision': float(precision[i]), 'recall': float(recall[i]), 'f1-score': float(f1[i]), 'support': int(support[i])}
+        for i in range(2)
+    }
+    metrics['accuracy'] = float(correct.sum() / total) if total else 0.0
+    weights = support / total if total else np.zeros(2)
+    for name, w in [('macro avg', np.full(2, 0.5)), ('weighted avg', weights)]:
+        metrics[name] = {
+            'precision': float(precision @ w), 'recall': float(recall @ w), 'f1-score': float(f1 @ w), 'support': int(total)
+        }
+    return metrics
+
+def format_classification_report(metrics, target_names, digits=3):
+    """Text report in the layout of sklearn's `classification_report` from the output of `metrics_from_confusion`."""
+    headers = ['precision', 'recall', 'f1-score', 'support']
+    width = max(len(name) for name in list(target_names) + ['weighted avg'])
+    head_fmt = '{:>{width}s} ' + ' {:>9}' * len(headers)
+    row_fmt = '{:>{width}s} ' + ' {:>9.{digits}f}' * 3 + ' {:>9}\n'
+    report = head_fmt.format('', *headers, width=width) + '\n\n'
+    for i, name in enumerate(target_names):
+        m = metrics[i]
+        report += row_fmt.format(name, m['precision'], m['recall'], m['f1-score'], m['support'], width=width, digits=digits)
+    report += '\n'
+    accuracy_fmt = '{:>{width}s} ' + ' {:>9}' * 2 + ' {:>9.{digits}f} {:>9}\n'
+    report += accuracy_fmt.format('accuracy', '', '', metrics['accuracy'], metrics['weighted avg']['support'], width=width, digits=digits)
+    for name in ['macro avg', 'weighted avg']:
+        m = metrics[name]
+        report += row_fmt.format(name, m['precision'], m['recall'], m['f1-score'], m['support'], width=width, digits=digits)
+    return report
+
+def evaluate_classification_binary(y_true, y_pred=None, y_proba=None, model=None, X=None, threshold=0.5, labels=(0, 1)):
+    """
+    Metrics of a binary classifier, the model predicts at most once.
+
+    The predictions can be passed directly (`y_pred` and/or `y_proba`, the probability of the positive
+    label), otherwise `model.predict(X)` is called. All metrics except the ROC AUC are derived from
+    the confusion counts.
+
+    Returns:
+        dict: 'confusion_matrix', the metrics of `metrics_from_confusion` and 'roc_auc' if probabilities are given.
+    """
+    if y_pred is None:
+        if y_proba is not None:
+            y_pred = np.where(np.asarray(y_proba) >= threshold, labels[1], labels[0])
+        elif model is not None:
+            y_pred = model.predict(X)
+        else:
+            raise ValueError('Either y_pred, y_proba or model and X are required')
+    cm = binary_confusion_counts(y_true, y_pred, labels)
+    result = {'confusion_matrix': cm, **metrics_from_confusion(cm)}
+    if y_proba is not None:
+        result['roc_auc'] = roc_auc_score(np.asarray(y_true) == labels[1], y_proba)
+    return result
+
+def _normalize_confusion(cm, normalize):
+    cm = cm.astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if normalize == 'true':
+            cm = cm / cm.sum(axis=1, keepdims=True)
+        elif normalize == 'pred':
+            cm = cm / cm.sum(axis=0, keepdims=True)
+        elif normalize == 'all':
+            cm = cm / cm.sum()
+    return np.nan_to_num(cm)
+
+def check_classification_binary(model, X_train, X_test, y_train, y_test, normalize=None, tracker=None,
+                                train_pred_y=None, test_pred_y=None, train_proba_y=None, test_proba_y=None, plot=True):
     """
     Evaluates the performance of a given model on training and testing datasets.
 
     The function performs the following steps:
-    1. Predicts the target variable for both training and testing datasets.
-    2. Displays confusion matrices for both datasets using `ConfusionMatrixDisplay`.
-    3. Generates and displays classification reports for both datasets.
+    1. Predicts the target variable for both training and testing datasets, exactly once per dataset.
+       Already computed predictions or probabilities can be passed, then the model isn't used for that dataset.
+    2. Computes confusion matrices and classification reports from the confusion counts.
+    3. If `plot` is True, displays the confusion matrices and the classification reports.
 
     Args:
-        model: The trained machine learning model to evaluate.
+        model: The trained machine learning model to evaluate. Can be None if the predictions are passed.
         X_train: Training features.
         X_test: Testing features.
         y_train: Training target.
         y_test: Testing target.
-        normalize (str or None, optional): This parameter is passed directly to the `normalize` argument of `ConfusionMatrixDisplay.from_estimator`. It determines how the confusion matrix is normalized. Acceptable values are:
+        normalize (str or None, optional): Normalization of the displayed confusion matrix, like the `normalize` argument of `ConfusionMatrixDisplay.from_estimator`. Acceptable values are:
             - None: No normalization is applied (counts are shown).
             - 'true': Normalize over the true (rows).
             - 'pred': Normalize over the predicted (columns).
             - 'all': Normalize over the whole matrix (all values sum to 1).
         See the scikit-learn documentation for more details.
+        tracker (AsyncTracker, optional): If given, the figure is uploaded in the background by the tracker
+            (see `modeling/tracking.py`) instead of a blocking `mlflow.log_figure` call.
+        train_pred_y (optional): Predictions for X_train.
+        test_pred_y (optional): Predictions for X_test.
+        train_proba_y (optional): Probabilities of the positive class for X_train, adds the ROC AUC to the metrics.
+        test_proba_y (optional): Probabilities of the positive class for X_test.
+        plot (bool): Render the figure. Without it, nothing is displayed or logged to mlflow.
 
     Visualization:
         - The function creates a 2x2 grid of subplots:
@@ -31,11 +146,15 @@ def check_classification_binary(model, X_train, X_test, y_train, y_test, normali
             - Bottom row: Classification reports for test and train datasets.
 
     Returns:
-        None: The function directly displays the evaluation results.
+        dict: The metrics of `evaluate_classification_binary` for 'test' and 'train'.
     """
 
-    test_pred_y = model.predict(X_test)
-    train_pred_y = model.predict(X_train)
+    results = {
+        'test': evaluate_classification_binary(y_test, test_pred_y, test_proba_y, model, X_test),
+        'train': evaluate_classification_binary(y_train, train_pred_y, train_proba_y, model, X_train),
+    }
+    if not plot:
+        return results
 
     classes = ['Terminated', 'Fulfilled']
     fig, axes = plt.subplots(nrows=2, ncols=2, figsize=(12, 6), gridspec_kw={'height_ratios': [3, 1]})
@@ -43,21 +162,33 @@ def check_classification_binary(model, X_train, X_test, y_train, y_test, normali
     values_format = 'd'
     if normalize != None:
         values_format = '.3f'
-    cmd_test = ConfusionMatrixDisplay.from_estimator(model, X_test, y_test, display_labels=classes, normalize=normalize, values_format=values_format, cmap='Blues', ax=axes[0][0])
-    axes[0][0].set_title('Test Data')
-    axes[1][0].text(0, 0, classification_report(y_test, test_pred_y, target_names=classes, digits=3), verticalalignment='top', fontfamily='monospace')
-    axes[1][0].axis('off')
-
-    cmd_test = ConfusionMatrixDisplay.from_estimator(model, X_train, y_train, display_labels=classes, normalize=normalize, values_format=values_format, cmap='Greens', ax=axes[0][1])
-    axes[0][1].set_title('Train Data')
-    axes[1][1].text(0, 0, classification_report(y_train, train_pred_y, target_names=classes, digits=3), verticalalignment='top', fontfamily='monospace')
-    axes[1][1].axis('off')
-    if mlflow.active_run():
+    for col, (name, title, cmap) in enumerate([('test', 'Test Data', 'Blues'), ('train', 'Train Data', 'Greens')]):
+        cm = results[name]['confusion_matrix']
+        if normalize != None:
+            cm = _normalize_confusion(cm, normalize)
+        ConfusionMatrixDisplay(cm, display_labels=classes).plot(values_format=values_format, cmap=cmap, ax=axes[0][col])
+        axes[0][col].set_title(title)
+        axes[1][col].text(0, 0, format_classification_report(results[name], classes, digits=3), verticalalignment='top', fontfamily='monospace')
+        axes[1][col].axis('off')
+    if tracker is not None:
+        fig.tight_layout()
+        tracker.log_figure(fig, 'classification_matrix.png')
+    elif mlflow.active_run():
         print('will update classificatin_matrix.png')
         fig.tight_layout()
         mlflow.log_figure(fig, 'classification_matrix.png')
+    return results
 
-def encode_categorical_columns(df, encoder=OrdinalEncoder(), num_columns=None, cat_columns=None):
+def encode_categorical_columns(df, encoder=None, num_columns=None, cat_columns=None):
+    """
+    Fits the encoder on the categorical columns of df and returns an encoded copy.
+
+    Every call learns the categories again, so train and test data encoded with separate calls
+    can get different codes. Use `CategoricalEncoderRegistry` in `modeling/encoding.py` to fit once
+    on the training data and encode all splits consistently.
+    """
+    if encoder is None:
+        encoder = OrdinalEncoder()
     if cat_columns == None:
         cat_columns = [col for col in df.columns if col not in num_columns]
     df_copy = df.copy()
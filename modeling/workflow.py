@@ -0,0 +1,401 @@
+"""
+Incremental runner of the pipeline from the DAZUBI crawl to the models.
+
+The steps from the raw data to the models are scripts and notebooks that hand over files in `data/`.
+`STAGES` declares each step with its input and output files and the code it depends on. A stage
+is run again only if its fingerprint changed, the hash of the contents of its inputs, of its code
+and of its command, or if one of its outputs is missing. The hashes are kept in a state file with
+the size and modification time of every file, so unchanged files are not read again and a run
+without changes only calls `os.stat`. A stage whose new outputs are identical to the old ones
+doesn't trigger its dependents.
+
+The dependencies between the stages follow from the files: a stage depends on the stages that
+write its inputs. Stages whose dependencies are finished run in parallel in a thread pool (the
+notebooks and scripts run as subprocesses). Some steps didn't fit together, they are bridged by
+conversion stages:
+
+- `download_dazubi.py` writes `dazubi_complete.csv`, `dazubi_split.ipynb` reads `dazubi_complete.parquet`
+- `dazubi_split.ipynb` writes `dazubi_berufe.parquet`, `dazubi_cleaning.ipynb` reads `dazubi_berufe.csv`
+- `synthetic_population_dp.ipynb` writes `synthetic_population.csv` next to the notebook,
+  `feature_integration.ipynb` reads it from `data/`
+
+The crawl and the IAB download are `manual` stages: they only run if their outputs are missing or
+if they are forced, a change of their code or of another stage never repeats the download.
+`synthetic_population.ipynb` is not a stage, the notebook contains unresolved merge conflicts.
+`synth_combined.csv` is a source, it's not written by any stage.
+
+Usage (run from the repository root):
+
+    python -m modeling.workflow                     # everything that is out of date
+    python -m modeling.workflow dazubi_cleaning     # a stage and the stages it depends on
+    python -m modeling.workflow --dry-run           # show what would run
+    python -m modeling.workflow --force crawl       # run a stage even if it's up to date
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from logging import getLogger
+
+import pandas as pd
+
+logger = getLogger(__name__)
+
+STATE_PATH = "data/cache/workflow/state.json"
+NOTEBOOK_OUTPUT_DIR = "data/cache/workflow/notebooks"
+
+
+class Stage:
+    """
+    One step of the pipeline.
+
+    Args:
+        name (str): Unique name.
+        inputs (list): Files read by the stage.
+        outputs (list): Files written by the stage.
+        command: Command line as list (run from the repository root) or a Python function without arguments.
+        code (list): Files of the code, e.g. the notebook or script. Changing one reruns the stage.
+        manual (bool): Only run if an output is missing or the stage is forced.
+    """
+
+    def __init__(self, name: str, inputs: list, outputs: list, command, code: list = (), manual: bool = False):
+        self.name = name
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.command = command
+        self.code = list(code)
+        self.manual = manual
+
+    def __repr__(self):
+        return f"Stage({self.name!r})"
+
+    def describe(self) -> str:
+        """The command as text, part of the fingerprint."""
+        if callable(self.command):
+            return f"{self.command.__module__}.{getattr(self.command, '__qualname__', repr(self.command))}"
+        return " ".join(self.command)
+
+    def run(self):
+        for path in self.outputs:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if callable(self.command):
+            self.command()
+        else:
+            subprocess.run(self.command, check=True)
+
+
+def _atomic(write, path: str):
+    tmp_filename = path + ".tmp"
+    try:
+        write(tmp_filename)
+        os.replace(tmp_filename, path)
+    except (KeyboardInterrupt, OSError, RuntimeError):
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+
+def parquet_to_csv(source: str, target: str):
+    """Returns a function that converts a Parquet file to CSV with the index as first column."""
+
+    def convert():
+        df = pd.read_parquet(source)
+        _atomic(lambda path: df.to_csv(path), target)
+
+    convert.__qualname__ = f"parquet_to_csv({source}, {target})"
+    return convert
+
+
+def copy_file(source: str, target: str):
+    def copy():
+        _atomic(lambda path: shutil.copyfile(source, path), target)
+
+    copy.__qualname__ = f"copy_file({source}, {target})"
+    return copy
+
+
+def notebook(path: str) -> list:
+    """Command to execute a notebook in its directory, the executed copy is saved in NOTEBOOK_OUTPUT_DIR."""
+    return [sys.executable, "-m", "nbconvert", "--to", "notebook", "--execute", "--output-dir", NOTEBOOK_OUTPUT_DIR, path]
+
+
+def script(*args: str) -> list:
+    return [sys.executable, *args]
+
+
+def module(name: str, *args: str) -> list:
+    return [sys.executable, "-m", name, *args]
+
+
+DAZUBI_SPLIT_OUTPUTS = [
+    f"data/dazubi_{name}.parquet"
+    for name in ("deutschland", "westdeutschland", "ostdeutschland", "alte_laender", "neue_laender", "bundeslaender", "insgesamt", "berufe")
+]
+
+STAGES = [
+    Stage("crawl", [], ["data/dazubi_complete.csv"], script("data_collect/download_dazubi.py"), ["data_collect/download_dazubi.py"], manual=True),
+    Stage(
+        "dazubi_to_parquet", ["data/dazubi_complete.csv"], ["data/dazubi_complete.parquet"],
+        script("data_collect/schema.py", "data/dazubi_complete.csv", "--parquet", "data/dazubi_complete.parquet", "--no-check"), ["data_collect/schema.py"],
+    ),
+    Stage("dazubi_split", ["data/dazubi_complete.parquet"], DAZUBI_SPLIT_OUTPUTS, notebook("notebooks/dazubi_split.ipynb"), ["notebooks/dazubi_split.ipynb"]),
+    Stage("berufe_to_csv", ["data/dazubi_berufe.parquet"], ["data/dazubi_berufe.csv"], parquet_to_csv("data/dazubi_berufe.parquet", "data/dazubi_berufe.csv")),
+    Stage("dazubi_cleaning", ["data/dazubi_berufe.csv"], ["data/dazubi_grouped_berufe.csv"], notebook("notebooks/dazubi_cleaning.ipynb"), ["notebooks/dazubi_cleaning.ipynb"]),
+    Stage(
+        # the notebook writes its population as synthetische_population.csv next to itself
+        "synthetic_population_dp", ["data/dazubi_grouped_berufe.csv"], ["notebooks/synthetische_population.csv"],
+        notebook("notebooks/synthetic_population_dp.ipynb"), ["notebooks/synthetic_population_dp.ipynb"],
+    ),
+    Stage(
+        "synthetic_population_to_data", ["notebooks/synthetische_population.csv"], ["data/synthetic_population.csv"],
+        copy_file("notebooks/synthetische_population.csv", "data/synthetic_population.csv"),
+    ),
+    Stage("iab", [], ["data/iab_features.parquet"], script("data_collect/iab.py"), ["data_collect/iab.py"], manual=True),
+    Stage(
+        "feature_integration",
+        ["data/synthetic_population.csv", "data/iab_features.parquet", "data/destatis/nominalwage_idx.csv", "data/destatis/nominalwage_rate.csv"],
+        ["data/state_year_features.parquet"],
+        notebook("notebooks/feature_integration.ipynb"),
+        ["notebooks/feature_integration.ipynb", "data_collect/destatis.py", "data_collect/iab.py", "modeling/enrichment.py"],
+    ),
+    Stage("cube", ["data/dazubi_grouped_berufe.csv"], ["data/dazubi_cube.npz"], module("modeling.cube", "data/dazubi_grouped_berufe.csv"), ["modeling/cube.py"]),
+    Stage(
+        "forecasts", ["data/dazubi_grouped_berufe.csv"], ["data/forecasts/dazubi_forecasts.parquet"],
+        module("modeling.forecasting", "data/dazubi_grouped_berufe.csv"), ["modeling/forecasting.py", "modeling/cube.py"],
+    ),
+    Stage(
+        "dropout_risk_model", ["data/dazubi_grouped_berufe.csv"], ["models/dropout_risk/model.json", "models/dropout_risk/encoder.json"],
+        module("modeling.dropout_risk", "data/dazubi_grouped_berufe.csv"), ["modeling/dropout_risk.py", "modeling/encoding.py"],
+    ),
+    Stage(
+        "explanations", ["models/dropout_risk/model.json", "models/dropout_risk/encoder.json"], ["data/explanations/dropout_risk_shap.parquet"],
+        module("modeling.explain", "models/dropout_risk"), ["modeling/explain.py", "modeling/dropout_risk.py"],
+    ),
+    Stage("model_simple", ["data/synth_combined.csv"], [], notebook("notebooks/model_simple.ipynb"), ["notebooks/model_simple.ipynb", "modeling/utils.py", "modeling/encoding.py"]),
+    Stage("model_pipeline", ["data/synth_combined.csv"], [], notebook("notebooks/model_pipeline.ipynb"), ["notebooks/model_pipeline.ipynb", "modeling/utils.py"]),
+    Stage("model_optuna", ["data/synth_combined.csv"], [], notebook("notebooks/model_optuna.ipynb"), ["notebooks/model_optuna.ipynb", "modeling/utils.py", "modeling/encoding.py"]),
+]
+
+
+class FileHashes:
+    """
+    Content hashes of files, cached by size and modification time in the state file.
+
+    A file whose size and mtime didn't change since the last run is not read again.
+    """
+
+    def __init__(self, cache: dict):
+        self.cache = cache
+
+    def get(self, path: str) -> str:
+        """sha256 of the file, None if it doesn't exist."""
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        key = [stat.st_size, stat.st_mtime_ns]
+        cached = self.cache.get(path)
+        if cached and cached[0] == key:
+            return cached[1]
+        digest = hashlib.sha256()
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                digest.update(block)
+        self.cache[path] = [key, digest.hexdigest()]
+        return self.cache[path][1]
+
+
+class Workflow:
+    """
+    Runs the stages that are out of date in the order of their dependencies.
+
+    Args:
+        stages (list): The stages, each output is written by one stage only.
+        state_path (str): JSON file with the file hashes and the fingerprints of the last successful runs.
+    """
+
+    def __init__(self, stages: list = STAGES, state_path: str = STATE_PATH):
+        self.stages = {stage.name: stage for stage in stages}
+        self.state_path = state_path
+        self.producers = {}
+        for stage in stages:
+            for path in stage.outputs:
+                if path in self.producers:
+                    raise ValueError(f"{path} is written by {self.producers[path]} and {stage.name}")
+                self.producers[path] = stage.name
+        self.dependencies = {
+            stage.name: sorted({self.producers[path] for path in stage.inputs if path in self.producers}) for stage in stages
+        }
+        self._check_cycles()
+        state = {"files": {}, "stages": {}}
+        if os.path.exists(state_path):
+            with open(state_path) as file:
+                state = json.load(file)
+        self.hashes = FileHashes(state["files"])
+        self.fingerprints = state["stages"]
+
+    def _check_cycles(self):
+        visiting, done = set(), set()
+
+        def visit(name, path):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError(f"Cycle between the stages {' -> '.join(path + [name])}")
+            visiting.add(name)
+            for dependency in self.dependencies[name]:
+                visit(dependency, path + [name])
+            visiting.discard(name)
+            done.add(name)
+
+        for name in self.stages:
+            visit(name, [])
+
+    def save_state(self):
+        os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+        state = {"files": self.hashes.cache, "stages": self.fingerprints}
+
+        def write(path):
+            with open(path, "w") as file:
+                json.dump(state, file, indent=1, sort_keys=True)
+
+        _atomic(write, self.state_path)
+
+    def fingerprint(self, stage: Stage) -> str:
+        """Hash of the input contents, the code and the command, None if an input is missing."""
+        digest = hashlib.sha256(stage.describe().encode())
+        for path in stage.inputs + stage.code:
+            file_hash = self.hashes.get(path)
+            if file_hash is None:
+                return None
+            digest.update(f"{path}:{file_hash}".encode())
+        return digest.hexdigest()
+
+    def is_up_to_date(self, stage: Stage, fingerprint: str) -> bool:
+        if any(not os.path.exists(path) for path in stage.outputs):
+            return False
+        return stage.manual or self.fingerprints.get(stage.name) == fingerprint
+
+    def upstream(self, targets) -> list:
+        """The targets and all the stages they depend on, in the order of STAGES."""
+        selected = set()
+
+        def visit(name):
+            if name not in selected:
+                selected.add(name)
+                for dependency in self.dependencies[name]:
+                    visit(dependency)
+
+        for name in targets:
+            if name not in self.stages:
+                raise KeyError(f"Unknown stage {name}, stages: {', '.join(self.stages)}")
+            visit(name)
+        return [name for name in self.stages if name in selected]
+
+    def run(self, targets=None, jobs: int = 4, force=(), dry_run: bool = False) -> dict:
+        """
+        Runs the stages that are out of date.
+
+        Args:
+            targets (list, optional): Run these stages and their dependencies, default all.
+            jobs (int): Maximum number of stages running at the same time.
+            force (list): Run these stages even if they are up to date.
+            dry_run (bool): Only report what would run. Stages after a stage that would run are
+                reported as 'waiting', whether they run depends on the new outputs.
+
+        Returns:
+            dict: Status per stage: 'up to date', 'ran', 'would run', 'waiting', 'failed',
+                'skipped' (a dependency failed) or 'missing input' (a source file doesn't exist).
+        """
+        names = self.upstream(targets) if targets else list(self.stages)
+        status = {}
+        pending = set(names)
+        running = {}
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            while pending or running:
+                for name in [name for name in names if name in pending]:
+                    unfinished = pending | {running_name for running_name, *_ in running.values()}
+                    dependencies = [d for d in self.dependencies[name] if d in status or d in unfinished]
+                    if any(d in unfinished for d in dependencies):
+                        continue
+                    pending.discard(name)
+                    if any(status[d] in ("failed", "skipped", "missing input", "waiting", "would run") for d in dependencies):
+                        blocked = {"failed": "skipped", "skipped": "skipped", "missing input": "skipped"}
+                        status[name] = next((blocked[status[d]] for d in dependencies if status[d] in blocked), "waiting")
+                        continue
+                    stage = self.stages[name]
+                    fingerprint = self.fingerprint(stage)
+                    if fingerprint is None:
+                        missing = [path for path in stage.inputs + stage.code if not os.path.exists(path)]
+                        logger.warning(f"{name}: missing {', '.join(missing)}")
+                        status[name] = "missing input"
+                        continue
+                    if name not in force and self.is_up_to_date(stage, fingerprint):
+                        status[name] = "up to date"
+                        continue
+                    if dry_run:
+                        status[name] = "would run"
+                        continue
+                    old_outputs = [self.hashes.get(path) for path in stage.outputs]
+                    logger.info(f"{name}: running {stage.describe()}")
+                    running[executor.submit(stage.run)] = (name, fingerprint, old_outputs, time.perf_counter())
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, fingerprint, old_outputs, started = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as error:
+                        logger.error(f"{name}: failed after {time.perf_counter() - started:.1f}s: {error}")
+                        status[name] = "failed"
+                        continue
+                    missing = [path for path in self.stages[name].outputs if not os.path.exists(path)]
+                    if missing:
+                        logger.error(f"{name}: finished without writing {', '.join(missing)}")
+                        status[name] = "failed"
+                        continue
+                    self.fingerprints[self.stages[name].name] = fingerprint
+                    new_outputs = [self.hashes.get(path) for path in self.stages[name].outputs]
+                    unchanged = new_outputs == old_outputs
+                    logger.info(f"{name}: finished in {time.perf_counter() - started:.1f}s{', outputs unchanged' if unchanged else ''}")
+                    status[name] = "ran"
+                    self.save_state()
+        if not dry_run:
+            self.save_state()
+        logger.info(f"Workflow finished in {time.perf_counter() - start:.2f}s")
+        return status
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, description="Run the stages of the pipeline that are out of date")
+    parser.add_argument("targets", nargs="*", help="Stages to bring up to date with their dependencies, default all")
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="Maximum number of stages running in parallel")
+    parser.add_argument("-f", "--force", nargs="*", default=[], help="Run these stages even if they are up to date")
+    parser.add_argument("-n", "--dry-run", action="store_true")
+    parser.add_argument("-l", "--list", action="store_true", help="List the stages with their dependencies")
+    parser.add_argument("--state", default=STATE_PATH)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    import logging
+
+    logging.basicConfig(format="%(asctime)s: %(message)s", level=logging.INFO)
+    args = parse_arguments()
+    workflow = Workflow(state_path=args.state)
+    if args.list:
+        for name, stage in workflow.stages.items():
+            print(f"{name:30} <- {', '.join(workflow.dependencies[name]) or '-':40} {'(manual)' if stage.manual else ''}")
+    else:
+        status = workflow.run(args.targets, args.jobs, args.force, args.dry_run)
+        for name, result in status.items():
+            print(f"{name:30} {result}")
+        if any(result in ("failed", "skipped", "missing input") for result in status.values()):
+            sys.exit(1)